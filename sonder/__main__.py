@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+from contextlib import nullcontext
 import inspect
 
 import itertools
@@ -25,8 +26,9 @@ from sonder import utils
 from sonder.analysis.models import Player, Game
 from sonder.league.utils import download_new_games
 from sonder.league.utils import get_season_ids_for_league
-from sonder.league.utils import get_game_pgns
-from sonder.cr import import_cr_database
+from sonder.league.utils import import_pgns
+from sonder.league.lichess import LichessDownloader
+from sonder.cr import import_cr_database, import_cr_database_bulk
 from sonder.cr import cr_text_report
 from sonder.analysis.models import (
     IrwinReport,
@@ -34,9 +36,23 @@ from sonder.analysis.models import (
     IrwinReportRequiredGame,
     GameAnalysis,
     import_pgn_file_to_db,
-    import_pgn_to_db,
 )
-from sonder.analysis.jobs import update_all_games_reports
+from sonder.analysis.jobs import (
+    enqueue_update_player_reports,
+    index_game_positions,
+    pack_game_analyses,
+    reclaim_stalled_games,
+    update_player_reports,
+)
+from sonder.analysis.packed import iter_pv_cps
+from sonder.analysis.export import (
+    COMPRESSIONS,
+    EXPORT_CHUNK_SIZE,
+    ExportError,
+    compressed,
+    exportable_games,
+    iter_pgns,
+)
 
 BIN_DIR = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 sys.path.insert(0, os.path.join(BIN_DIR, ".."))
@@ -62,8 +78,10 @@ def pgn():
 @click.option(
     "--encoding", default="ISO-8859-1", required=False, help="Encoding of the file"
 )
-def pgn_import(pgn, encoding):
-    import_pgn_file_to_db(pgn, encoding=encoding)
+@click.option("--batch-size", default=1000, help="Number of games per transaction")
+def pgn_import(pgn, encoding, batch_size):
+    games = import_pgn_file_to_db(pgn, encoding=encoding, batch_size=batch_size)
+    click.secho(f"✓ Imported {len(games)} games", fg="green")
 
 
 @pgn.command(name="to_uci")
@@ -75,20 +93,21 @@ def pgn_to_uci(pgn):
 @pgn.command(name="export")
 @click.option("--player", help="Player we are interested in")
 @click.option("--time_control", help="TimeControl to export")
-def pgn_export(player=None, time_control=None):
-    qs = Game.objects.exclude(source_pgn="")
-    if player:
-        try:
-            username = Player.normalize_username(player)
-            player = Player.objects.get(username=username)
-        except Player.DoesNotExist:
-            print(f"Unable to find player: {player}")
-            sys.exit()
-        qs = qs.filter(Q(white_player=player) | Q(black_player=player))
-    if time_control:
-        qs = qs.filter(time_control=time_control)
-    for game in qs:
-        print(f"""{game.source_pgn}\n\n\n""")
+@click.option(
+    "--compression", type=click.Choice(sorted(COMPRESSIONS)), default="none",
+)
+@click.option("--output", type=click.Path(), help="Write to this file instead of stdout")
+@click.option("--chunk-size", default=EXPORT_CHUNK_SIZE, help="Games read per query")
+def pgn_export(player, time_control, compression, output, chunk_size):
+    try:
+        games = exportable_games(player, time_control)
+        data = compressed(iter_pgns(games, chunk_size), compression)
+    except ExportError as e:
+        print(e)
+        sys.exit()
+    with open(output, "wb") if output else nullcontext(sys.stdout.buffer) as fout:
+        for chunk in data:
+            fout.write(chunk)
 
 
 # -------------------------------------------------------------------------------
@@ -104,8 +123,13 @@ def league():
 @click.option(
     "--season", help="number for team4545, number with or without u1800 for lonewolf"
 )
-def league_download_games(league, season=None):
-    download_new_games(league, season)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Revalidate the cached pages of closed seasons as well",
+)
+def league_download_games(league, season=None, refresh=False):
+    download_new_games(league, season, refresh=refresh)
 
 
 @league.command(name="get-season-ids")
@@ -126,9 +150,12 @@ def lichess():
 @click.option(
     "--gameids", required=True, help="List of Lichess game IDs", multiple="true"
 )
-def lichess_download_games(gameids):
-    for pgn in get_game_pgns(gameids):
-        import_pgn_to_db(pgn)
+@click.option("--workers", default=4, help="Number of concurrent requests")
+@click.option("--rate", default=1.0, help="Maximum requests per second")
+def lichess_download_games(gameids, workers, rate):
+    downloader = LichessDownloader(workers=workers, rate=rate)
+    imported = import_pgns(downloader.download(gameids))
+    click.secho(f"✓ Imported {imported} game pgns", fg="green")
 
 
 # -------------------------------------------------------------------------------
@@ -145,8 +172,21 @@ def cr():
 @click.option(
     "--stockfish-version", required=True, help="The stockfish version of the analysis"
 )
-def cr_import(database, analysis_source, stockfish_version):
-    import_cr_database(database, analysis_source, stockfish_version)
+@click.option(
+    "--bulk",
+    is_flag=True,
+    help="Stream the sqlite database directly and write in bulk",
+)
+@click.option(
+    "--batch-size", default=1000, help="Number of rows per batch in bulk mode"
+)
+def cr_import(database, analysis_source, stockfish_version, bulk, batch_size):
+    if bulk:
+        import_cr_database_bulk(
+            database, analysis_source, stockfish_version, batch_size=batch_size
+        )
+    else:
+        import_cr_database(database, analysis_source, stockfish_version)
 
 
 @cr.command(name="report")
@@ -156,8 +196,24 @@ def cr_import(database, analysis_source, stockfish_version):
     help="The games to include in the report as a whitespace separated string of lichess game IDs",
 )
 @click.option("--name", required=True, help="The name of the report")
-def cr_txt_report(gameids, name):
-    cr_text_report(gameids.split(), name)
+@click.option(
+    "--engine",
+    type=click.Choice(["python", "numpy"]),
+    default="python",
+    help="Compute the report move by move or with numpy array operations",
+)
+@click.option(
+    "--workers", default=1, help="Number of processes to generate the report with"
+)
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Recompute every game instead of using the cached per-game results",
+)
+def cr_txt_report(gameids, name, engine, workers, no_cache):
+    cr_text_report(
+        gameids.split(), name, engine=engine, workers=workers, use_cache=not no_cache
+    )
 
 
 @cr.command(name="game-cps-debug")
@@ -177,14 +233,26 @@ def cr_game_cps_debug(gameids):
     for game_id in gameids.split():
         ga = GameAnalysis.objects.get(game__lichess_id=game_id)
         colors = itertools.cycle(["w", "b"])
-        for color, move, a in zip(colors, range(1024), ga.analysis):
-            s = [pov["score"]["cp"] for pov in a["pvs"]]
+        cps = iter_pv_cps(ga.analysis_view())
+        for color, move, s in zip(colors, range(1024), cps):
             if move % 2 == 1:
                 move = move - 1
             move = (move // 2) + 1
             print(f"{color},{move},{s[0]},{s[1]},{s[2]},{s[3]},{s[4]}")
 
 
+@cr.command(name="pack-analysis")
+@click.option("--batch-size", default=500, help="Number of analyses per batch")
+@click.option(
+    "--drop-json",
+    is_flag=True,
+    help="Clear the JSON analysis once the packed version is stored",
+)
+def cr_pack_analysis(batch_size, drop_json):
+    """Backfill the packed representation of game analyses."""
+    pack_game_analyses(batch_size=batch_size, drop_json=drop_json, progress=True)
+
+
 # -------------------------------------------------------------------------------
 # Jobs commands
 # -------------------------------------------------------------------------------
@@ -193,9 +261,36 @@ def jobs():
     pass
 
 
-@jobs.command(name="update_all_games")
-def jobs_update_all_games():
-    update_all_games_reports(progress=True)
+@jobs.command(name="update-player-reports")
+@click.option(
+    "--full", is_flag=True, help="Recompute every player rather than resuming"
+)
+@click.option(
+    "--enqueue", is_flag=True, help="Run the job on the rq worker instead of here"
+)
+def jobs_update_player_reports(full, enqueue):
+    if enqueue:
+        job = enqueue_update_player_reports(full=full)
+        click.secho(f"✓ Enqueued {job.id}", fg="green")
+    else:
+        update_player_reports(full=full, progress=True)
+
+
+@jobs.command(name="reclaim-stalled")
+def jobs_reclaim_stalled():
+    """Requeue games whose fishnet client stopped reporting progress.
+
+    Meant to be run periodically, e.g. from cron.
+    """
+    reclaim_stalled_games(progress=True)
+
+
+@jobs.command(name="index-positions")
+@click.option("--workers", default=1, help="Number of processes to index with")
+@click.option("--batch-size", default=1000, help="Number of games per batch")
+def jobs_index_positions(workers, batch_size):
+    """Index the positions of games imported before they were indexed."""
+    index_game_positions(workers=workers, batch_size=batch_size, progress=True)
 
 
 # -------------------------------------------------------------------------------
@@ -233,13 +328,8 @@ def create_test_irwin_jobs(source, player, number):
         precedence=precedence,
     )
     games = Game.objects.filter(Q(white_player=player) | Q(black_player=player))[:number]
-    for g in games:
-        IrwinReportRequiredGame.objects.get_or_create(
-            irwin_report=report,
-            game=g,
-            completed=False,
-            owner=None
-        )
+    required = set(report.irwinreportrequiredgame_set.values_list("game", flat=True))
+    IrwinReportRequiredGame.enqueue(report, [g for g in games if g.pk not in required])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+"""
+Streams games out of the database as PGN, optionally compressed.
+"""
+import zlib
+
+from django.db.models import Q
+
+from .models import Game, Player
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+EXPORT_CHUNK_SIZE = 2000
+
+# The file name extension of each supported compression.
+COMPRESSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+class ExportError(Exception):
+    pass
+
+
+def exportable_games(player=None, time_control=None):
+    """The games that have a PGN, of player (a username) if given."""
+    games = Game.objects.exclude(source_pgn="")
+    if player:
+        username = Player.normalize_username(player)
+        try:
+            player = Player.objects.get(username=username)
+        except Player.DoesNotExist:
+            raise ExportError(f"Unable to find player: {username}")
+        games = games.filter(Q(white_player=player) | Q(black_player=player))
+    if time_control:
+        games = games.filter(time_control=time_control)
+    return games
+
+
+def iter_pgns(games, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the PGN of each of games, reading chunk_size rows at a time.
+
+    Only source_pgn is read from the database, and only chunk_size games are
+    in memory at once, so memory use doesn't grow with the number of games.
+    """
+    for source_pgn in (
+        games.order_by("pk").values_list("source_pgn", flat=True).iterator(chunk_size)
+    ):
+        yield f"{source_pgn}\n\n\n"
+
+
+def compressor(compression):
+    """An object with compress() and flush() for compression, or None."""
+    if compression == "none":
+        return None
+    if compression == "gzip":
+        return zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ExportError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor().compressobj()
+    raise ExportError(f"Unknown compression: {compression}")
+
+
+def compressed(chunks, compression="none"):
+    """Encode the str chunks and compress them as they are consumed.
+
+    The compressor is created up front so that an unsupported compression
+    raises ExportError before anything is yielded.
+    """
+    compress = compressor(compression)
+
+    def generate():
+        for chunk in chunks:
+            data = chunk.encode()
+            if compress is not None:
+                data = compress.compress(data)
+            if data:
+                yield data
+        if compress is not None:
+            yield compress.flush()
+
+    return generate()
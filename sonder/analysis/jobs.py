@@ -1,13 +1,245 @@
 """
 Some background jobs.
 """
-from .models import Player
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import timedelta
+import math
+from multiprocessing import get_context
+
+import click
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Max, Min, Q
+from django.utils import timezone
 from tqdm import tqdm
 
+from .models import (
+    Player,
+    Game,
+    GameAnalysis,
+    GamePosition,
+    CRReport,
+    IrwinReportRequiredGame,
+    JobCheckpoint,
+)
+from .packed import UnpackableAnalysis
+
+FULL_REPORT_NAME = "full"
+PLAYER_REPORTS_CHECKPOINT = "player-reports"
+
+
+def update_player_report(player):
+    """Recompute the CRReport covering every analysed game of player."""
+    # Imported here as sonder.cr imports the models.
+    from sonder.cr import a1_report_for_games
+
+    gameids = list(
+        GameAnalysis.objects.filter(
+            Q(game__white_player=player) | Q(game__black_player=player)
+        ).values_list("game__lichess_id", flat=True).distinct()
+    )
+    report = a1_report_for_games(gameids, engine="numpy", use_cache=True)
+    cr_report = CRReport.from_cr_report(report.by_player[player])
+    with transaction.atomic():
+        existing = (
+            CRReport.objects.select_for_update()
+            .filter(player=player, name=FULL_REPORT_NAME, criteria=None)
+            .first()
+        )
+        if existing:
+            cr_report.pk = existing.pk
+            cr_report.date_created = existing.date_created
+        cr_report.player = player
+        cr_report.name = FULL_REPORT_NAME
+        cr_report.is_completed = True
+        cr_report.save()
+    return cr_report
+
+
+def update_player_reports(batch_size=1000, full=False, progress=False):
+    """Recompute the full reports of players whose games' analysis changed.
+
+    Changed analyses are found through GameAnalysis.date_modified, resuming
+    from the checkpoint left by the previous run. The checkpoint advances
+    after each batch, so a crashed run picks up where it left off.
+    """
+    checkpoint, _ = JobCheckpoint.objects.get_or_create(name=PLAYER_REPORTS_CHECKPOINT)
+    if full:
+        checkpoint.reset()
+        checkpoint.save()
+
+    # Analyses saved after this point are left for the next run, which also
+    # means a player only needs to be recomputed once per run. It lags behind
+    # the clock so that analyses still being committed with an earlier
+    # date_modified aren't skipped over by the checkpoint.
+    run_started = timezone.now() - timedelta(
+        seconds=settings.PLAYER_REPORTS_SETTLE_SECONDS
+    )
+    updated_players = set()
+    if progress:
+        progress_bar = tqdm(desc="Updating player reports", leave=False)
+    while True:
+        batch = list(
+            checkpoint.after(GameAnalysis.objects.filter(date_modified__lte=run_started))
+            .order_by("date_modified", "pk")
+            .values_list(
+                "pk", "date_modified", "game__white_player", "game__black_player"
+            )[:batch_size]
+        )
+        if not batch:
+            break
+        player_ids = {
+            player_id
+            for _, _, white, black in batch
+            for player_id in (white, black)
+        } - updated_players
+        for player in Player.objects.filter(pk__in=player_ids):
+            update_player_report(player)
+        updated_players |= player_ids
+
+        checkpoint.last_pk, checkpoint.high_water = batch[-1][:2]
+        checkpoint.save()
+        if progress:
+            progress_bar.update(len(player_ids))
+    if progress:
+        progress_bar.close()
+        click.secho(f"✓ Updated {len(updated_players)} player reports", fg="green")
+    return updated_players
+
+
+def reclaim_stalled_games(progress=False):
+    """Requeue games whose fishnet client stopped renewing its lease."""
+    reclaimed = IrwinReportRequiredGame.reclaim_expired()
+    if progress:
+        click.secho(f"✓ Reclaimed {reclaimed} stalled games", fg="green")
+    return reclaimed
 
-def update_all_games_reports(progress=False):
-    qs = Player.objects.all()
+
+def enqueue_update_player_reports(full=False):
+    # Imported here so that only the enqueuer needs a redis connection.
+    from redis import Redis
+    from rq import Queue
+
+    queue = Queue(connection=Redis.from_url(settings.REDIS_URL))
+    return queue.enqueue(update_player_reports, full=full, job_timeout=-1)
+
+
+def pack_game_analyses(batch_size=500, drop_json=False, progress=False):
+    """Fill in GameAnalysis.analysis_packed for analyses that don't have it yet.
+
+    Walks the table in primary key order so it can be interrupted and re-run.
+    Analyses that can't be represented in the packed format are left as JSON.
+    Each batch is locked while it is packed, so analysis merged in by a
+    concurrent submission isn't overwritten. Analyses locked by one are
+    skipped, and packed by the next run.
+    """
+    qs = GameAnalysis.objects.filter(analysis_packed__isnull=True).order_by("pk")
+    if progress:
+        progress_bar = tqdm(total=qs.count(), desc="Packing analysis", leave=False)
+    last_pk = 0
+    packed = skipped = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                qs.filter(pk__gt=last_pk).select_for_update(skip_locked=True)[:batch_size]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            updated = []
+            for game_analysis in batch:
+                try:
+                    game_analysis.pack(drop_json=drop_json)
+                except UnpackableAnalysis:
+                    skipped += 1
+                    continue
+                updated.append(game_analysis)
+            GameAnalysis.objects.bulk_update(updated, ["analysis", "analysis_packed"])
+        packed += len(updated)
+        if progress:
+            progress_bar.update(len(batch))
+    if progress:
+        progress_bar.close()
+        click.secho(f"✓ Packed {packed} analyses", fg="green")
+        if skipped:
+            click.secho(f"✘ Left {skipped} analyses that can't be packed", fg="red")
+    return packed, skipped
+
+
+def index_game_positions_between(first_pk, last_pk, batch_size=1000):
+    """Index the positions of the games in a pk range that aren't indexed yet.
+
+    Returns the number of positions created.
+    """
+    games = (
+        Game.objects.filter(
+            pk__gte=first_pk,
+            pk__lte=last_pk,
+            moves__isnull=False,
+            positions_indexed=False,
+        )
+        .only("pk", "moves")
+        .order_by("pk")
+    )
+    created = 0
+    last_indexed = first_pk - 1
+    while True:
+        with transaction.atomic():
+            # Games locked by an import are indexed by that import.
+            batch = list(
+                games.filter(pk__gt=last_indexed).select_for_update(skip_locked=True)[
+                    :batch_size
+                ]
+            )
+            if not batch:
+                break
+            last_indexed = batch[-1].pk
+            created += GamePosition.index_games(batch)
+    return created
+
+
+def index_game_positions(workers=1, batch_size=1000, progress=False):
+    """Backfill GamePosition for the games that were imported without it.
+
+    The games are split into pk ranges that are indexed by a pool of
+    workers processes. Only games that aren't indexed yet are indexed, so
+    this can be interrupted and re-run. Returns the number of positions
+    created.
+    """
+    bounds = Game.objects.aggregate(first=Min("pk"), last=Max("pk"))
+    if bounds["first"] is None:
+        return 0
+    shard_size = max(
+        batch_size, math.ceil((bounds["last"] - bounds["first"] + 1) / (workers * 16))
+    )
+    shards = [
+        (first_pk, first_pk + shard_size - 1)
+        for first_pk in range(bounds["first"], bounds["last"] + 1, shard_size)
+    ]
+    if progress:
+        progress_bar = tqdm(total=len(shards), desc="Indexing positions", leave=False)
+    created = 0
+    if workers == 1:
+        for first_pk, last_pk in shards:
+            created += index_game_positions_between(first_pk, last_pk, batch_size)
+            if progress:
+                progress_bar.update()
+    else:
+        # Workers are forked so that they inherit the configured django, but
+        # they must not share the parent's database connections.
+        connections.close_all()
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context("fork")
+        ) as executor:
+            futures = [
+                executor.submit(index_game_positions_between, first_pk, last_pk, batch_size)
+                for first_pk, last_pk in shards
+            ]
+            for future in as_completed(futures):
+                created += future.result()
+                if progress:
+                    progress_bar.update()
     if progress:
-        qs = tqdm(qs)
-    for player in qs:
-        player.update_full_report()
+        progress_bar.close()
+        click.secho(f"✓ Indexed {created} positions", fg="green")
+    return created
@@ -0,0 +1,82 @@
+"""
+DataLoaders for the GraphQL API, so related objects of every row in a result
+are fetched with one query per relation instead of one query per row.
+"""
+from collections import defaultdict
+
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from . import models
+
+
+class PlayerLoader(DataLoader):
+    """Players by id, annotated with their total_games."""
+
+    def batch_load_fn(self, keys):  # pylint: disable=method-hidden
+        players = models.Player.annotate_total_games(
+            models.Player.objects.filter(pk__in=keys)
+        ).in_bulk()
+        return Promise.resolve([players.get(key) for key in keys])
+
+
+class TotalGamesLoader(DataLoader):
+    """The number of games of each player id."""
+
+    def batch_load_fn(self, keys):  # pylint: disable=method-hidden
+        totals = dict(
+            models.Player.annotate_total_games(models.Player.objects.filter(pk__in=keys))
+            .values_list("pk", "total_games")
+        )
+        return Promise.resolve([totals.get(key, 0) for key in keys])
+
+
+class RelatedLoader(DataLoader):
+    """The objects of model whose field points at each key, as lists."""
+
+    def __init__(self, model, field, **kwargs):
+        super().__init__(**kwargs)
+        self.model = model
+        self.field = field
+
+    def batch_load_fn(self, keys):  # pylint: disable=method-hidden
+        related = defaultdict(list)
+        for obj in self.model.objects.filter(**{f"{self.field}__in": keys}).order_by(
+            "pk"
+        ):
+            related[getattr(obj, f"{self.field}_id")].append(obj)
+        return Promise.resolve([related[key] for key in keys])
+
+
+class Loaders:
+    """The loaders of one request.
+
+    Loaders cache what they load, so they must not outlive the request.
+    """
+
+    def __init__(self):
+        self.player = PlayerLoader()
+        self.total_games = TotalGamesLoader()
+        self.games_as_white = RelatedLoader(models.Game, "white_player")
+        self.games_as_black = RelatedLoader(models.Game, "black_player")
+        self.crreport_set = RelatedLoader(models.CRReport, "player")
+
+
+def loaders(info):
+    """The Loaders of the request that info belongs to."""
+    context = info.context
+    if not hasattr(context, "loaders"):
+        context.loaders = Loaders()
+    return context.loaders
+
+
+def related(info, obj, name):
+    """The objects of obj's reverse relation name.
+
+    DjangoFilterPaginateListField prefetches some of the relations it sees
+    selected, those are used as they are. The others go through the loaders.
+    """
+    prefetched = getattr(obj, "_prefetched_objects_cache", {})
+    if name in prefetched:
+        return list(prefetched[name])
+    return getattr(loaders(info), name).load(obj.pk)
@@ -0,0 +1,57 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('analysis', '0010_auto_20191226_0256'),
+    ]
+
+    operations = [
+        migrations.RenameField(
+            model_name='crreport',
+            old_name='completed',
+            new_name='is_completed',
+        ),
+        migrations.RenameField(
+            model_name='irwinreport',
+            old_name='completed',
+            new_name='is_completed',
+        ),
+        migrations.RenameField(
+            model_name='irwinreportrequiredgame',
+            old_name='completed',
+            new_name='is_completed',
+        ),
+        migrations.RemoveField(
+            model_name='irwinreport',
+            name='origin',
+        ),
+        migrations.AddField(
+            model_name='irwinreportrequiredgame',
+            name='date_created',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='irwinreportrequiredgame',
+            name='date_modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.CreateModel(
+            name='IrwinReportOrigin',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(choices=[('MO', 'Moderator'), ('TO', 'Tournament')], default='MO', max_length=2)),
+                ('precedence', models.PositiveIntegerField()),
+                ('moderator', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+                ('report', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='analysis.IrwinReport')),
+            ],
+        ),
+    ]
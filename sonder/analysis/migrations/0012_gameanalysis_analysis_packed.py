@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 19:40
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0011_auto_20261018_1900'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameanalysis',
+            name='analysis_packed',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name='gameanalysis',
+            name='analysis',
+            field=django.contrib.postgres.fields.jsonb.JSONField(null=True),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:05
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0012_gameanalysis_analysis_packed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CRGameResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('color', models.CharField(choices=[('w', 'White'), ('b', 'Black')], max_length=1)),
+                ('config_hash', models.CharField(max_length=40)),
+                ('sample_size', models.PositiveIntegerField(default=0)),
+                ('sample_total_cpl', models.PositiveIntegerField(default=0)),
+                ('t1_total', models.PositiveIntegerField(default=0)),
+                ('t1_count', models.PositiveIntegerField(default=0)),
+                ('t2_total', models.PositiveIntegerField(default=0)),
+                ('t2_count', models.PositiveIntegerField(default=0)),
+                ('t3_total', models.PositiveIntegerField(default=0)),
+                ('t3_count', models.PositiveIntegerField(default=0)),
+                ('cp_loss_count', django.contrib.postgres.fields.jsonb.JSONField(default=dict)),
+                ('cp_loss_total', models.PositiveIntegerField(default=0)),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('game_analysis', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='analysis.GameAnalysis')),
+            ],
+            options={
+                'unique_together': {('game_analysis', 'color', 'config_hash')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0013_crgameresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameanalysis',
+            name='date_modified',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.CreateModel(
+            name='JobCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('high_water', models.DateTimeField(blank=True, null=True)),
+                ('last_pk', models.PositiveIntegerField(default=0)),
+                ('date_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
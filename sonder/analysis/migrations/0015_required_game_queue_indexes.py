@@ -0,0 +1,21 @@
+# Generated by Django 2.2.28 on 2026-10-18 22:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0014_gameanalysis_date_modified_jobcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='irwinreport',
+            index=models.Index(fields=['-precedence', 'date_modified'], name='irwinreport_queue_order'),
+        ),
+        migrations.AddIndex(
+            model_name='irwinreportrequiredgame',
+            index=models.Index(condition=models.Q(is_completed=False, owner__isnull=True), fields=['irwin_report', 'id'], name='irwinrequiredgame_unassigned'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 23:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0015_required_game_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='irwinreportrequiredgame',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
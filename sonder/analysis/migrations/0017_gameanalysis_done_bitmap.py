@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 23:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0016_irwinreportrequiredgame_lease_expires'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gameanalysis',
+            name='done_bitmap',
+            field=models.BinaryField(editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.28 on 2026-10-19 00:40
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0017_gameanalysis_done_bitmap'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PositionAnalysis',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zobrist', models.BigIntegerField()),
+                ('nodes', models.PositiveIntegerField(default=4500000)),
+                ('multipv', models.PositiveSmallIntegerField(default=5)),
+                ('analysis', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('date_created', models.DateTimeField(auto_now_add=True)),
+                ('source', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to='analysis.AnalysisSource')),
+            ],
+            options={
+                'unique_together': {('zobrist', 'nodes', 'multipv')},
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.28 on 2026-10-19 01:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0018_positionanalysis'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysissource',
+            name='observed_nps',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.RemoveIndex(
+            model_name='irwinreport',
+            name='irwinreport_queue_order',
+        ),
+        migrations.AddIndex(
+            model_name='irwinreport',
+            index=models.Index(fields=['-precedence', 'date_created'], name='irwinreport_queue_order'),
+        ),
+    ]
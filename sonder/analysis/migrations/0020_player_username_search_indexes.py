@@ -0,0 +1,43 @@
+from django.db import migrations
+
+
+def create_trigram_index(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        if cursor.fetchone() is None:
+            # Searches still work, they just scan the whole table.
+            return
+    schema_editor.execute(
+        'CREATE INDEX "player_username_upper_trgm" ON "analysis_player" '
+        'USING gin (UPPER("username") gin_trgm_ops)'
+    )
+
+
+def drop_trigram_index(apps, schema_editor):
+    schema_editor.execute('DROP INDEX IF EXISTS "player_username_upper_trgm"')
+
+
+class Migration(migrations.Migration):
+    """Index username for the icontains and iexact filters of the players list.
+
+    Django compares UPPER(username) for both lookups, so that's what is
+    indexed. Django 2.2 can't declare expression indexes, hence the SQL.
+
+    Creating extensions takes privileges the app's user usually lacks, so the
+    trigram index for icontains is only created if pg_trgm is already
+    installed in the database, see the README. Otherwise only the plain
+    index is, which serves iexact.
+    """
+
+    dependencies = [
+        ('analysis', '0019_job_scheduling'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+        migrations.RunSQL(
+            'CREATE INDEX "player_username_upper" ON "analysis_player" '
+            '(UPPER("username"))',
+            reverse_sql='DROP INDEX "player_username_upper"',
+        ),
+    ]
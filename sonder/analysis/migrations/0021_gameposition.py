@@ -0,0 +1,31 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """The positions of existing games are filled in by jobs index-positions."""
+
+    dependencies = [
+        ('analysis', '0020_player_username_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GamePosition',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ply', models.PositiveSmallIntegerField()),
+                ('zobrist', models.BigIntegerField()),
+                ('game', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='positions', to='analysis.Game')),
+            ],
+            options={
+                'unique_together': {('game', 'ply')},
+            },
+        ),
+        migrations.AddIndex(
+            model_name='gameposition',
+            index=models.Index(fields=['zobrist', 'game', 'ply'], name='gameposition_lookup'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 21:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0021_gameposition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='positions_indexed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunSQL(
+            'UPDATE "analysis_game" SET "positions_indexed" = true WHERE "id" IN '
+            '(SELECT DISTINCT "game_id" FROM "analysis_gameposition")',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.28 on 2026-10-18 20:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0022_game_positions_indexed'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='irwinreportrequiredgame',
+            name='irwinrequiredgame_unassigned',
+        ),
+        migrations.AddField(
+            model_name='analysissource',
+            name='slow',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='irwinreportrequiredgame',
+            name='cost',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        # Roughly costs the queued games, as the positions outside the opening.
+        # They're costed exactly when they go back in the queue.
+        migrations.RunSQL(
+            'UPDATE "analysis_irwinreportrequiredgame" AS "required" '
+            'SET "cost" = GREATEST(CASE WHEN jsonb_typeof("game"."moves") = \'array\' '
+            'THEN jsonb_array_length("game"."moves") + 1 - 10 ELSE 0 END, 0) '
+            'FROM "analysis_game" AS "game" '
+            'WHERE "required"."game_id" = "game"."id" AND NOT "required"."is_completed"',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddIndex(
+            model_name='irwinreportrequiredgame',
+            index=models.Index(condition=models.Q(('is_completed', False), ('owner__isnull', True)), fields=['irwin_report', 'cost', 'id'], name='irwinrequiredgame_cheapest'),
+        ),
+        migrations.AddIndex(
+            model_name='irwinreportrequiredgame',
+            index=models.Index(condition=models.Q(('is_completed', False), ('owner__isnull', True)), fields=['irwin_report', '-cost', 'id'], name='irwinrequiredgame_costliest'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+from django.db import migrations
+from django.utils import timezone
+
+CR_KEYS = ["played_eval", "played_rank", "masterdb_matches"]
+
+# Analyses with a ply that has the CR keys at the top level, where the first
+# CR importer put them.
+LEGACY_ANALYSIS = (
+    "jsonb_typeof(\"analysis_gameanalysis\".\"analysis\") = 'array' AND EXISTS ("
+    "SELECT 1 FROM jsonb_array_elements(\"analysis_gameanalysis\".\"analysis\") AS ply "
+    "WHERE jsonb_typeof(ply) = 'object' AND ply ?| array['played_eval', 'played_rank', "
+    "'masterdb_matches'])"
+)
+
+
+def nest_cr_keys(entry):
+    if not isinstance(entry, dict) or not any(key in entry for key in CR_KEYS):
+        return entry
+    cr = dict(entry.get("cr") or {})
+    for key in CR_KEYS:
+        if key in entry:
+            cr[key] = entry.pop(key)
+    entry["cr"] = cr
+    return entry
+
+
+def move_cr_keys(apps, schema_editor):
+    GameAnalysis = apps.get_model("analysis", "GameAnalysis")
+    legacy = GameAnalysis.objects.extra(where=[LEGACY_ANALYSIS]).only("analysis")
+    # Bumped so that the jobs that follow date_modified see the moved evals.
+    now = timezone.now()
+    batch = []
+    for game_analysis in legacy.iterator(chunk_size=1000):
+        game_analysis.analysis = [nest_cr_keys(entry) for entry in game_analysis.analysis]
+        game_analysis.date_modified = now
+        batch.append(game_analysis)
+        if len(batch) == 1000:
+            GameAnalysis.objects.bulk_update(batch, ["analysis", "date_modified"])
+            batch = []
+    GameAnalysis.objects.bulk_update(batch, ["analysis", "date_modified"])
+
+
+class Migration(migrations.Migration):
+    """Move the CR evals of analyses from the first CR importer under "cr".
+
+    That importer put played_eval, played_rank and masterdb_matches next to
+    the pvs of each ply, where neither the reports nor pack_analysis look.
+    """
+
+    dependencies = [
+        ('analysis', '0023_job_costs'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_cr_keys, migrations.RunPython.noop),
+    ]
@@ -1,17 +1,48 @@
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import List
+
 import chess.pgn
 
+from django.conf import settings
 from django.db import models, transaction
+from django.db.models.functions import Coalesce
+from django.db.models.signals import post_delete, post_save
 from django.contrib.postgres.fields import JSONField
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.contrib.auth.models import User
 
-from sonder.utils import pgn_to_uci, Choices
+from sonder.utils import (
+    batches,
+    pgn_to_uci,
+    zobrist_hashes,
+    Choices,
+    IngestVisitor,
+    TTLCache,
+)
+from .packed import PackedAnalysis, pack_analysis, unpack_analysis
 
 
 def create_api_token():
     return get_random_string(length=12)
 
 
+# Sources slower than this fraction of the fastest one get the short jobs.
+SLOW_SOURCE_RATIO = 0.5
+
+
+class JSONBArrayLength(models.Func):
+    """jsonb_array_length, but 0 for anything that isn't an array."""
+
+    template = (
+        "(CASE WHEN jsonb_typeof(%(expressions)s) = 'array'"
+        " THEN jsonb_array_length(%(expressions)s) ELSE 0 END)"
+    )
+    output_field = models.IntegerField()
+
+
 class AnalysisSource(models.Model):
     name = models.CharField(max_length=255, unique=True)
     secret_token = models.CharField(
@@ -20,6 +51,11 @@ class AnalysisSource(models.Model):
     use_for_irwin = models.BooleanField(default=False)
     use_for_mods = models.BooleanField(default=False)
     enabled = models.BooleanField(default=False)
+    # A moving average of the nodes per second reported by the source.
+    observed_nps = models.FloatField(null=True, blank=True)
+    # Whether observed_nps is much lower than the fastest irwin source's, as
+    # of the source's last record_nps.
+    slow = models.BooleanField(default=False, editable=False)
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
@@ -27,6 +63,53 @@ class AnalysisSource(models.Model):
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_token(cls, secret_token):
+        """The source with secret_token, or None, cached for a while.
+
+        Every fishnet request authenticates with its api key, so lookups are
+        served from an in-process cache. Unknown keys aren't cached, so
+        a source is found as soon as it is created.
+        """
+        return _sources_by_token.get_or_set(
+            secret_token, lambda: cls.objects.filter(secret_token=secret_token).first()
+        )
+
+    def record_nps(self, nps, weight=0.2):
+        """Fold nps into observed_nps, and work out whether the source is slow."""
+        if self.observed_nps is None:
+            self.observed_nps = nps
+        else:
+            self.observed_nps += weight * (nps - self.observed_nps)
+        fastest = (
+            AnalysisSource.objects.filter(use_for_irwin=True)
+            .exclude(pk=self.pk)
+            .aggregate(nps=models.Max("observed_nps"))["nps"]
+        )
+        self.slow = self.observed_nps < SLOW_SOURCE_RATIO * (fastest or 0)
+        AnalysisSource.objects.filter(pk=self.pk).update(
+            observed_nps=self.observed_nps, slow=self.slow
+        )
+
+    def is_slow(self):
+        """Whether the source is much slower than the fastest irwin source.
+
+        Sources report their speed with every submission, so this is only
+        worked out then, see record_nps.
+        """
+        return self.slow
+
+
+_sources_by_token = TTLCache(settings.ANALYSIS_SOURCE_CACHE_SECONDS)
+
+
+def clear_source_cache(**kwargs):
+    _sources_by_token.clear()
+
+
+post_save.connect(clear_source_cache, sender=AnalysisSource)
+post_delete.connect(clear_source_cache, sender=AnalysisSource)
+
 
 class Tag(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -44,6 +127,24 @@ class Player(models.Model):
     def __str__(self):
         return self.username
 
+    @staticmethod
+    def annotate_total_games(queryset):
+        """Annotate total_games, the number of games played as either colour."""
+
+        def count_games(field):
+            games = (
+                Game.objects.filter(**{field: models.OuterRef("pk")})
+                .order_by()
+                .values(field)
+                .annotate(count=models.Count("pk"))
+                .values("count")
+            )
+            return Coalesce(models.Subquery(games), 0)
+
+        return queryset.annotate(
+            total_games=count_games("white_player") + count_games("black_player")
+        )
+
 
 class Game(models.Model):
     lichess_id = models.CharField(max_length=32, unique=True)
@@ -69,9 +170,104 @@ class Game(models.Model):
     # played this move
     moves_masterdb_matches = JSONField(null=True)
 
-    def set_pgn(self, pgn):
+    # Whether GamePosition holds the positions of moves, which it may not
+    # for games imported before it existed. Games whose moves are illegal
+    # are indexed without any positions.
+    positions_indexed = models.BooleanField(default=False)
+
+    def position_hashes(self):
+        """The zobrist hash of every position, or [] if moves are illegal."""
+        try:
+            return zobrist_hashes(self.moves or [])
+        except ValueError:
+            return []
+
+    def set_pgn(self, pgn, moves=None):
+        """Set the PGN, and the moves unless the caller already has them."""
         self.source_pgn = pgn
-        self.moves = pgn_to_uci(self.source_pgn)
+        self.moves = moves if moves is not None else pgn_to_uci(self.source_pgn)
+
+
+# Rows written per INSERT when indexing positions.
+POSITION_INDEX_BATCH_SIZE = 5000
+
+
+class GamePosition(models.Model):
+    """A position reached in a game, by its zobrist hash.
+
+    Lets games be found by the positions they reached without replaying
+    their moves, see games_reaching. Ply 0 is the initial position, like in
+    Game.position_hashes.
+    """
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, related_name="positions")
+    ply = models.PositiveSmallIntegerField()
+    zobrist = models.BigIntegerField()
+
+    class Meta:
+        unique_together = [["game", "ply"]]
+        indexes = [
+            # Covers games_reaching, so a lookup never touches the table.
+            models.Index(fields=["zobrist", "game", "ply"], name="gameposition_lookup")
+        ]
+
+    @classmethod
+    def positions_of(cls, games):
+        """Yield the unsaved GamePositions of games."""
+        for game in games:
+            for ply, zobrist in enumerate(game.position_hashes()):
+                yield cls(game_id=game.pk, ply=ply, zobrist=zobrist)
+
+    @classmethod
+    def index_games(cls, games):
+        """Replace the positions of saved games with those of their moves.
+
+        Returns the number of positions created.
+        """
+        games = list(games)
+        if not games:
+            return 0
+        with transaction.atomic():
+            # Updating the flag first locks the games, so that concurrent
+            # indexing of the same game waits instead of conflicting.
+            Game.objects.filter(pk__in=[game.pk for game in games]).update(
+                positions_indexed=True
+            )
+            created = cls.replace_positions(games)
+        for game in games:
+            game.positions_indexed = True
+        return created
+
+    @classmethod
+    def replace_positions(cls, games):
+        """Like index_games, for games already locked and flagged as indexed."""
+        positions = list(cls.positions_of(games))
+        cls.objects.filter(game__in=[game.pk for game in games]).delete()
+        cls.objects.bulk_create(positions, batch_size=POSITION_INDEX_BATCH_SIZE)
+        return len(positions)
+
+    @classmethod
+    def hashes_by_game(cls, games):
+        """Map the ids of games to the zobrist hash of each of their positions.
+
+        Like Game.position_hashes, but read from the index. Games that aren't
+        indexed yet are indexed first, so they are only replayed once.
+        """
+        cls.index_games([game for game in games if not game.positions_indexed])
+        hashes = {game.pk: [] for game in games}
+        for game_id, zobrist in (
+            cls.objects.filter(game__in=list(hashes))
+            .order_by("game", "ply")
+            .values_list("game", "zobrist")
+        ):
+            hashes[game_id].append(zobrist)
+        return hashes
+
+    @classmethod
+    def games_reaching(cls, zobrist):
+        """The games that reached the position with hash zobrist."""
+        return Game.objects.filter(
+            pk__in=cls.objects.filter(zobrist=zobrist).values("game")
+        )
 
 
 class GameTag(models.Model):
@@ -81,6 +277,14 @@ class GameTag(models.Model):
 
 colors = (("w", "White"), ("b", "Black"))
 
+# Positions that fishnet is told not to analyse in every job.
+OPENING_SKIP_POSITIONS = range(10)
+
+# TODO: Where does this value come from?
+ANALYSIS_NODES = 4500000
+# TODO: is this configurable?
+ANALYSIS_MULTIPV = 5
+
 
 class GameAnalysis(models.Model):
     game = models.ForeignKey(Game, on_delete=models.CASCADE)
@@ -115,32 +319,127 @@ class GameAnalysis(models.Model):
     #     "mate": None # number of moves until mate
     #   },
     # },
-    analysis = JSONField()
+    # analysis may be None once it has been moved to analysis_packed.
+    analysis = JSONField(null=True)
+
+    # Optional compact encoding of analysis, see sonder.analysis.packed.
+    # When set it takes precedence over analysis.
+    analysis_packed = models.BinaryField(null=True, editable=False)
+
+    # Bit i (of byte i // 8) is set once position i has a usable result, so
+    # completeness can be kept up to date without rescanning every ply.
+    done_bitmap = models.BinaryField(null=True, editable=False)
+
+    # Note that bulk_update doesn't touch auto_now fields, so bulk writers
+    # must set this themselves.
+    date_modified = models.DateTimeField(auto_now=True, db_index=True)
 
     class Meta:
         index_together = [["game", "source"]]
 
-    def update_complete(self, required_game):
-        job = required_game.job()
-        self.is_completed = all(
-            [
-                (
-                    (
-                        # this is a skipped position
-                        i in job["skipPositions"]
-                        and m is not None
-                        and m["skipped"]
-                    )
-                    or (
-                        # we have analysis for it
-                        m is not None
-                        and m.get("score", None) is not None
-                    )
-                )
-                for i, m in enumerate(self.analysis)
-            ]
+    def set_analysis(self, analysis):
+        self.analysis = analysis
+        self.analysis_packed = None
+        self.done_bitmap = None
+
+    def get_analysis(self):
+        if self.analysis_packed is not None:
+            return unpack_analysis(self.analysis_packed)
+        return self.analysis
+
+    def analysis_view(self):
+        """The analysis in whichever form is cheapest to read.
+
+        Either the JSON list or a PackedAnalysis; sonder.cr and
+        sonder.analysis.packed.iter_pv_cps accept both.
+        """
+        if self.analysis_packed is not None:
+            return PackedAnalysis(self.analysis_packed)
+        return self.analysis
+
+    def pack(self, drop_json=False):
+        self.analysis_packed = pack_analysis(self.get_analysis())
+        if drop_json:
+            self.analysis = None
+
+    @classmethod
+    def done_plies_by_game(cls, games, source):
+        """Map the ids of games to the plies source has already analysed."""
+        return {
+            game_analysis.game_id: game_analysis.done_plies()
+            for game_analysis in cls.objects.filter(game__in=games, source=source)
+        }
+
+    @staticmethod
+    def position_done(ply, position, skip_positions=OPENING_SKIP_POSITIONS):
+        return position is not None and (
+            # we have analysis for it
+            position.get("score", None) is not None
+            # this is a skipped position
+            or (ply in skip_positions and position.get("skipped", False))
         )
 
+    def done_plies(self):
+        """The plies of the positions that don't need analysing anymore."""
+        bitmap = self.get_done_bitmap()
+        return [
+            ply
+            for ply in range(len(bitmap) * 8)
+            if bitmap[ply // 8] & (1 << (ply % 8))
+        ]
+
+    def get_done_bitmap(self):
+        if self.done_bitmap is not None:
+            return bytearray(self.done_bitmap)
+        # Analysis stored before the bitmap existed.
+        bitmap = bytearray()
+        for ply, position in enumerate(self.get_analysis() or []):
+            if self.position_done(ply, position):
+                set_bit(bitmap, ply)
+        return bitmap
+
+    def merge_analysis(self, analysis):
+        """Merge a (partial) fishnet submission into the analysis ply by ply.
+
+        Positions that the submission has no result for keep the result we
+        already have, so a client that was told to skip done positions can't
+        wipe them out. Returns whether the analysis changed.
+        """
+        current = list(self.get_analysis() or [])
+        bitmap = self.get_done_bitmap()
+        changed = len(current) < len(analysis)
+        current.extend([None] * (len(analysis) - len(current)))
+        for ply, position in enumerate(analysis):
+            if position is None or position == current[ply]:
+                continue
+            if current[ply] is not None and position.get("score", None) is None:
+                continue
+            current[ply] = position
+            changed = True
+            if self.position_done(ply, position):
+                set_bit(bitmap, ply)
+
+        if changed:
+            self.set_analysis(current)
+        self.done_bitmap = bytes(bitmap)
+        self.is_completed = bool(current) and all_bits_set(bitmap, len(current))
+        return changed
+
+
+def set_bit(bitmap, i):
+    if len(bitmap) <= i // 8:
+        bitmap.extend(bytes(i // 8 + 1 - len(bitmap)))
+    bitmap[i // 8] |= 1 << (i % 8)
+
+
+def all_bits_set(bitmap, count):
+    full, rest = divmod(count, 8)
+    if len(bitmap) < full + (rest > 0):
+        return False
+    if any(byte != 0xFF for byte in bitmap[:full]):
+        return False
+    return rest == 0 or bitmap[full] & ((1 << rest) - 1) == (1 << rest) - 1
+
 
 class IrwinReport(models.Model):
     player = models.ForeignKey(Player, null=True, on_delete=models.SET_NULL,)
@@ -151,6 +450,14 @@ class IrwinReport(models.Model):
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["-precedence", "date_created"],
+                name="irwinreport_queue_order",
+            )
+        ]
+
 
 class IrwinReportOrigin(models.Model):
     report = models.ForeignKey(IrwinReport, on_delete=models.CASCADE)
@@ -167,43 +474,241 @@ class IrwinReportRequiredGame(models.Model):
     game = models.ForeignKey(Game, null=True, on_delete=models.SET_NULL)
     is_completed = models.BooleanField()
     owner = models.ForeignKey(AnalysisSource, null=True, on_delete=models.SET_NULL)
+    # The owner loses the game if it doesn't report progress before this.
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    # The number of positions left to analyse when the game was queued, see
+    # update_costs. Rows created without enqueue count as the cheapest.
+    cost = models.PositiveIntegerField(default=0)
 
     date_created = models.DateTimeField(auto_now_add=True)
     date_modified = models.DateTimeField(auto_now=True)
 
-    def job(self):
+    class Meta:
+        # Only the unassigned games are ever searched for work, in the orders
+        # of assign_games.
+        indexes = [
+            models.Index(
+                fields=["irwin_report", "cost", "id"],
+                name="irwinrequiredgame_cheapest",
+                condition=models.Q(owner__isnull=True, is_completed=False),
+            ),
+            models.Index(
+                fields=["irwin_report", "-cost", "id"],
+                name="irwinrequiredgame_costliest",
+                condition=models.Q(owner__isnull=True, is_completed=False),
+            ),
+        ]
+
+    def job(self, done_plies=()):
+        """The fishnet job, skipping the opening and any done_plies."""
         return {
             "work": {"type": "analysis", "id": f"irwin-{self.id}",},
             "game_id": f"{self.game.lichess_id}",
             # TODO: pull this from the game type?
             "position": "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
             "variant": "standard",
-            "skipPositions": list(range(10)),
+            "skipPositions": sorted(set(OPENING_SKIP_POSITIONS).union(done_plies)),
             "moves": " ".join(self.game.moves),
-            # TODO: Where does this value come from?
-            "nodes": 4500000,
-            # TODO: is this configurable?
-            "multipv": 5,
+            "nodes": ANALYSIS_NODES,
+            "multipv": ANALYSIS_MULTIPV,
         }
 
 
     @classmethod
     def assign_game(cls, source):
+        games = cls.assign_games(source, 1)
+        return games[0] if games else None
+
+    @classmethod
+    def enqueue(cls, irwin_report, games):
+        """Create the required games of irwin_report, with their costs."""
+        required_games = [
+            cls(irwin_report=irwin_report, game=game, is_completed=False)
+            for game in games
+        ]
+        cls.update_costs(required_games)
+        return cls.objects.bulk_create(required_games)
+
+    @classmethod
+    def update_costs(cls, required_games, source=None):
+        """Set the cost of each of required_games, without saving them.
+
+        Every job searches ANALYSIS_NODES per position, so the cost is the
+        number of positions to analyse: those outside the opening that
+        aren't in the PositionAnalysis cache, nor already done by source.
+        """
+        games = [rg.game for rg in required_games if rg.game is not None]
+        cached_plies = PositionAnalysis.cached_plies_by_game(games)
+        done_plies = (
+            GameAnalysis.done_plies_by_game(games, source) if source else {}
+        )
+        for required_game in required_games:
+            moves = required_game.game.moves if required_game.game else None
+            skipped = set(OPENING_SKIP_POSITIONS).union(
+                cached_plies.get(required_game.game_id, ()),
+                done_plies.get(required_game.game_id, ()),
+            )
+            required_game.cost = sum(
+                1 for ply in range(len(moves or ()) + 1) if ply not in skipped
+            )
+
+    @classmethod
+    def queue(cls):
+        """The games waiting to be analysed.
+
+        Games without moves have nothing to analyse and are left out.
+        """
+        return (
+            cls.objects.filter(owner__isnull=True, is_completed=False)
+            .annotate(plies=JSONBArrayLength("game__moves"))
+            .filter(plies__gt=0)
+        )
+
+    @classmethod
+    def assign_games(cls, source, count):
+        """Claim the next count unassigned games for source.
+
+        Reports are worked through one at a time, by precedence and then
+        age, so that each finishes as early as possible. Within a report,
+        fast sources take the costliest games first and slow sources the
+        cheapest, which keeps slow sources from holding up the end of a
+        report with a long game.
+
+        Games locked by a concurrent claim are skipped instead of waited on,
+        so simultaneous clients each get different games from one query.
+        """
+        cost_order = "cost" if source.is_slow() else "-cost"
         with transaction.atomic():
-            games = (
-                cls.objects.filter(owner__isnull=True, is_completed=False)
-                .exclude(game__moves="")
-                .order_by("-irwin_report__precedence", "irwin_report__date_modified", "pk")
+            games = list(
+                cls.queue()
+                .select_related("game")
+                .select_for_update(skip_locked=True, of=("self",))
+                .order_by(
+                    "-irwin_report__precedence",
+                    "irwin_report__date_created",
+                    "irwin_report_id",
+                    cost_order,
+                    "pk",
+                )[:count]
             )
-            try:
-                game = games[0]
-                game = cls.objects.select_for_update().get(pk=game.pk)
+            if not games:
+                return games
+            lease_expires = cls.lease_expiry()
+            for game in games:
                 game.owner = source
-                game.save()
-                return game
-            except IndexError:
-                pass
-        return None
+                game.lease_expires = lease_expires
+            cls.objects.filter(pk__in=[game.pk for game in games]).update(
+                owner=source, lease_expires=lease_expires, date_modified=timezone.now()
+            )
+            return games
+
+    @staticmethod
+    def lease_expiry():
+        return timezone.now() + timedelta(seconds=settings.ANALYSIS_LEASE_SECONDS)
+
+    def renew_lease(self, save=True):
+        self.lease_expires = self.lease_expiry()
+        if save:
+            self.save(update_fields=["lease_expires", "date_modified"])
+
+    def release(self):
+        self.owner = None
+        self.lease_expires = None
+
+    @classmethod
+    def requeue(cls, required_games):
+        """Put games back in the queue, costed by what their owner left to do."""
+        by_owner = defaultdict(list)
+        for required_game in required_games:
+            by_owner[required_game.owner].append(required_game)
+        now = timezone.now()
+        for owner, owned in by_owner.items():
+            cls.update_costs(owned, owner)
+            for required_game in owned:
+                required_game.release()
+                required_game.date_modified = now
+        cls.objects.bulk_update(
+            required_games, ["owner", "lease_expires", "cost", "date_modified"]
+        )
+
+    @classmethod
+    def reclaim_expired(cls):
+        """Put games whose owner's lease ran out back in the queue.
+
+        Games assigned before leases existed have no expiry and are
+        reclaimed as well. Returns the number of reclaimed games.
+        """
+        with transaction.atomic():
+            expired = list(
+                cls.objects.filter(owner__isnull=False, is_completed=False)
+                .filter(
+                    models.Q(lease_expires__lt=timezone.now())
+                    | models.Q(lease_expires__isnull=True)
+                )
+                .select_related("game", "owner")
+                .select_for_update(of=("self",))
+            )
+            cls.requeue(expired)
+        return len(expired)
+
+
+class PositionAnalysis(models.Model):
+    """The engine analysis of a single position, shared between games.
+
+    Positions are identified by their zobrist hash (see
+    sonder.utils.zobrist_hashes) together with the search parameters, and
+    analysis holds a fishnet position result.
+    """
+    zobrist = models.BigIntegerField()
+    nodes = models.PositiveIntegerField(default=ANALYSIS_NODES)
+    multipv = models.PositiveSmallIntegerField(default=ANALYSIS_MULTIPV)
+    analysis = JSONField()
+    source = models.ForeignKey(AnalysisSource, null=True, on_delete=models.SET_NULL)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [["zobrist", "nodes", "multipv"]]
+
+    @classmethod
+    def lookup(cls, hashes, nodes=ANALYSIS_NODES, multipv=ANALYSIS_MULTIPV):
+        """Map those of hashes that have been analysed to their analysis."""
+        return dict(
+            cls.objects.filter(
+                zobrist__in=set(hashes), nodes=nodes, multipv=multipv
+            ).values_list("zobrist", "analysis")
+        )
+
+    @classmethod
+    def store(cls, analyses, source, nodes=ANALYSIS_NODES, multipv=ANALYSIS_MULTIPV):
+        """Add {zobrist: analysis} to the cache, keeping existing entries."""
+        cls.objects.bulk_create(
+            [
+                cls(
+                    zobrist=zobrist,
+                    nodes=nodes,
+                    multipv=multipv,
+                    analysis=analysis,
+                    source=source,
+                )
+                for zobrist, analysis in analyses.items()
+            ],
+            ignore_conflicts=True,
+        )
+
+    @classmethod
+    def cached_plies_by_game(cls, games):
+        """Map the ids of games to the plies whose position is cached."""
+        hashes = GamePosition.hashes_by_game(games)
+        cached = cls.lookup(h for game_hashes in hashes.values() for h in game_hashes)
+        return {
+            game_id: [
+                ply
+                for ply, h in enumerate(game_hashes)
+                if h in cached and ply not in OPENING_SKIP_POSITIONS
+            ]
+            for game_id, game_hashes in hashes.items()
+        }
 
 
 class Criteria(models.Model):
@@ -264,47 +769,258 @@ class CRReport(models.Model):
         return cls(**update_dict)
 
 
+class CRGameResult(models.Model):
+    """The A1 result for one side of an analysed game.
+
+    Rows are computed for a particular CR config and engine, identified by
+    config_hash, and are replaced whenever the analysis they were computed
+    from changes.
+    """
+    game_analysis = models.ForeignKey(GameAnalysis, on_delete=models.CASCADE)
+    color = models.CharField(max_length=1, choices=colors)
+    config_hash = models.CharField(max_length=40)
+
+    sample_size = models.PositiveIntegerField(default=0)
+    sample_total_cpl = models.PositiveIntegerField(default=0)
+
+    t1_total = models.PositiveIntegerField(default=0)
+    t1_count = models.PositiveIntegerField(default=0)
+    t2_total = models.PositiveIntegerField(default=0)
+    t2_count = models.PositiveIntegerField(default=0)
+    t3_total = models.PositiveIntegerField(default=0)
+    t3_count = models.PositiveIntegerField(default=0)
+
+    cp_loss_count = JSONField(default=dict)
+    cp_loss_total = models.PositiveIntegerField(default=0)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [["game_analysis", "color", "config_hash"]]
+
+    copy_attrs = [
+        "sample_size",
+        "sample_total_cpl",
+        "t1_total",
+        "t1_count",
+        "t2_total",
+        "t2_count",
+        "t3_total",
+        "t3_count",
+        "cp_loss_total",
+    ]
+
+    @classmethod
+    def from_result(cls, game_analysis_id, color, config_hash, result):
+        update_dict = {attr: getattr(result, attr) for attr in cls.copy_attrs}
+        update_dict["cp_loss_count"] = dict(result.cp_loss_count)
+        return cls(
+            game_analysis_id=game_analysis_id,
+            color=color,
+            config_hash=config_hash,
+            **update_dict,
+        )
+
+
+class JobCheckpoint(models.Model):
+    """How far a resumable background job has gotten through a table.
+
+    Rows are processed in (date_modified, pk) order and the checkpoint is the
+    last row that was fully processed.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    high_water = models.DateTimeField(null=True, blank=True)
+    last_pk = models.PositiveIntegerField(default=0)
+
+    date_modified = models.DateTimeField(auto_now=True)
+
+    def reset(self):
+        self.high_water = None
+        self.last_pk = 0
+
+    def after(self, qs):
+        """Filter qs down to the rows past this checkpoint."""
+        if self.high_water is None:
+            return qs
+        return qs.filter(
+            models.Q(date_modified__gt=self.high_water)
+            | models.Q(date_modified=self.high_water, pk__gt=self.last_pk)
+        )
+
+
 class GamePlayerConflict(AssertionError):
     pass
 
 
-def import_pgn_file_to_db(pgn_file, encoding="ISO-8859-1"):
-    pgn_in = open(pgn_file, encoding=encoding)
-    return import_pgn_to_db(pgn_in)
+def import_pgn_file_to_db(pgn_file, encoding="ISO-8859-1", batch_size=1000):
+    with open(pgn_file, encoding=encoding) as pgn_in:
+        return import_pgn_to_db(pgn_in, batch_size=batch_size)
+
+
+def read_pgn_games(pgn_in, invalid=None):
+    """Yield a ParsedGame for each game in pgn_in, see IngestVisitor.
 
+    Games that don't parse cleanly, like those with illegal moves or in
+    unsupported variants, are logged and skipped. If invalid is a list, the
+    headers and errors of each skipped game are appended to it.
+    """
+    while True:
+        visitor = IngestVisitor()
+        parsed = chess.pgn.read_game(pgn_in, Visitor=lambda: visitor)
+        if parsed is None:
+            return
+        if visitor.errors:
+            if invalid is not None:
+                invalid.append((visitor.game_headers, visitor.errors))
+            continue
+        yield ParsedGame.from_headers(*parsed)
 
-def import_pgn_to_db(pgn_in):
+
+def import_pgn_to_db(pgn_in, batch_size=1000):
     games = []
-    game = chess.pgn.read_game(pgn_in)
-    while game:
-        games.append(insert_game_into_db(game))
-        game = chess.pgn.read_game(pgn_in)
+    for batch in batches(read_pgn_games(pgn_in), batch_size):
+        games.extend(insert_games_into_db(batch))
     return games
 
 
-def insert_game_into_db(game):
-    white_username = Player.normalize_username(game.headers["White"])
-    black_username = Player.normalize_username(game.headers["Black"])
-    w, _ = Player.objects.get_or_create(username=white_username)
-    b, _ = Player.objects.get_or_create(username=black_username)
-    exporter = chess.pgn.StringExporter(headers=True, variations=False, comments=False)
-    pgn_text = game.accept(exporter)
-    lichess_id = game.headers["Site"][-8:]
-    try:
-        g = Game.objects.get(lichess_id=lichess_id)
-        if g.white_player and g.white_player != w:
-            raise GamePlayerConflict(
-                f"PGN expects game to have {w} as white, but db has {g.white_player} as white."
-            )
-        if g.black_player and g.black_player != b:
-            raise GamePlayerConflict(
-                f"PGN expects game to have {b} as black, but db has {g.black_player} as black."
+@dataclass
+class ParsedGame:
+    lichess_id: str
+    white_username: str
+    black_username: str
+    time_control: str
+    pgn: str
+    moves: List[str]
+
+    @classmethod
+    def from_headers(cls, headers, pgn, moves):
+        return cls(
+            lichess_id=headers["Site"][-8:],
+            white_username=Player.normalize_username(headers["White"]),
+            black_username=Player.normalize_username(headers["Black"]),
+            time_control=headers["TimeControl"],
+            pgn=pgn,
+            moves=moves,
+        )
+
+    @classmethod
+    def from_pgn_game(cls, game):
+        exporter = chess.pgn.StringExporter(
+            headers=True, variations=False, comments=False
+        )
+        return cls.from_headers(
+            game.headers,
+            game.accept(exporter),
+            [move.uci() for move in game.mainline_moves()],
+        )
+
+
+def get_or_create_players(usernames):
+    """Map each username to its Player, creating the missing ones in bulk."""
+    usernames = set(usernames)
+    players = Player.objects.in_bulk(usernames, field_name="username")
+    missing = usernames - players.keys()
+    if missing:
+        Player.objects.bulk_create(
+            [Player(username=username) for username in missing],
+            ignore_conflicts=True,
+        )
+        # Players created with ignore_conflicts don't get their pk set.
+        players.update(Player.objects.in_bulk(missing, field_name="username"))
+    return players
+
+
+def insert_games_into_db(pgn_games, tags_by_lichess_id=None):
+    """Upsert a batch of ParsedGames or chess.pgn games in a single transaction.
+
+    Each game is only parsed once, and players, games, tags and the
+    positions of new or changed games are loaded and written with a handful
+    of queries for the whole batch. Returns the
+    Game of each of pgn_games, in order.
+    """
+    parsed = [
+        game if isinstance(game, ParsedGame) else ParsedGame.from_pgn_game(game)
+        for game in pgn_games
+    ]
+    with transaction.atomic():
+        players = get_or_create_players(
+            username
+            for game in parsed
+            for username in (game.white_username, game.black_username)
+        )
+        existing = Game.objects.in_bulk(
+            {game.lichess_id for game in parsed}, field_name="lichess_id"
+        )
+        games = {}
+        # Games whose positions need (re)indexing.
+        reindex = set()
+        for game in parsed:
+            w = players[game.white_username]
+            b = players[game.black_username]
+            g = games.get(game.lichess_id) or existing.get(game.lichess_id)
+            if g is None:
+                g = Game(lichess_id=game.lichess_id)
+            elif g.pk is not None:
+                if g.white_player_id and g.white_player_id != w.pk:
+                    raise GamePlayerConflict(
+                        f"PGN expects game to have {w} as white, but db has {g.white_player} as white."
+                    )
+                if g.black_player_id and g.black_player_id != b.pk:
+                    raise GamePlayerConflict(
+                        f"PGN expects game to have {b} as black, but db has {g.black_player} as black."
+                    )
+            if g.pk is None or g.moves != game.moves or not g.positions_indexed:
+                reindex.add(game.lichess_id)
+                g.positions_indexed = True
+            g.white_player = w
+            g.black_player = b
+            g.time_control = game.time_control
+            g.set_pgn(game.pgn, game.moves)
+            games[game.lichess_id] = g
+
+        to_update = [g for g in games.values() if g.pk is not None]
+        to_create = [g for g in games.values() if g.pk is None]
+        Game.objects.bulk_update(
+            to_update,
+            [
+                "white_player",
+                "black_player",
+                "time_control",
+                "source_pgn",
+                "moves",
+                "positions_indexed",
+            ],
+        )
+        Game.objects.bulk_create(to_create)
+        GamePosition.replace_positions([games[lichess_id] for lichess_id in reindex])
+
+        if tags_by_lichess_id:
+            tag_games(
+                (games[lichess_id], tag)
+                for lichess_id in games
+                for tag in tags_by_lichess_id.get(lichess_id, [])
             )
-    except Game.DoesNotExist:
-        g = Game(lichess_id=lichess_id)
-    g.white_player = w
-    g.black_player = b
-    g.time_control = game.headers["TimeControl"]
-    g.set_pgn(pgn_text)
-    g.save()
-    return g
+    return [games[game.lichess_id] for game in parsed]
+
+
+def insert_game_into_db(game):
+    return insert_games_into_db([game])[0]
+
+
+def tag_games(game_tags):
+    """Create the GameTags for (game, tag) pairs that aren't tagged already."""
+    game_tags = {(game.pk, tag.pk) for game, tag in game_tags}
+    if not game_tags:
+        return
+    existing = set(
+        GameTag.objects.filter(
+            game_id__in={game_id for game_id, _ in game_tags},
+            tag_id__in={tag_id for _, tag_id in game_tags},
+        ).values_list("game_id", "tag_id")
+    )
+    GameTag.objects.bulk_create(
+        [
+            GameTag(game_id=game_id, tag_id=tag_id)
+            for game_id, tag_id in sorted(game_tags - existing)
+        ]
+    )
@@ -0,0 +1,431 @@
+"""
+A compact, column oriented binary encoding of GameAnalysis.analysis.
+
+The JSON representation repeats every key for every pv of every ply. Here each
+value is stored once in a typed column instead, and PVs are stored as 16 bit
+move indexes rather than UCI strings. Missing keys are tracked with per-ply and
+per-pv bitmasks so that the JSON can be rebuilt from the blob.
+
+Layout (little endian):
+    header: magic, version, number of plies, number of pvs, number of pv moves
+    a byte per column: COLUMN_FULL or COLUMN_CONSTANT
+    followed by each column in _ply_columns, _pv_columns and then pv_moves.
+    A constant column (e.g. mate for CR imports, which is always None) is
+    stored as a single value.
+"""
+import struct
+import sys
+from array import array
+from itertools import accumulate
+
+MAGIC = b"SNDR"
+VERSION = 1
+_header = struct.Struct("<4sBIII")
+
+# Sentinels used for keys that are present but None.
+NULL32 = -(2 ** 31)
+NULL64 = -(2 ** 63)
+
+# Per ply key bits
+PLY_NONE = 1 << 0  # the entry itself is None
+PLY_MOVE = 1 << 1
+PLY_PVS = 1 << 2
+PLY_CR = 1 << 3
+PLY_TIME = 1 << 4
+PLY_NODES = 1 << 5
+PLY_NPS = 1 << 6
+PLY_SKIPPED = 1 << 7
+PLY_FLAT = 1 << 8  # a fishnet style entry with the pv fields on the ply itself
+
+# Per ply "cr" key bits
+CR_PLAYED_EVAL = 1 << 0
+CR_PLAYED_RANK = 1 << 1
+CR_MASTERDB_MATCHES = 1 << 2
+
+# Per pv key bits
+PV_PV = 1 << 0
+PV_SCORE = 1 << 1
+PV_CP = 1 << 2
+PV_MATE = 1 << 3
+PV_DEPTH = 1 << 4
+PV_SELDEPTH = 1 << 5
+PV_TBHITS = 1 << 6
+
+_ply_columns = [
+    ("move", "i"),
+    ("keys", "H"),
+    ("cr_keys", "B"),
+    ("played_eval", "i"),
+    ("played_rank", "i"),
+    ("masterdb_matches", "i"),
+    ("time", "q"),
+    ("nodes", "q"),
+    ("nps", "q"),
+    ("skipped", "B"),
+    ("npvs", "B"),
+]
+_pv_columns = [
+    ("keys", "B"),
+    ("cp", "i"),
+    ("mate", "i"),
+    ("depth", "i"),
+    ("seldepth", "i"),
+    ("tbhits", "q"),
+    ("length", "H"),
+]
+
+_ply_int_keys = [
+    ("time", PLY_TIME, NULL64),
+    ("nodes", PLY_NODES, NULL64),
+    ("nps", PLY_NPS, NULL64),
+]
+_cr_int_keys = [
+    ("played_eval", CR_PLAYED_EVAL, NULL32),
+    ("played_rank", CR_PLAYED_RANK, NULL32),
+    ("masterdb_matches", CR_MASTERDB_MATCHES, NULL32),
+]
+_pv_int_keys = [
+    ("depth", PV_DEPTH, NULL32),
+    ("seldepth", PV_SELDEPTH, NULL32),
+    ("tbhits", PV_TBHITS, NULL64),
+]
+_flat_keys = {"pv", "score", "depth", "seldepth", "tbhits"}
+_ply_keys = {"move", "pvs", "cr", "time", "nodes", "nps", "skipped"}
+
+_files = "abcdefgh"
+_promotions = " nbrq"
+NULL_MOVE = 0xFFFF
+
+COLUMN_FULL = 0
+COLUMN_CONSTANT = 1
+
+
+class UnpackableAnalysis(ValueError):
+    pass
+
+
+def _to_int(value):
+    # The CR importer stores the values it read from csv as strings.
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool):
+        raise UnpackableAnalysis(f"Unexpected boolean: {value}")
+    if isinstance(value, float):
+        if not value.is_integer():
+            raise UnpackableAnalysis(f"Unexpected fractional value: {value}")
+        return int(value)
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        raise UnpackableAnalysis(f"Unexpected value: {value!r}")
+
+
+def _encode(value, null):
+    value = _to_int(value)
+    return null if value is None else value
+
+
+def _decode(value, null):
+    return None if value == null else value
+
+
+def encode_uci(uci):
+    if uci == "0000":
+        return NULL_MOVE
+    if len(uci) not in (4, 5) or uci[0] not in _files or uci[2] not in _files:
+        raise UnpackableAnalysis(f"Not a uci move: {uci}")
+    try:
+        from_square = _files.index(uci[0]) + 8 * (int(uci[1]) - 1)
+        to_square = _files.index(uci[2]) + 8 * (int(uci[3]) - 1)
+        promotion = _promotions.index(uci[4]) if len(uci) == 5 else 0
+    except ValueError:
+        raise UnpackableAnalysis(f"Not a uci move: {uci}")
+    if not (0 <= from_square < 64 and 0 <= to_square < 64):
+        raise UnpackableAnalysis(f"Not a uci move: {uci}")
+    return from_square | to_square << 6 | promotion << 12
+
+
+def decode_uci(code):
+    if code == NULL_MOVE:
+        return "0000"
+    from_square, to_square, promotion = code & 63, code >> 6 & 63, code >> 12
+    uci = (
+        f"{_files[from_square % 8]}{from_square // 8 + 1}"
+        f"{_files[to_square % 8]}{to_square // 8 + 1}"
+    )
+    return uci + _promotions[promotion] if promotion else uci
+
+
+def _columns(spec):
+    return {name: array(typecode) for name, typecode in spec}
+
+
+def _pack_pv(pv, pvs, pv_moves):
+    if not isinstance(pv, dict):
+        raise UnpackableAnalysis(f"Unexpected pv: {pv!r}")
+    keys = 0
+    if "pv" in pv:
+        keys |= PV_PV
+        if not isinstance(pv["pv"], str):
+            raise UnpackableAnalysis(f"Unexpected pv: {pv['pv']!r}")
+        moves = [encode_uci(uci) for uci in pv["pv"].split()]
+        pv_moves.extend(moves)
+        pvs["length"].append(len(moves))
+    else:
+        pvs["length"].append(0)
+    cp = mate = None
+    if "score" in pv:
+        keys |= PV_SCORE
+        score = pv["score"]
+        if set(score) - {"cp", "mate"}:
+            raise UnpackableAnalysis(f"Unexpected score keys: {set(score)}")
+        if "cp" in score:
+            keys |= PV_CP
+            cp = score["cp"]
+        if "mate" in score:
+            keys |= PV_MATE
+            mate = score["mate"]
+    pvs["cp"].append(_encode(cp, NULL32))
+    pvs["mate"].append(_encode(mate, NULL32))
+    for key, bit, null in _pv_int_keys:
+        if key in pv:
+            keys |= bit
+        pvs[key].append(_encode(pv.get(key), null))
+    pvs["keys"].append(keys)
+
+
+def _pack_ply(entry, plies, pvs, pv_moves):
+    keys = cr_keys = 0
+    cr = {}
+    entry_pvs = []
+    if entry is None:
+        keys |= PLY_NONE
+        entry = {}
+    elif not isinstance(entry, dict):
+        raise UnpackableAnalysis(f"Unexpected ply: {entry!r}")
+    elif set(entry) & _flat_keys:
+        if "pvs" in entry:
+            raise UnpackableAnalysis("Ply has both pvs and a flat pv")
+        keys |= PLY_FLAT
+        entry_pvs = [{k: v for k, v in entry.items() if k in _flat_keys}]
+
+    unknown = set(entry) - _ply_keys - (_flat_keys if keys & PLY_FLAT else set())
+    if unknown:
+        raise UnpackableAnalysis(f"Unexpected keys: {unknown}")
+    if "move" in entry:
+        keys |= PLY_MOVE
+    plies["move"].append(_encode(entry.get("move"), NULL32))
+    if "pvs" in entry:
+        keys |= PLY_PVS
+        entry_pvs = entry["pvs"]
+    if "cr" in entry:
+        keys |= PLY_CR
+        cr = entry["cr"]
+        if set(cr) - {key for key, _, _ in _cr_int_keys}:
+            raise UnpackableAnalysis(f"Unexpected cr keys: {set(cr)}")
+    for key, bit, null in _cr_int_keys:
+        if key in cr:
+            cr_keys |= bit
+        plies[key].append(_encode(cr.get(key), null))
+    for key, bit, null in _ply_int_keys:
+        if key in entry:
+            keys |= bit
+        plies[key].append(_encode(entry.get(key), null))
+    if "skipped" in entry:
+        keys |= PLY_SKIPPED
+    plies["skipped"].append(1 if entry.get("skipped") else 0)
+    if len(entry_pvs) > 255:
+        raise UnpackableAnalysis("Too many pvs")
+    plies["npvs"].append(len(entry_pvs))
+    for pv in entry_pvs:
+        _pack_pv(pv, pvs, pv_moves)
+    plies["keys"].append(keys)
+    plies["cr_keys"].append(cr_keys)
+
+
+def pack_analysis(analysis):
+    """Encode a GameAnalysis.analysis list as bytes.
+
+    Numeric strings are stored as integers and empty strings as None, so
+    unpacking gives back the normalized form of what was packed. Raises
+    UnpackableAnalysis for anything the format can't represent.
+    """
+    plies = _columns(_ply_columns)
+    pvs = _columns(_pv_columns)
+    pv_moves = array("H")
+    try:
+        for entry in analysis:
+            _pack_ply(entry, plies, pvs, pv_moves)
+    except OverflowError as e:
+        raise UnpackableAnalysis(str(e))
+
+    columns = [*plies.values(), *pvs.values(), pv_moves]
+    modes = array("B")
+    for i, column in enumerate(columns):
+        if len(column) > 1 and column.count(column[0]) == len(column):
+            modes.append(COLUMN_CONSTANT)
+            columns[i] = column[:1]
+        else:
+            modes.append(COLUMN_FULL)
+    parts = [
+        _header.pack(MAGIC, VERSION, len(plies["move"]), len(pvs["keys"]), len(pv_moves)),
+        modes.tobytes(),
+    ]
+    for column in columns:
+        if sys.byteorder == "big":
+            column.byteswap()
+        parts.append(column.tobytes())
+    return b"".join(parts)
+
+
+class PackedAnalysis:
+    """Read access to a packed analysis without rebuilding the JSON.
+
+    The columns are exposed as arrays named after the ply and pv columns,
+    e.g. `played_eval` or `pv_cp`. pv_offsets[ply] is the index of the
+    first pv of that ply in the pv columns.
+    """
+
+    def __init__(self, blob):
+        blob = bytes(blob)
+        magic, version, num_plies, num_pvs, num_pv_moves = _header.unpack_from(blob)
+        if magic != MAGIC or version != VERSION:
+            raise UnpackableAnalysis("Not a packed analysis")
+        offset = _header.size
+        columns = (
+            [(name, typecode, num_plies) for name, typecode in _ply_columns]
+            + [(f"pv_{name}", typecode, num_pvs) for name, typecode in _pv_columns]
+            + [("pv_moves", "H", num_pv_moves)]
+        )
+        modes = blob[offset:offset + len(columns)]
+        offset += len(columns)
+        for (name, typecode, length), mode in zip(columns, modes):
+            column = array(typecode)
+            stored = 1 if mode == COLUMN_CONSTANT else length
+            end = offset + stored * column.itemsize
+            column.frombytes(blob[offset:end])
+            if sys.byteorder == "big":
+                column.byteswap()
+            if mode == COLUMN_CONSTANT:
+                column *= length
+            setattr(self, name, column)
+            offset = end
+        self.pv_offsets = [0, *accumulate(self.npvs)]
+        self.pv_move_offsets = [0, *accumulate(self.pv_length)]
+
+    def __len__(self):
+        return len(self.move)
+
+    def pv_cps(self, ply):
+        start, end = self.pv_offsets[ply], self.pv_offsets[ply + 1]
+        return [_decode(cp, NULL32) for cp in self.pv_cp[start:end]]
+
+    def moves(self):
+        for ply in range(len(self)):
+            yield PackedMove(self, ply)
+
+    def _pv(self, i):
+        keys = self.pv_keys[i]
+        pv = {}
+        if keys & PV_PV:
+            start, end = self.pv_move_offsets[i], self.pv_move_offsets[i + 1]
+            pv["pv"] = " ".join(decode_uci(code) for code in self.pv_moves[start:end])
+        if keys & PV_SCORE:
+            pv["score"] = {}
+            if keys & PV_CP:
+                pv["score"]["cp"] = _decode(self.pv_cp[i], NULL32)
+            if keys & PV_MATE:
+                pv["score"]["mate"] = _decode(self.pv_mate[i], NULL32)
+        for key, bit, null in _pv_int_keys:
+            if keys & bit:
+                pv[key] = _decode(getattr(self, f"pv_{key}")[i], null)
+        return pv
+
+    def ply(self, ply):
+        keys = self.keys[ply]
+        if keys & PLY_NONE:
+            return None
+        pvs = [self._pv(i) for i in range(self.pv_offsets[ply], self.pv_offsets[ply + 1])]
+        entry = pvs[0] if keys & PLY_FLAT else {}
+        if keys & PLY_MOVE:
+            entry["move"] = _decode(self.move[ply], NULL32)
+        if keys & PLY_PVS:
+            entry["pvs"] = pvs
+        if keys & PLY_CR:
+            entry["cr"] = {
+                key: _decode(getattr(self, key)[ply], null)
+                for key, bit, null in _cr_int_keys
+                if self.cr_keys[ply] & bit
+            }
+        for key, bit, null in _ply_int_keys:
+            if keys & bit:
+                entry[key] = _decode(getattr(self, key)[ply], null)
+        if keys & PLY_SKIPPED:
+            entry["skipped"] = bool(self.skipped[ply])
+        return entry
+
+    def to_json(self):
+        return [self.ply(ply) for ply in range(len(self))]
+
+
+def unpack_analysis(blob):
+    return PackedAnalysis(blob).to_json()
+
+
+class PackedMove:
+    """The packed counterpart of sonder.cr.Move."""
+
+    def __init__(self, packed, ply):
+        self.packed = packed
+        self.ply = ply
+
+    def _pv_eval(self, index):
+        if index >= self.packed.npvs[self.ply]:
+            return None
+        return _decode(self.packed.pv_cp[self.packed.pv_offsets[self.ply] + index], NULL32)
+
+    @property
+    def pv1_eval(self):
+        return self._pv_eval(0)
+
+    @property
+    def pv2_eval(self):
+        return self._pv_eval(1)
+
+    @property
+    def pv3_eval(self):
+        return self._pv_eval(2)
+
+    @property
+    def pv4_eval(self):
+        return self._pv_eval(3)
+
+    @property
+    def pv5_eval(self):
+        return self._pv_eval(4)
+
+    @property
+    def played_eval(self):
+        return _decode(self.packed.played_eval[self.ply], NULL32)
+
+    @property
+    def played_rank(self):
+        return _decode(self.packed.played_rank[self.ply], NULL32)
+
+    @property
+    def color(self):
+        return "w" if self.packed.move[self.ply] % 2 == 1 else "b"
+
+    @property
+    def number(self):
+        return ((self.packed.move[self.ply] - 1) // 2) + 1
+
+
+def iter_pv_cps(analysis):
+    """The cp of each pv, per ply, for either representation of an analysis."""
+    if isinstance(analysis, PackedAnalysis):
+        for ply in range(len(analysis)):
+            yield analysis.pv_cps(ply)
+    else:
+        for entry in analysis:
+            yield [pv["score"]["cp"] for pv in entry["pvs"]]
@@ -12,6 +12,7 @@ from graphene_django_extras.paginations import LimitOffsetGraphqlPagination
 
 from . import models
 from .. import cr
+from .loaders import loaders, related
 
 # TODO: welp, this wasn't nearly as succinct as I was hoping. :P
 FishnetRequest = {
@@ -58,56 +59,73 @@ FishnetJob = {
     },
 }
 
-FishnetAnalysis = {
-    "title": "FishnetAnalysis",
+FishnetJobBatch = {
+    "title": "FishnetJobBatch",
     "type": "object",
-    "required": ["fishnet", "stockfish", "analysis"],
+    "required": ["jobs"],
     "properties": {
-        "fishnet": {
-            "type": "object",
-            "required": ["version", "python", "apikey"],
-            "properties": {
-                "version": {"type": "string"},
-                "python": {"type": "string"},
-                "apikey": {"type": "string"},
-            },
-        },
-        "stockfish": {
+        "jobs": {"type": "array", "items": FishnetJob},
+    },
+}
+
+FishnetPositions = {
+    "type": "array",
+    "items": {
+        "anyOf": [{
+            "type": "null",
+        }, {
             "type": "object",
-            "required": ["name", "options"],
             "properties": {
-                "name": {"type": "string"},
-                "options": {"type": "object"},
-            }
-        },
-        "analysis": {
-            "type": "array",
-            "items": {
-                "anyOf": [{
-                    "type": "null",
-                }, {
+                "skipped": {"type": "boolean"},
+                "bsetmove": {"type": "string"},
+                "pv": {"type": "string"},
+                "seldepth": {"type": "number"},
+                "tbhits": {"type": "number"},
+                "depth": {"type": "number"},
+                "score": {
                     "type": "object",
                     "properties": {
-                        "skipped": {"type": "boolean"},
-                        "bsetmove": {"type": "string"},
-                        "pv": {"type": "string"},
-                        "seldepth": {"type": "number"},
-                        "tbhits": {"type": "number"},
-                        "depth": {"type": "number"},
-                        "score": {
-                            "type": "object",
-                            "properties": {
-                                "cp": {"type": "number"},
-                                "mate": {"type": "number"},
-                             }
-                        },
-                        "time": {"type": "number"},
-                        "nodes": {"type": "number"},
-                        "nps": {"type": "number"},
-                    }
-                    }]
+                        "cp": {"type": "number"},
+                        "mate": {"type": "number"},
+                     }
+                },
+                "time": {"type": "number"},
+                "nodes": {"type": "number"},
+                "nps": {"type": "number"},
             }
-        }
+            }]
+    }
+}
+
+FishnetAnalysis = {
+    "title": "FishnetAnalysis",
+    "type": "object",
+    "required": ["fishnet", "stockfish", "analysis"],
+    "properties": {
+        "fishnet": FishnetRequest["properties"]["fishnet"],
+        "stockfish": FishnetRequest["properties"]["stockfish"],
+        "analysis": FishnetPositions,
+    }
+}
+
+FishnetAnalysisBatch = {
+    "title": "FishnetAnalysisBatch",
+    "type": "object",
+    "required": ["fishnet", "stockfish", "analyses"],
+    "properties": {
+        "fishnet": FishnetRequest["properties"]["fishnet"],
+        "stockfish": FishnetRequest["properties"]["stockfish"],
+        "analyses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["work_id", "analysis"],
+                "properties": {
+                    "work_id": {"type": "string"},
+                    "analysis": FishnetPositions,
+                },
+            },
+        },
     }
 }
 
@@ -143,6 +161,11 @@ class CRReport(DjangoObjectType, LoginRequired):
             "cp_loss_total",
         ]
 
+    def resolve_player(parent, info):
+        if parent.player_id is None:
+            return None
+        return loaders(info).player.load(parent.player_id)
+
     t1_percentage = graphene.Float(required=True)
 
     def resolve_t1_percentage(parent, info):
@@ -179,20 +202,29 @@ class Game(DjangoObjectType, LoginRequired):
             "black_player__username",
         ]
 
+    def resolve_white_player(parent, info):
+        return loaders(info).player.load(parent.white_player_id)
+
+    def resolve_black_player(parent, info):
+        return loaders(info).player.load(parent.black_player_id)
+
 
 class PlayerFilter(FilterSet):
     class Meta:
         model = models.Player
         fields = {
             "id": ("exact",),
-            "username": ("icontains", "iexact"),
+            # username__gt is the keyset pagination cursor: ordered by
+            # username, the next page starts after the last username seen.
+            "username": ("icontains", "iexact", "gt"),
         }
 
     @property
     def qs(self):
-        # The query context can be found in self.request.
-        return super(PlayerFilter, self).qs.prefetch_related(
-            "games_as_white", "games_as_black"
+        # The query context can be found in self.request. Ordered by username
+        # for the username__gt cursor, unless the query asks for an ordering.
+        return models.Player.annotate_total_games(
+            super(PlayerFilter, self).qs.order_by("username")
         )
 
 
@@ -206,7 +238,19 @@ class Player(DjangoObjectType, LoginRequired):
     totalGames = graphene.Int(required=True)
 
     def resolve_totalGames(parent, info):
-        return parent.games_as_white.count() + parent.games_as_black.count()
+        total_games = getattr(parent, "total_games", None)
+        if total_games is not None:
+            return total_games
+        return loaders(info).total_games.load(parent.pk)
+
+    def resolve_games_as_white(parent, info):
+        return related(info, parent, "games_as_white")
+
+    def resolve_games_as_black(parent, info):
+        return related(info, parent, "games_as_black")
+
+    def resolve_crreport_set(parent, info):
+        return related(info, parent, "crreport_set")
 
 
 class Query(ObjectType, LoginRequired):
@@ -218,18 +262,18 @@ class Query(ObjectType, LoginRequired):
         filterset_class=PlayerFilter,
     )
 
-    @classmethod
-    def resolve_player(cls, info, **kwargs):
+    def resolve_player(parent, info, **kwargs):
         if info.context.user.is_anonymous:
             return None
         _id = kwargs.get("id")
         username = kwargs.get("username")
 
+        players = models.Player.annotate_total_games(models.Player.objects)
         if _id is not None:
-            return models.Player.objects.get(pk=_id)
+            return players.get(pk=_id)
 
         if username is not None:
-            return models.Player.objects.get(username=username)
+            return players.get(username=username)
 
         return None
 
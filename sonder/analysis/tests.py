@@ -1,6 +1,1075 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+from datetime import timedelta
+
+import chess.pgn
+
+from django.contrib.auth.models import User
+from django.db import connection, connections, transaction
+from django.test import (
+    Client,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from sonder import cr, jsonapi
+from sonder.bench import UnsafeDatabase, is_isolated_database, require_isolated_database
+from sonder.bench.loadtest import (
+    acquire_load_test,
+    create_acquire_fixture,
+    endpoint_benchmark,
+    fishnet_analysis_payload,
+    league_dump,
+    players_benchmark,
+    random_moves,
+)
+from sonder.schema import schema
+from sonder.utils import TTLCache, zobrist_hashes
+from .export import compressed, exportable_games, iter_pgns
+from .jobs import (
+    FULL_REPORT_NAME,
+    index_game_positions,
+    pack_game_analyses,
+    update_player_reports,
+)
+from .models import (
+    AnalysisSource,
+    CRGameResult,
+    CRReport,
+    Game,
+    GameAnalysis,
+    GamePlayerConflict,
+    GamePosition,
+    GameTag,
+    IrwinReport,
+    IrwinReportRequiredGame,
+    ParsedGame,
+    Player,
+    PositionAnalysis,
+    Tag,
+    import_pgn_to_db,
+    insert_games_into_db,
+    read_pgn_games,
+)
+from .packed import PackedAnalysis, UnpackableAnalysis, pack_analysis, unpack_analysis
+from .schema import (
+    FishnetAnalysis,
+    FishnetAnalysisBatch,
+    FishnetJob,
+    FishnetPositions,
+)
+from .views import save_analyses
 
 # Create your tests here.
 class TestAnalysis(TestCase):
     def test_something(self):
         self.assertEqual("Foo", "Foo")
+
+
+cr_schema = """
+CREATE TABLE "game" ("id" VARCHAR(255) NOT NULL PRIMARY KEY, "is_analyzed" INTEGER NOT NULL);
+CREATE TABLE "player" ("id" INTEGER NOT NULL PRIMARY KEY, "username" VARCHAR(255) NOT NULL);
+CREATE TABLE "gameplayer" ("id" INTEGER NOT NULL PRIMARY KEY, "game_id" VARCHAR(255) NOT NULL, "color" CHAR(1) NOT NULL, "player_id" INTEGER NOT NULL);
+CREATE TABLE "move" ("id" INTEGER NOT NULL PRIMARY KEY, "game_id" VARCHAR(255) NOT NULL, "color" CHAR(1) NOT NULL, "number" INTEGER NOT NULL, "pv1_eval" INTEGER NOT NULL, "pv2_eval" INTEGER, "pv3_eval" INTEGER, "pv4_eval" INTEGER, "pv5_eval" INTEGER, "played_eval" INTEGER NOT NULL, "played_rank" INTEGER, "nodes" INTEGER, "masterdb_matches" INTEGER);
+INSERT INTO game VALUES('6OuA9Pzz',1);
+INSERT INTO game VALUES('UjjpxfT2',0);
+INSERT INTO player VALUES(1,'dotaautochess');
+INSERT INTO player VALUES(2,'chesswhiz');
+INSERT INTO gameplayer VALUES(1,'6OuA9Pzz','w',1);
+INSERT INTO gameplayer VALUES(2,'6OuA9Pzz','b',2);
+INSERT INTO gameplayer VALUES(3,'UjjpxfT2','w',2);
+INSERT INTO gameplayer VALUES(4,'UjjpxfT2','b',1);
+INSERT INTO move VALUES(1,'UjjpxfT2','w',1,29,25,20,NULL,NULL,29,1,4500592,NULL);
+INSERT INTO move VALUES(2,'UjjpxfT2','b',1,-30,-35,-40,-41,-42,-35,2,4500000,12);
+INSERT INTO move VALUES(3,'6OuA9Pzz','w',1,15,10,5,0,-5,15,1,4500000,3);
+"""
+
+
+class TestCRBulkImport(TestCase):
+    def setUp(self):
+        fd, self.database = tempfile.mkstemp(suffix=".sqlite3")
+        os.close(fd)
+        connection = sqlite3.connect(self.database)
+        connection.executescript(cr_schema)
+        connection.close()
+
+    def tearDown(self):
+        os.unlink(self.database)
+
+    def test_import(self):
+        Player.objects.create(username="chesswhiz")
+        cr.import_cr_database_bulk(self.database, "cr", "sf10", batch_size=1)
+
+        self.assertEqual(Player.objects.count(), 2)
+        game = Game.objects.get(lichess_id="UjjpxfT2")
+        self.assertEqual(game.white_player.username, "chesswhiz")
+        self.assertEqual(game.black_player.username, "dotaautochess")
+
+        analysis = GameAnalysis.objects.get(game=game)
+        self.assertFalse(analysis.is_completed)
+        self.assertEqual(len(analysis.analysis), 2)
+        black = cr.Move(analysis.analysis[1])
+        self.assertEqual(black.color, "b")
+        self.assertEqual(
+            [black.pv1_eval, black.pv2_eval, black.pv5_eval], [-30, -35, -42]
+        )
+        self.assertEqual((black.played_eval, black.played_rank), (-35, 2))
+        self.assertIsNone(cr.Move(analysis.analysis[0]).pv4_eval)
+
+    def test_import_caches_results(self):
+        cr.import_cr_database_bulk(self.database, "cr", "sf10")
+        self.assertEqual(CRGameResult.objects.count(), 4)
+
+    def test_reimport_updates_analysis(self):
+        cr.import_cr_database_bulk(self.database, "cr", "sf10")
+        cr.import_cr_database_bulk(self.database, "cr", "sf10")
+        self.assertEqual(Game.objects.count(), 2)
+        self.assertEqual(GameAnalysis.objects.count(), 2)
+        self.assertTrue(
+            GameAnalysis.objects.get(game__lichess_id="6OuA9Pzz").is_completed
+        )
+
+
+def random_cr_analysis(rng, plies, missing_evals=0):
+    """Random CR analysis, with pv1 and played evals missing at the given rate."""
+    analysis = []
+    pv1 = rng.randint(-50, 50)
+    for ply in range(1, plies + 1):
+        # Evals are from the mover's perspective, so an unchanged position flips sign.
+        pv1 = rng.randint(-300, 300) if rng.random() < 0.5 else -pv1
+        evals = [pv1]
+        for _ in range(4):
+            evals.append(evals[-1] - rng.choice([0, 5, 30, 80, 150]))
+        missing = rng.choice([0, 0, 0, 1, 2, 4])
+        evals = evals[:5 - missing] + [None] * missing
+        rank = rng.choice([1, 1, 2, 3, 4, 5, None, ""])
+        played_eval = pv1 - rng.choice([0, 0, 0, 15, 60, 250, 900])
+        if rng.random() < missing_evals:
+            evals[0] = None
+        if rng.random() < missing_evals:
+            played_eval = None
+        as_str = rng.random() < 0.5
+        analysis.append({
+            "move": ply,
+            "pvs": [
+                {"pv": "", "score": {"cp": str(cp) if as_str and cp is not None else cp, "mate": None}}
+                for cp in evals
+            ],
+            "cr": {"played_eval": played_eval, "played_rank": rank, "masterdb_matches": None},
+        })
+    return analysis
+
+
+class TestA1Engines(SimpleTestCase):
+    def test_numpy_engine_matches_python(self):
+        config = json.loads(cr.CR_CONFIG)
+        rng = random.Random(4545)
+        outcomes = set()
+        for game in range(400):
+            analysis = random_cr_analysis(rng, rng.randint(0, 120), missing_evals=0.01)
+            moves = [cr.Move(a) for a in analysis]
+            arrays = cr.EvalArrays.from_analysis(analysis)
+            for color in ("w", "b"):
+                expected = a1_outcome(cr.a1_game, str(game), config, moves, color)
+                actual = a1_outcome(cr.a1_game_arrays, str(game), config, arrays, color)
+                self.assertEqual(expected, actual)
+                outcomes.add(expected is None)
+        self.assertEqual(outcomes, {True, False})
+
+
+def a1_outcome(a1_game, gid, config, moves, color):
+    """The result of a1_game as a dict, or None if the analysis is unusable."""
+    try:
+        return a1_game(gid, config, moves, color, None).asdict()
+    except cr.UNUSABLE_ANALYSIS_ERRORS:
+        return None
+
+
+def create_analysed_games(count, seed=7):
+    source = AnalysisSource.objects.create(name="cr")
+    rng = random.Random(seed)
+    players = [Player.objects.create(username=f"player{i}") for i in range(4)]
+    gameids = []
+    for i in range(count):
+        game = Game.objects.create(
+            lichess_id=f"game{i:04}",
+            white_player=players[i % 4],
+            black_player=players[(i + 1) % 4],
+        )
+        GameAnalysis.objects.create(
+            game=game,
+            source=source,
+            stockfish_version="sf10",
+            analysis=random_cr_analysis(rng, 40),
+        )
+        gameids.append(game.lichess_id)
+    return gameids
+
+
+class TestA1ReportQueries(TestCase):
+    def setUp(self):
+        self.gameids = create_analysed_games(10)
+
+    def test_report_is_a_single_query(self):
+        for engine in cr.a1_engines:
+            with self.assertNumQueries(1):
+                working_set = cr.get_analysed_game_pgns_from_db(self.gameids)
+                report = cr.generate_a1_report(working_set, engine=engine)
+                for player, result in report.by_player.items():
+                    self.assertTrue(player.username)
+            self.assertEqual(len(report.by_player), 4)
+            self.assertEqual(len(report.by_game), 20)
+
+
+fishnet_analysis = [
+    {"skipped": True},
+    None,
+    {
+        "pv": "e2e4 e7e5 g1f3 b8c6 e1g1",
+        "score": {"cp": 24},
+        "depth": 18,
+        "seldepth": 24,
+        "tbhits": 0,
+        "time": 1004,
+        "nodes": 1686023,
+        "nps": 1670251,
+    },
+    {"pv": "a7a8q b2b1n 0000", "score": {"mate": -3}, "depth": 30},
+]
+
+
+class TestPackedAnalysis(SimpleTestCase):
+    def test_round_trip(self):
+        rng = random.Random(1)
+        cr_analysis = random_cr_analysis(rng, 80)
+        normalized = json.loads(
+            json.dumps(cr_analysis), object_hook=lambda d: {
+                k: (cr.int_or_none(v) if k in ("cp", "played_rank") else v)
+                for k, v in d.items()
+            }
+        )
+        self.assertEqual(unpack_analysis(pack_analysis(cr_analysis)), normalized)
+        self.assertEqual(unpack_analysis(pack_analysis(fishnet_analysis)), fishnet_analysis)
+        self.assertLess(len(pack_analysis(cr_analysis)), len(json.dumps(cr_analysis)) / 5)
+
+    def test_unpackable(self):
+        for analysis in ([{"bestmove": "e2e4"}], [{"pv": "e2e9"}], [{"nodes": 2 ** 70}]):
+            with self.assertRaises(UnpackableAnalysis):
+                pack_analysis(analysis)
+
+    def test_engines_read_packed_analysis(self):
+        config = json.loads(cr.CR_CONFIG)
+        rng = random.Random(2)
+        for game in range(50):
+            analysis = random_cr_analysis(rng, rng.randint(0, 100))
+            packed = PackedAnalysis(pack_analysis(analysis))
+            self.assertEqual(
+                list(packed.pv_cps(i) for i in range(len(packed))),
+                [[cr.int_or_none(pv["score"]["cp"]) for pv in a["pvs"]] for a in analysis],
+            )
+            for color in ("w", "b"):
+                expected = cr.a1_game("g", config, cr.moves_from_analysis(analysis), color, None)
+                for prepare, run in cr.a1_engines.values():
+                    actual = run("g", config, prepare(packed), color, None)
+                    self.assertEqual(expected.asdict(), actual.asdict())
+
+
+class TestPackGameAnalyses(TestCase):
+    def test_backfill(self):
+        source = AnalysisSource.objects.create(name="cr")
+        white = Player.objects.create(username="white")
+        black = Player.objects.create(username="black")
+        analysis = random_cr_analysis(random.Random(3), 30)
+        for i, data in enumerate([analysis, [{"bestmove": "e2e4"}]]):
+            game = Game.objects.create(
+                lichess_id=f"game{i}", white_player=white, black_player=black
+            )
+            GameAnalysis.objects.create(
+                game=game, source=source, stockfish_version="sf10", analysis=data
+            )
+
+        self.assertEqual(pack_game_analyses(batch_size=1, drop_json=True), (1, 1))
+        game_analysis = GameAnalysis.objects.get(game__lichess_id="game0")
+        self.assertIsNone(game_analysis.analysis)
+        expected = cr.PgnSpyResult()
+        expected.add(cr.a1_game(
+            "game0", json.loads(cr.CR_CONFIG), cr.moves_from_analysis(analysis), "w", white
+        ))
+        report = cr.generate_a1_report(cr.get_analysed_game_pgns_from_db(["game0"]))
+        self.assertEqual(report.by_player[white].asdict(), expected.asdict())
+
+        game_analysis.set_analysis([])
+        game_analysis.save()
+        self.assertEqual(GameAnalysis.objects.get(pk=game_analysis.pk).get_analysis(), [])
+
+
+class TestPackGameAnalysesLocking(TransactionTestCase):
+    def test_locked_analyses_are_skipped(self):
+        gameids = create_analysed_games(2)
+        locked_pk = GameAnalysis.objects.get(game__lichess_id=gameids[0]).pk
+        locked, release = threading.Event(), threading.Event()
+
+        def submission():
+            with transaction.atomic():
+                GameAnalysis.objects.select_for_update().get(pk=locked_pk)
+                locked.set()
+                release.wait(10)
+            connections.close_all()
+
+        thread = threading.Thread(target=submission)
+        thread.start()
+        try:
+            locked.wait(10)
+            self.assertEqual(pack_game_analyses(), (1, 0))
+        finally:
+            release.set()
+            thread.join()
+        unpacked = GameAnalysis.objects.filter(analysis_packed__isnull=True)
+        self.assertEqual(list(unpacked.values_list("pk", flat=True)), [locked_pk])
+        self.assertEqual(pack_game_analyses(), (1, 0))
+
+
+class TestParallelA1Report(TransactionTestCase):
+    def test_matches_serial_report(self):
+        gameids = create_analysed_games(30)
+        random.Random(5).shuffle(gameids)
+
+        def flatten(report):
+            return (
+                [(p.username, r.asdict()) for p, r in report.by_player.items()],
+                [(p.username, g, r.asdict()) for (p, g), r in report.by_game.items()],
+            )
+
+        serial = cr.generate_a1_report(cr.get_analysed_game_pgns_from_db(gameids))
+        parallel = cr.generate_a1_report_parallel(gameids, workers=3)
+        self.assertEqual(flatten(serial), flatten(parallel))
+
+
+class TestCRGameResultCache(TestCase):
+    def setUp(self):
+        self.gameids = create_analysed_games(10)
+
+    def report(self, use_cache):
+        report = cr.a1_report_for_games(self.gameids, use_cache=use_cache)
+        return {p.username: r.asdict() for p, r in report.by_player.items()}
+
+    def test_cached_report_matches(self):
+        expected = self.report(use_cache=False)
+        self.assertEqual(self.report(use_cache=True), expected)
+        self.assertEqual(CRGameResult.objects.count(), 20)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.report(use_cache=True), expected)
+
+    def test_engines_are_cached_separately(self):
+        cr.cache_a1_results(GameAnalysis.objects.all(), engine="numpy")
+        self.assertEqual(CRGameResult.objects.count(), 20)
+        expected = self.report(use_cache=False)
+        self.assertEqual(self.report(use_cache=True), expected)
+        self.assertEqual(CRGameResult.objects.count(), 40)
+
+    def test_overwritten_analysis_is_recomputed(self):
+        self.report(use_cache=True)
+        game_analysis = GameAnalysis.objects.get(game__lichess_id=self.gameids[0])
+        game_analysis.set_analysis(random_cr_analysis(random.Random(99), 60))
+        game_analysis.save()
+        cr.cache_a1_results([game_analysis])
+        self.assertEqual(self.report(use_cache=True), self.report(use_cache=False))
+
+        game_analysis.set_analysis([None])
+        game_analysis.save()
+        cr.cache_a1_results([game_analysis])
+        self.assertFalse(
+            CRGameResult.objects.filter(game_analysis=game_analysis).exists()
+        )
+
+
+@override_settings(PLAYER_REPORTS_SETTLE_SECONDS=0)
+class TestUpdatePlayerReports(TestCase):
+    def setUp(self):
+        self.gameids = create_analysed_games(10)
+
+    def updated(self, **kwargs):
+        return {p.username for p in Player.objects.filter(
+            pk__in=update_player_reports(batch_size=3, **kwargs)
+        )}
+
+    def test_only_changed_players_are_updated(self):
+        self.assertEqual(self.updated(), {f"player{i}" for i in range(4)})
+        self.assertEqual(CRReport.objects.filter(name=FULL_REPORT_NAME).count(), 4)
+        self.assertEqual(self.updated(), set())
+
+        game_analysis = GameAnalysis.objects.get(game__lichess_id=self.gameids[0])
+        game_analysis.set_analysis(random_cr_analysis(random.Random(99), 60))
+        game_analysis.save()
+        self.assertEqual(self.updated(), {"player0", "player1"})
+        self.assertEqual(CRReport.objects.filter(name=FULL_REPORT_NAME).count(), 4)
+
+        report = cr.a1_report_for_games(self.gameids)
+        player = Player.objects.get(username="player0")
+        self.assertEqual(
+            CRReport.objects.get(player=player).sample_size,
+            report.by_player[player].sample_size,
+        )
+        self.assertEqual(len(self.updated(full=True)), 4)
+
+    def test_recent_analyses_are_left_for_the_next_run(self):
+        with override_settings(PLAYER_REPORTS_SETTLE_SECONDS=60):
+            self.assertEqual(self.updated(), set())
+        self.assertEqual(self.updated(), {f"player{i}" for i in range(4)})
+
+    def test_fishnet_analyses_are_skipped(self):
+        game = Game.objects.create(
+            lichess_id="fishnet0",
+            white_player=Player.objects.get(username="player0"),
+            black_player=Player.objects.get(username="player2"),
+        )
+        fishnet = GameAnalysis(
+            game=game, source=AnalysisSource.objects.get(), stockfish_version="sf10"
+        )
+        fishnet.merge_analysis([{"skipped": True}] * 3)
+        fishnet.save()
+        self.assertTrue(fishnet.is_completed)
+        self.assertEqual(self.updated(), {f"player{i}" for i in range(4)})
+        self.assertEqual(self.updated(), set())
+
+        report = cr.a1_report_for_games(self.gameids)
+        player = Player.objects.get(username="player0")
+        self.assertEqual(
+            CRReport.objects.get(player=player).sample_size,
+            report.by_player[player].sample_size,
+        )
+
+
+def pgn_text(count, white="White", black="Black"):
+    return "\n\n".join(
+        f"""[Site "https://lichess.org/pgn{i:05}"]
+[White "{white}{i % 3}"]
+[Black "{black}{i % 5}"]
+[TimeControl "180+2"]
+
+1. d4 d5 2. c4 e6 *"""
+        for i in range(count)
+    )
+
+
+class TestPGNImport(TestCase):
+    def test_queries_per_batch_are_constant(self):
+        with CaptureQueriesContext(connection) as queries:
+            games = import_pgn_to_db(io.StringIO(pgn_text(200)), batch_size=100)
+        self.assertEqual(len(games), 200)
+        self.assertLessEqual(len(queries), 2 * 8)
+        self.assertEqual(Player.objects.count(), 8)
+        game = Game.objects.get(lichess_id="pgn00007")
+        self.assertEqual(game.moves, ["d2d4", "d7d5", "c2c4", "e7e6"])
+        self.assertEqual(game.white_player.username, "white1")
+        self.assertEqual(game.black_player.username, "black2")
+
+    def test_reimport_updates_and_tags(self):
+        import_pgn_to_db(io.StringIO(pgn_text(10)))
+        tag = Tag.objects.create(name="Season-1")
+        games = insert_games_into_db(
+            list(read_pgn_games(io.StringIO(pgn_text(12)))),
+            {f"pgn{i:05}": [tag] for i in range(12)},
+        )
+        self.assertEqual(len({g.pk for g in games}), 12)
+        self.assertEqual(Game.objects.count(), 12)
+        self.assertEqual(GameTag.objects.filter(tag=tag).count(), 12)
+
+        with self.assertRaises(GamePlayerConflict):
+            import_pgn_to_db(io.StringIO(pgn_text(1, white="Other")))
+
+    def test_ingest_matches_game_builder(self):
+        dump = league_dump(20, unique=10) + (
+            '\n\n[Site "https://lichess.org/variatio"]\n[White "a"]\n[Black "b"]\n'
+            '[TimeControl "-"]\n\n1. e4 $1 (1. d4 d5) e5 {ok} 2. Nf3?! Nc6 *'
+            '\n\n[Site "https://lichess.org/castles1"]\n[White "a"]\n[Black "b"]\n'
+            '[TimeControl "-"]\n\n1. e4 e5 2. Nf3 Nc6 3. Bc4 Nf6 4. 0-0 Bc5 *'
+            '\n\n[Site "https://lichess.org/foolmate"]\n[White "a"]\n[Black "b"]\n'
+            '[TimeControl "-"]\n\n1. f3 e5 2. g4 Qh4 0-1'
+        )
+        expected = []
+        pgn_in = io.StringIO(dump)
+        game = chess.pgn.read_game(pgn_in)
+        while game:
+            expected.append(ParsedGame.from_pgn_game(game))
+            game = chess.pgn.read_game(pgn_in)
+        for _ in range(2):
+            # Again with the openings cached.
+            self.assertEqual(list(read_pgn_games(io.StringIO(dump))), expected)
+        self.assertEqual(expected[-3].moves, ["e2e4", "e7e5", "g1f3", "b8c6"])
+        self.assertIn("4. O-O Bc5", expected[-2].pgn)
+        self.assertIn("2. g4 Qh4#", expected[-1].pgn)
+
+    def test_invalid_games_are_skipped(self):
+        dump = "\n\n".join(
+            [
+                pgn_text(1),
+                '[Site "https://lichess.org/illegal1"]\n[White "a"]\n[Black "b"]\n'
+                '[TimeControl "-"]\n\n1. e4 e5 2. Ke3 *',
+                '[Site "https://lichess.org/variant1"]\n[White "a"]\n[Black "b"]\n'
+                '[TimeControl "-"]\n[Variant "Fairy"]\n\n1. e4 e5 *',
+                pgn_text(2),
+            ]
+        )
+        invalid = []
+        with self.assertLogs("chess.pgn", "ERROR"):
+            games = list(read_pgn_games(io.StringIO(dump), invalid))
+        self.assertEqual(
+            [game.lichess_id for game in games], ["pgn00000", "pgn00000", "pgn00001"]
+        )
+        self.assertEqual(
+            [headers["Site"][-8:] for headers, _ in invalid], ["illegal1", "variant1"]
+        )
+
+
+class TestGamePositions(TransactionTestCase):
+    def test_lookup_and_reindex(self):
+        import_pgn_to_db(io.StringIO(pgn_text(3)))
+        queen_pawn = zobrist_hashes(["d2d4", "d7d5"])[2]
+        self.assertEqual(GamePosition.objects.count(), 3 * 5)
+        self.assertEqual(GamePosition.games_reaching(queen_pawn).count(), 3)
+
+        # Reimporting with other moves replaces the game's positions.
+        import_pgn_to_db(io.StringIO(pgn_text(1).replace("1. d4 d5 2. c4 e6", "1. e4 e5 2. Nf3 Nc6")))
+        games = GamePosition.games_reaching(queen_pawn)
+        self.assertEqual(
+            set(games.values_list("lichess_id", flat=True)), {"pgn00001", "pgn00002"}
+        )
+        self.assertEqual(GamePosition.objects.count(), 3 * 5)
+
+    def test_hashes_by_game(self):
+        games = import_pgn_to_db(io.StringIO(pgn_text(2)))
+        Game.objects.filter(pk=games[1].pk).update(positions_indexed=False)
+        GamePosition.objects.filter(game=games[1]).delete()
+        games = list(Game.objects.filter(pk__in=[game.pk for game in games]))
+        expected = {game.pk: game.position_hashes() for game in games}
+        self.assertEqual(GamePosition.hashes_by_game(games), expected)
+        # The unindexed game was indexed, so it isn't replayed again.
+        with self.assertNumQueries(1):
+            self.assertEqual(GamePosition.hashes_by_game(games), expected)
+
+    def test_parallel_backfill(self):
+        import_pgn_to_db(io.StringIO(pgn_text(40)))
+        expected = set(GamePosition.objects.values_list("game", "ply", "zobrist"))
+        GamePosition.objects.filter(game__lichess_id__gte="pgn00010").delete()
+        # Left over from an interrupted run, to be replaced.
+        GamePosition.objects.filter(game__lichess_id="pgn00005", ply__gt=0).delete()
+        Game.objects.filter(lichess_id__gte="pgn00005").update(positions_indexed=False)
+        illegal = Game.objects.get(lichess_id="pgn00039")
+        illegal.moves = ["e2e5"]
+        illegal.save()
+        expected = {row for row in expected if row[0] != illegal.pk}
+
+        self.assertEqual(index_game_positions(workers=3, batch_size=4), 34 * 5)
+        self.assertEqual(
+            set(GamePosition.objects.values_list("game", "ply", "zobrist")), expected
+        )
+        self.assertFalse(Game.objects.filter(positions_indexed=False).exists())
+        self.assertEqual(index_game_positions(), 0)
+
+
+class TestPGNExport(TestCase):
+    def setUp(self):
+        import_pgn_to_db(io.StringIO(pgn_text(30)))
+        self.client.force_login(User.objects.create(username="moderator"))
+
+    def test_export_streams_pgns(self):
+        with self.assertNumQueries(2):
+            pgns = b"".join(
+                compressed(iter_pgns(exportable_games("White1"), chunk_size=4))
+            ).decode()
+        white1 = Game.objects.filter(white_player__username="white1").count()
+        self.assertEqual(pgns.count("[Event "), white1)
+
+    def test_endpoint(self):
+        response = self.client.get("/analysis/export.pgn?compression=gzip")
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            response["Content-Disposition"], 'attachment; filename="games.pgn.gz"'
+        )
+        pgns = gzip.decompress(b"".join(response.streaming_content)).decode()
+        self.assertEqual(pgns.count("[Event "), 30)
+
+        response = self.client.get("/analysis/export.pgn?player=nobody")
+        self.assertEqual(response.status_code, 400)
+        self.client.logout()
+        response = self.client.get("/analysis/export.pgn")
+        self.assertEqual(response.status_code, 302)
+
+
+class TestAcquireLoadTest(TransactionTestCase):
+    def test_refuses_shared_databases(self):
+        require_isolated_database()
+        self.assertFalse(is_isolated_database("sonder"))
+        with override_settings(BENCH_DATABASE="sonder"):
+            self.assertTrue(is_isolated_database("sonder"))
+            self.assertFalse(is_isolated_database("sonder_production"))
+        with override_settings(BENCH_DATABASE=""):
+            self.assertFalse(is_isolated_database(""))
+
+        name = connection.settings_dict["NAME"]
+        connection.settings_dict["NAME"] = "sonder"
+        try:
+            with self.assertRaises(UnsafeDatabase):
+                acquire_load_test(workers=1, games=1)
+        finally:
+            connection.settings_dict["NAME"] = name
+
+    def test_each_game_is_assigned_once(self):
+        result = acquire_load_test(workers=8, games=40)
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(result.acquired, 40)
+        self.assertEqual(result.double_assigned, 0)
+        self.assertEqual(result.summary()["acquires"], 48)
+        self.assertFalse(Game.objects.exists())
+
+    def test_endpoint_benchmark(self):
+        result = endpoint_benchmark(clients=3, reports=2, games=4, plies=20)
+        self.assertEqual(result["errors"], 0)
+        self.assertEqual(result["double_assigned"], 0)
+        self.assertEqual(result["completed_games"], 8)
+        self.assertEqual(result["endpoints"]["analysis"]["requests"], 8)
+        self.assertEqual(result["endpoints"]["acquire"]["statuses"]["204"], 3)
+        self.assertGreater(result["endpoints"]["acquire"]["queries_per_request"], 0)
+        json.dumps(result)
+
+
+class TestRequiredGameLeases(TestCase):
+    def setUp(self):
+        create_acquire_fixture("lease", 2)
+        self.source = AnalysisSource.objects.create(name="lease-source")
+
+    def test_expired_leases_are_reclaimed(self):
+        game = IrwinReportRequiredGame.assign_game(self.source)
+        self.assertGreater(game.lease_expires, timezone.now())
+        self.assertEqual(IrwinReportRequiredGame.reclaim_expired(), 0)
+
+        IrwinReportRequiredGame.objects.filter(pk=game.pk).update(
+            lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(IrwinReportRequiredGame.reclaim_expired(), 1)
+        game.refresh_from_db()
+        self.assertIsNone(game.owner)
+        self.assertIsNone(game.lease_expires)
+        self.assertEqual(IrwinReportRequiredGame.assign_game(self.source), game)
+
+    def test_stale_submissions_leave_reassigned_games_alone(self):
+        stale = IrwinReportRequiredGame.assign_game(self.source)
+        IrwinReportRequiredGame.objects.filter(pk=stale.pk).update(
+            lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+        IrwinReportRequiredGame.reclaim_expired()
+        other = AnalysisSource.objects.create(name="lease-other")
+        self.assertEqual(IrwinReportRequiredGame.assign_game(other), stale)
+
+        done = [{"skipped": True}] * 3
+        self.assertEqual(save_analyses(self.source, "sf11", [(stale, done)]), 0)
+        stale.refresh_from_db()
+        self.assertEqual(stale.owner, other)
+        self.assertFalse(stale.is_completed)
+
+
+class TestBatchFishnetAPI(TestCase):
+    def setUp(self):
+        create_acquire_fixture("batch", 5)
+        self.source = AnalysisSource.objects.create(
+            name="batch-source", use_for_irwin=True
+        )
+        self.fishnet = {
+            "fishnet": {"version": "1", "python": "3", "apikey": self.source.secret_token},
+            "stockfish": {"name": "sf11", "options": {}},
+        }
+
+    def post(self, url, body):
+        return self.client.post(url, json.dumps(body), content_type="application/json")
+
+    def test_acquire_and_submit_in_batches(self):
+        response = self.post("/analysis/acquire/batch?count=3", self.fishnet)
+        self.assertEqual(response.status_code, 202)
+        work_ids = [job["work"]["id"] for job in response.json()["jobs"]]
+        self.assertEqual(len(work_ids), 3)
+        self.assertEqual(
+            IrwinReportRequiredGame.objects.filter(owner=self.source).count(), 3
+        )
+
+        done = [{"skipped": True}] * 3
+        response = self.post(
+            "/analysis/analysis/batch",
+            {
+                **self.fishnet,
+                "analyses": [
+                    {"work_id": work_ids[0], "analysis": done},
+                    {"work_id": work_ids[1], "analysis": done},
+                    {"work_id": work_ids[2], "analysis": [None] * 3},
+                ],
+            },
+        )
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(len(response.json()["jobs"]), 2)
+        self.assertEqual(
+            IrwinReportRequiredGame.objects.filter(is_completed=True).count(), 2
+        )
+        self.assertEqual(GameAnalysis.objects.filter(is_completed=True).count(), 2)
+        self.assertEqual(
+            IrwinReportRequiredGame.objects.filter(owner=self.source).count(), 3
+        )
+
+        response = self.post(
+            f"/analysis/analysis/{work_ids[2]}", {**self.fishnet, "analysis": done}
+        )
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            IrwinReportRequiredGame.objects.filter(is_completed=True).count(), 3
+        )
+
+    def test_reacquired_job_skips_done_positions(self):
+        Game.objects.update(moves=["e2e4", "e7e5"] * 7)
+        response = self.post("/analysis/acquire", self.fishnet)
+        work_id = response.json()["work"]["id"]
+        self.assertEqual(response.json()["skipPositions"], list(range(10)))
+
+        progress = [{"skipped": True}] * 10 + [scored(1), scored(2)] + [None] * 3
+        response = self.post(
+            f"/analysis/analysis/{work_id}", {**self.fishnet, "analysis": progress}
+        )
+        self.assertEqual(response.status_code, 204)
+        self.post(f"/analysis/abort/{work_id}", self.fishnet)
+
+        response = self.post("/analysis/acquire/batch?count=5", self.fishnet)
+        jobs = {job["work"]["id"]: job for job in response.json()["jobs"]}
+        self.assertEqual(jobs[work_id]["skipPositions"], list(range(12)))
+
+    def test_known_positions_come_from_the_cache(self):
+        moves = "e2e4 e7e5 g1f3 b8c6 f1c4 f8c5 c2c3 g8f6 d2d3 d7d6 e1g1 e8g8".split()
+        first, second = IrwinReportRequiredGame.objects.order_by("pk")[:2]
+        Game.objects.filter(pk=first.game_id).update(
+            moves=moves + ["h2h3", "h7h6"], positions_indexed=False
+        )
+        Game.objects.filter(pk=second.game_id).update(
+            moves=moves + ["a2a3", "a7a6"], positions_indexed=False
+        )
+        first_job = self.post("/analysis/acquire", self.fishnet).json()
+        self.assertEqual(first_job["work"]["id"], f"irwin-{first.pk}")
+        analysis = [{"skipped": True}] * 10 + [scored(ply) for ply in range(10, 15)]
+        self.post(
+            f"/analysis/analysis/{first_job['work']['id']}?stop=true",
+            {**self.fishnet, "analysis": analysis},
+        )
+        self.assertEqual(PositionAnalysis.objects.count(), 5)
+
+        second_job = self.post("/analysis/acquire", self.fishnet).json()
+        self.assertEqual(second_job["skipPositions"], list(range(13)))
+        analysis = [{"skipped": True}] * 13 + [scored(-1), scored(-2)]
+        self.post(
+            f"/analysis/analysis/{second_job['work']['id']}?stop=true",
+            {**self.fishnet, "analysis": analysis},
+        )
+        game_analysis = GameAnalysis.objects.get(game=second.game_id)
+        self.assertTrue(game_analysis.is_completed)
+        self.assertEqual(
+            [position["score"]["cp"] for position in game_analysis.analysis[10:]],
+            [10, 11, 12, -1, -2],
+        )
+
+    @override_settings(JSONAPI_STREAM_MIN_BYTES=0)
+    def test_streamed_analysis_is_validated_per_ply(self):
+        work_id = self.post("/analysis/acquire", self.fishnet).json()["work"]["id"]
+        url = f"/analysis/analysis/{work_id}"
+        response = self.post(url, {**self.fishnet, "analysis": [None, {"depth": "1"}]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            json.loads(response.content), {"error": "'1' is not of type 'number'"}
+        )
+        response = self.client.post(
+            url, '{"analysis": [null, ', content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+        response = self.post(url, {"analysis": [None] * 3})
+        self.assertEqual(response.status_code, 400)
+        response = self.post(url, {**self.fishnet, "analysis": [{"skipped": True}] * 3})
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(IrwinReportRequiredGame.objects.get(pk=work_id[6:]).is_completed)
+
+    @override_settings(REQUEST_MEMORY_ACCOUNTING=True)
+    def test_memory_accounting(self):
+        client = Client()
+        with self.assertLogs("sonder.memory", "INFO") as logs:
+            response = client.post(
+                "/analysis/acquire",
+                json.dumps(self.fishnet),
+                content_type="application/json",
+            )
+        self.assertGreater(int(response["X-Memory-Peak-KiB"]), 0)
+        self.assertIn("POST /analysis/acquire 202 peak=", logs.output[0])
+
+    def test_sources_are_cached_until_saved(self):
+        self.assertEqual(AnalysisSource.from_token(self.source.secret_token), self.source)
+        with self.assertNumQueries(0):
+            AnalysisSource.from_token(self.source.secret_token)
+
+        self.source.use_for_irwin = False
+        self.source.save()
+        response = self.post("/analysis/acquire", self.fishnet)
+        self.assertEqual(response.status_code, 204)
+
+        self.source.delete()
+        response = self.post("/analysis/acquire", self.fishnet)
+        self.assertEqual(response.status_code, 404)
+
+    def test_unknown_sources_are_not_cached(self):
+        self.assertIsNone(AnalysisSource.from_token("not-yet"))
+        source = AnalysisSource.objects.create(
+            name="new-source", use_for_irwin=True, secret_token="not-yet"
+        )
+        self.assertEqual(AnalysisSource.from_token("not-yet"), source)
+
+
+class TestTTLCache(SimpleTestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache(10, maxsize=3, clock=lambda: self.now)
+
+    def test_entries_expire(self):
+        self.assertEqual(self.cache.get_or_set("a", lambda: 1), 1)
+        self.assertEqual(self.cache.get_or_set("a", lambda: 2), 1)
+        self.now = 10
+        self.assertEqual(self.cache.get_or_set("b", lambda: 3), 3)
+        self.assertEqual(list(self.cache.entries), ["b"])
+        self.assertEqual(self.cache.get_or_set("a", lambda: 2), 2)
+
+    def test_none_is_not_cached(self):
+        self.assertIsNone(self.cache.get_or_set("a", lambda: None))
+        self.assertEqual(self.cache.entries, {})
+
+    def test_size_is_bounded(self):
+        for i in range(5):
+            self.now = i
+            self.cache.get_or_set(i, lambda: i)
+        self.assertEqual(list(self.cache.entries), [2, 3, 4])
+
+
+def scored(cp):
+    return {"pv": "e2e4", "score": {"cp": cp}, "depth": 18}
+
+
+class TestMergeAnalysis(SimpleTestCase):
+    def test_partial_submissions_are_merged(self):
+        game_analysis = GameAnalysis()
+        skipped = {"skipped": True}
+        self.assertTrue(
+            game_analysis.merge_analysis([skipped] * 10 + [scored(1), None, None])
+        )
+        self.assertFalse(game_analysis.is_completed)
+        self.assertEqual(game_analysis.done_plies(), list(range(11)))
+
+        # A client told to skip the done positions sends them back as skipped.
+        self.assertTrue(game_analysis.merge_analysis([None] * 11 + [scored(2), None]))
+        self.assertFalse(game_analysis.merge_analysis([skipped] * 12 + [None]))
+        self.assertEqual(game_analysis.analysis[10], scored(1))
+        self.assertTrue(game_analysis.merge_analysis([skipped] * 12 + [scored(3)]))
+        self.assertTrue(game_analysis.is_completed)
+        self.assertEqual(game_analysis.done_plies(), list(range(13)))
+
+    def test_bitmap_of_existing_analysis(self):
+        game_analysis = GameAnalysis(analysis=[None] * 10 + [scored(1)] * 7)
+        self.assertEqual(game_analysis.done_plies(), list(range(10, 17)))
+
+
+class TestJobScheduling(TestCase):
+    def setUp(self):
+        white = Player.objects.create(username="white")
+        black = Player.objects.create(username="black")
+        self.reports = [
+            IrwinReport.objects.create(player=white, precedence=precedence)
+            for precedence in (1, 2, 2)
+        ]
+        lengths = {0: [30, 80], 1: [40, 100, 0, 20], 2: [120]}
+        for report, plies in lengths.items():
+            for i, length in enumerate(plies):
+                game = Game.objects.create(
+                    lichess_id=f"r{report}g{i}",
+                    white_player=white,
+                    black_player=black,
+                    moves=["e2e4"] * length,
+                )
+                IrwinReportRequiredGame.enqueue(self.reports[report], [game])
+        self.fast = AnalysisSource.objects.create(name="fast", use_for_irwin=True)
+        self.slow = AnalysisSource.objects.create(name="slow", use_for_irwin=True)
+        self.fast.record_nps(2e6)
+        self.slow.record_nps(5e5)
+
+    def test_reports_are_finished_one_at_a_time(self):
+        def lichess_ids(source, count):
+            return [
+                game.game.lichess_id
+                for game in IrwinReportRequiredGame.assign_games(source, count)
+            ]
+
+        self.assertEqual(lichess_ids(self.fast, 1), ["r1g1"])
+        self.assertEqual(lichess_ids(self.slow, 1), ["r1g3"])
+        self.assertEqual(lichess_ids(self.fast, 2), ["r1g0", "r2g0"])
+        self.assertEqual(lichess_ids(self.slow, 5), ["r0g0", "r0g1"])
+
+    def test_observed_nps(self):
+        self.assertTrue(self.slow.is_slow())
+        self.assertFalse(self.fast.is_slow())
+        for _ in range(20):
+            self.slow.record_nps(5e6)
+        self.slow.refresh_from_db()
+        self.assertGreater(self.slow.observed_nps, 4.9e6)
+        self.assertFalse(self.slow.is_slow())
+        # Sources find out they've become slow when they next report.
+        self.assertFalse(self.fast.is_slow())
+        self.fast.record_nps(2e6)
+        self.assertTrue(self.fast.is_slow())
+        self.assertTrue(AnalysisSource.objects.get(pk=self.fast.pk).is_slow())
+
+    def test_costs_are_the_positions_left(self):
+        moves = random_moves(random.Random(1), 30)
+        game = Game.objects.create(
+            lichess_id="costly",
+            white_player=Player.objects.get(username="white"),
+            black_player=Player.objects.get(username="black"),
+            moves=moves,
+        )
+        PositionAnalysis.store({game.position_hashes()[12]: {"score": {"cp": 0}}}, None)
+        [required_game] = IrwinReportRequiredGame.enqueue(self.reports[0], [game])
+        positions = len(moves) + 1
+        self.assertEqual(required_game.cost, positions - 10 - 1)
+
+        required_game.owner = self.fast
+        required_game.save()
+        game_analysis = GameAnalysis(
+            game=game, source=self.fast, stockfish_version="sf10"
+        )
+        game_analysis.merge_analysis([None] * 13 + [{"score": {"cp": 1}}] * 2)
+        game_analysis.save()
+        IrwinReportRequiredGame.requeue([required_game])
+        required_game.refresh_from_db()
+        self.assertIsNone(required_game.owner)
+        self.assertEqual(required_game.cost, positions - 10 - 1 - 2)
+
+
+class TestCompiledSchema(SimpleTestCase):
+    def setUp(self):
+        rng = random.Random(0)
+        self.payload = fishnet_analysis_payload(random_moves(rng, 40), rng)
+
+    def assertAgrees(self, schema, instance, valid):
+        compiled = jsonapi.CompiledSchema(schema)
+        self.assertEqual(compiled.is_valid(instance), valid)
+        self.assertEqual(compiled.validator.is_valid(instance), valid)
+        self.assertEqual(compiled.error(instance) is None, valid)
+
+    def test_agrees_with_jsonschema(self):
+        self.assertAgrees(FishnetAnalysis, self.payload, True)
+        self.assertAgrees(FishnetAnalysis, {**self.payload, "analysis": [None]}, True)
+        self.assertAgrees(
+            FishnetAnalysis, {**self.payload, "analysis": [{"depth": True}]}, False
+        )
+        self.assertAgrees(
+            FishnetAnalysis, {**self.payload, "analysis": [{"score": {"cp": "1"}}]}, False
+        )
+        self.assertAgrees(FishnetAnalysis, {"fishnet": self.payload["fishnet"]}, False)
+        self.assertAgrees(FishnetAnalysisBatch, {**self.payload, "analyses": []}, True)
+        job = {"work": {"type": "analysis", "id": "irwin-1"}, "position": "", "moves": ""}
+        self.assertAgrees(FishnetJob, {**job, "variant": "standard", "nodes": 1.5}, True)
+        self.assertAgrees(FishnetJob, {**job, "variant": "standard", "nodes": -1}, False)
+        self.assertAgrees(FishnetJob, job, False)
+
+    def test_stream_json_rejects_plies_before_the_end(self):
+        items = {"analysis.item": jsonapi.CompiledSchema(FishnetPositions["items"])}
+        body = json.dumps(self.payload).encode()
+        self.assertEqual(jsonapi.stream_json(io.BytesIO(body), items), self.payload)
+        body = b'{"analysis": [null, {"depth": "1"}, not json'
+        with self.assertRaises(jsonapi.InvalidItem):
+            jsonapi.stream_json(io.BytesIO(body), items, buf_size=16)
+
+    def test_unsupported_keywords_fall_back_to_jsonschema(self):
+        compiled = jsonapi.CompiledSchema({"type": "string", "pattern": "^a"})
+        self.assertEqual(compiled.is_valid, compiled.validator.is_valid)
+        self.assertIsNotNone(compiled.error("b"))
+
+
+class TestGraphQLQueries(TestCase):
+    def setUp(self):
+        players = [Player.objects.create(username=f"gql{i:02}") for i in range(30)]
+        Game.objects.bulk_create(
+            [
+                Game(
+                    lichess_id=f"gql{i}-{j}",
+                    white_player=players[i],
+                    black_player=players[(i + j + 1) % 30],
+                )
+                for i in range(30)
+                for j in range(3)
+            ]
+        )
+        CRReport.objects.bulk_create([CRReport(player=player) for player in players])
+        self.request = RequestFactory().post("/graphql/")
+        self.request.user = User.objects.create(username="gql-user")
+
+    def execute(self, query):
+        result = schema.execute(query, context_value=self.request)
+        self.assertIsNone(result.errors)
+        return result.data
+
+    def test_players_page_batches_relations(self):
+        query = """{
+            players(limit: 25, ordering: "username") {
+                username
+                totalGames
+                crreportSet { sampleSize }
+                gamesAsWhite { lichessId blackPlayer { username totalGames } }
+            }
+        }"""
+        # Players, their reports, their games and the games' black players.
+        with self.assertNumQueries(4):
+            players = self.execute(query)["players"]
+        self.assertEqual(len(players), 25)
+        self.assertEqual({player["totalGames"] for player in players}, {6})
+        self.assertEqual(len(players[0]["crreportSet"]), 1)
+        self.assertEqual(
+            sorted(game["blackPlayer"]["username"] for game in players[0]["gamesAsWhite"]),
+            ["gql01", "gql02", "gql03"],
+        )
+
+    def test_player_total_games(self):
+        with self.assertNumQueries(1):
+            player = self.execute('{ player(username: "gql05") { totalGames } }')
+        self.assertEqual(player, {"player": {"totalGames": 6}})
+
+    def test_players_keyset_pagination(self):
+        # Created last, but first by username.
+        Player.objects.create(username="gql-first")
+        query = """query ($after: String) {
+            players(limit: 10, username_Gt: $after) { username }
+        }"""
+        usernames = []
+        after = None
+        while True:
+            result = schema.execute(
+                query, variables={"after": after}, context_value=self.request
+            )
+            page = [player["username"] for player in result.data["players"]]
+            if not page:
+                break
+            usernames.extend(page)
+            after = page[-1]
+        self.assertEqual(usernames, ["gql-first"] + [f"gql{i:02}" for i in range(30)])
+
+    def test_players_benchmark(self):
+        result = players_benchmark(players=100, repeat=1)
+        self.assertEqual(result["players"], 130)
+        self.assertFalse(Player.objects.filter(username__startswith="benchplayers-"))
@@ -4,7 +4,10 @@ from . import views
 
 urlpatterns = [
     path("acquire", views.acquire, name="acquire"),
+    path("acquire/batch", views.acquire_batch, name="acquire_batch"),
+    path("analysis/batch", views.analysis_batch, name="analysis_batch"),
     path("analysis/<work_id>", views.analysis, name="analysis"),
     path("abort/<work_id>", views.abort, name="abort"),
     path("status", views.status, name="status"),
+    path("export.pgn", views.export_pgn, name="export_pgn"),
 ]
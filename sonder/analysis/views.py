@@ -1,13 +1,34 @@
-from pprint import pprint
+import statistics
 
-from django.http import HttpResponse, Http404
+from django.contrib.auth.decorators import login_required
+from django.db import transaction
+from django.http import HttpResponse, Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
+from django.utils import timezone
 from django.views.decorators.http import require_POST
 
 from .. import jsonapi
-from .schema import FishnetRequest, FishnetJob, FishnetAnalysis
-from .models import AnalysisSource, IrwinReportRequiredGame, GameAnalysis
+from .export import COMPRESSIONS, ExportError, compressed, exportable_games, iter_pgns
+from ..cr import cache_a1_results, invalidate_a1_results
+from .schema import (
+    FishnetRequest,
+    FishnetJob,
+    FishnetJobBatch,
+    FishnetAnalysis,
+    FishnetAnalysisBatch,
+)
+from .models import (
+    AnalysisSource,
+    IrwinReportRequiredGame,
+    GameAnalysis,
+    GamePosition,
+    PositionAnalysis,
+    OPENING_SKIP_POSITIONS,
+)
+
+# The most jobs handed out by a single request.
+MAX_BATCH_SIZE = 64
 
 def no_content():
     return HttpResponse(status=204)
@@ -16,28 +37,202 @@ def bad_request():
     return HttpResponse(status=400)
 
 def source_from_request(analysis):
-    return get_object_or_404(AnalysisSource, secret_token=analysis["fishnet"]["apikey"])
+    analysis_source = AnalysisSource.from_token(analysis["fishnet"]["apikey"])
+    if analysis_source is None:
+        raise Http404
+    return analysis_source
+
+
+def required_game_pk(work_id):
+    irwin, _, pk = work_id.partition("-")
+    if irwin != "irwin" or not pk.isdigit():
+        return None
+    return int(pk)
 
 
-def required_game_from_request(work_id, source=None):
-    [irwin, pk] = work_id.split("-", 1)
-    if irwin != "irwin":
-        return bad_request()
+def required_game_from_request(work_id, source=None, lock=False):
+    pk = required_game_pk(work_id)
+    if pk is None:
+        raise Http404
     kwargs = {"pk": pk}
     if source:
         kwargs["owner"] = source
-    return get_object_or_404(IrwinReportRequiredGame, **kwargs)
+    required_games = IrwinReportRequiredGame.objects.select_related("game")
+    if lock:
+        required_games = required_games.select_for_update(of=("self",))
+    return get_object_or_404(required_games, **kwargs)
+
+
+def assign_jobs(analysis_source, count):
+    """Claim count games, telling the client which positions it can skip.
+
+    Those are positions that are in the PositionAnalysis cache, and for a
+    game that went back into the queue, e.g. after an abort, the ones that
+    were already submitted for it.
+    """
+    games = IrwinReportRequiredGame.assign_games(analysis_source, count)
+    done_plies = GameAnalysis.done_plies_by_game(
+        [game.game_id for game in games], analysis_source
+    )
+    cached_plies = PositionAnalysis.cached_plies_by_game(
+        [game.game for game in games]
+    )
+    return [
+        game.job(
+            [*done_plies.get(game.game_id, ()), *cached_plies.get(game.game_id, ())]
+        )
+        for game in games
+    ]
 
 
 def job_for_source(analysis_source):
     if analysis_source.use_for_irwin:
-        game = IrwinReportRequiredGame.assign_game(analysis_source)
-        if game:
-            return game.job()
+        jobs = assign_jobs(analysis_source, 1)
+        if jobs:
+            return jobs[0]
+
+    return no_content()
+
+
+def jobs_for_source(analysis_source, count):
+    if analysis_source.use_for_irwin and count > 0:
+        jobs = assign_jobs(analysis_source, count)
+        if jobs:
+            return {"jobs": jobs}
 
     return no_content()
 
 
+def batch_count(request, default):
+    try:
+        count = int(request.GET.get("count", default))
+    except ValueError:
+        count = default
+    return max(0, min(count, MAX_BATCH_SIZE))
+
+
+def save_analyses(analysis_source, stockfish_version, submissions):
+    """Merge the analysis of several required games at once.
+
+    submissions are (required_game, analysis) pairs of required games owned
+    by analysis_source. Only analyses that changed are written. Completed
+    games are released, the leases of the others are renewed. Games the
+    source lost in the meantime, e.g. to reclaim_expired, are left as they
+    are. Returns the number of completed games.
+    """
+    now = timezone.now()
+    game_analyses = {
+        game_analysis.game_id: game_analysis
+        for game_analysis in GameAnalysis.objects.filter(
+            game_id__in=[required_game.game_id for required_game, _ in submissions],
+            source=analysis_source,
+        )
+    }
+    reported_nps = [
+        position["nps"]
+        for _, analysis in submissions
+        for position in analysis
+        if position is not None and position.get("nps")
+    ]
+    if reported_nps:
+        analysis_source.record_nps(statistics.median(reported_nps))
+    submissions = fill_from_position_cache(analysis_source, submissions)
+    changed = {}
+    # TODO: verify that we have the number of pvs that we wanted.
+    for required_game, analysis in submissions:
+        game_analysis = game_analyses.get(required_game.game_id)
+        if game_analysis is None:
+            game_analysis = game_analyses[required_game.game_id] = GameAnalysis(
+                game=required_game.game,
+                source=analysis_source,
+                stockfish_version=stockfish_version,
+            )
+        was_completed = game_analysis.is_completed
+        if (
+            game_analysis.merge_analysis(analysis)
+            or game_analysis.is_completed != was_completed
+            or game_analysis.pk is None
+        ):
+            game_analysis.date_modified = now
+            changed[required_game.game_id] = game_analysis
+
+        required_game.is_completed = game_analysis.is_completed
+        if required_game.is_completed:
+            required_game.release()
+        else:
+            required_game.renew_lease(save=False)
+        required_game.date_modified = now
+
+    with transaction.atomic():
+        # Ownership was checked without a lock, so it's checked again with
+        # one before the required games are written.
+        owned = set(
+            IrwinReportRequiredGame.objects.select_for_update()
+            .filter(
+                pk__in=[required_game.pk for required_game, _ in submissions],
+                owner=analysis_source,
+            )
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        submissions = [
+            (required_game, analysis)
+            for required_game, analysis in submissions
+            if required_game.pk in owned
+        ]
+        GameAnalysis.objects.bulk_create(
+            [ga for ga in changed.values() if ga.pk is None]
+        )
+        GameAnalysis.objects.bulk_update(
+            [ga for ga in changed.values() if ga.pk is not None],
+            [
+                "analysis",
+                "analysis_packed",
+                "done_bitmap",
+                "is_completed",
+                "date_modified",
+            ],
+        )
+        IrwinReportRequiredGame.objects.bulk_update(
+            [required_game for required_game, _ in submissions],
+            ["is_completed", "owner", "lease_expires", "date_modified"],
+        )
+        cache_a1_results([ga for ga in changed.values() if ga.is_completed])
+        invalidate_a1_results([ga for ga in changed.values() if not ga.is_completed])
+    return sum(required_game.is_completed for required_game, _ in submissions)
+
+
+def fill_from_position_cache(analysis_source, submissions):
+    """Fill positions the client skipped from the PositionAnalysis cache.
+
+    Positions the client did analyse are added to the cache in turn.
+    """
+    hashes = GamePosition.hashes_by_game(
+        [required_game.game for required_game, _ in submissions]
+    )
+    cached = PositionAnalysis.lookup(
+        h for game_hashes in hashes.values() for h in game_hashes
+    )
+    new_positions = {}
+    filled = []
+    for required_game, analysis in submissions:
+        game_hashes = hashes[required_game.game_id]
+        analysis = list(analysis)
+        for ply, h in enumerate(game_hashes[: len(analysis)]):
+            if ply in OPENING_SKIP_POSITIONS:
+                continue
+            position = analysis[ply]
+            if position is not None and position.get("score", None) is not None:
+                if h not in cached:
+                    new_positions[h] = position
+            elif h in cached:
+                analysis[ply] = cached[h]
+        filled.append((required_game, analysis))
+    if new_positions:
+        PositionAnalysis.store(new_positions, analysis_source)
+    return filled
+
+
 @csrf_exempt
 @require_POST
 @jsonapi.api(FishnetRequest, FishnetJob, status=202)
@@ -48,26 +243,26 @@ def acquire(request, fishnet_request):
 
 @csrf_exempt
 @require_POST
-@jsonapi.api(FishnetAnalysis, FishnetJob, status=202)
+@jsonapi.api(FishnetRequest, FishnetJobBatch, status=202)
+def acquire_batch(request, fishnet_request):
+    analysis_source = source_from_request(fishnet_request)
+    return jobs_for_source(analysis_source, batch_count(request, 1))
+
+
+@csrf_exempt
+@require_POST
+@jsonapi.api(
+    FishnetAnalysis, FishnetJob, status=202, stream_items=["analysis.item"]
+)
 def analysis(request, analysis, work_id):
     analysis_source = source_from_request(analysis)
     required_game = required_game_from_request(work_id, analysis_source)
     should_stop = request.GET.get("stop", "false") == "true"
-    is_completed = False
-    # TODO: verify that we have the number of pvs that we wanted.
-    game_analysis, _ = GameAnalysis.objects.get_or_create(
-        game=required_game.game,
-        source=analysis_source,
-        defaults={"stockfish_version": analysis["stockfish"]["name"],},
+    is_completed = save_analyses(
+        analysis_source,
+        analysis["stockfish"]["name"],
+        [(required_game, analysis["analysis"])],
     )
-    pprint(analysis['analysis'])
-    game_analysis.analysis = analysis["analysis"]
-    game_analysis.update_complete(required_game)
-    game_analysis.save()
-    is_completed = required_game.is_completed = game_analysis.is_completed
-    if is_completed:
-        required_game.owner = None
-    required_game.save()
 
     wants_next_job = is_completed and not should_stop
     return (
@@ -75,18 +270,78 @@ def analysis(request, analysis, work_id):
     )
 
 
+@csrf_exempt
+@require_POST
+@jsonapi.api(
+    FishnetAnalysisBatch,
+    FishnetJobBatch,
+    status=202,
+    stream_items=["analyses.item.analysis.item"],
+)
+def analysis_batch(request, analysis_batch):
+    """Submit the analysis of several jobs, and acquire their replacements.
+
+    Analyses for games the source no longer owns, e.g. because its lease
+    expired, are ignored. By default one new job is handed out per completed
+    game, ?count=N asks for N instead and ?stop=true for none.
+    """
+    analysis_source = source_from_request(analysis_batch)
+    analyses = {}
+    for submission in analysis_batch["analyses"]:
+        pk = required_game_pk(submission["work_id"])
+        if pk is None:
+            return bad_request()
+        analyses[pk] = submission["analysis"]
+    required_games = IrwinReportRequiredGame.objects.select_related("game").filter(
+        pk__in=analyses.keys(), owner=analysis_source
+    )
+    completed = save_analyses(
+        analysis_source,
+        analysis_batch["stockfish"]["name"],
+        [(required_game, analyses[required_game.pk]) for required_game in required_games],
+    )
+
+    if request.GET.get("stop", "false") == "true":
+        return no_content()
+    return jobs_for_source(analysis_source, batch_count(request, completed))
+
+
 @csrf_exempt
 @require_POST
 @jsonapi.api(FishnetRequest, status=202)
 def abort(request, analysis, work_id):
     analysis_source = source_from_request(analysis)
-    required_game = required_game_from_request(work_id, analysis_source)
-
-    IrwinReportRequiredGame.objects.filter(pk=required_game.pk).update(owner=None)
+    with transaction.atomic():
+        required_game = required_game_from_request(work_id, analysis_source, lock=True)
+        IrwinReportRequiredGame.requeue([required_game])
 
     return no_content()
 
 
+@login_required
+def export_pgn(request):
+    """Stream the PGNs of ?player's games, or of all games, as a download.
+
+    ?time_control filters by time control and ?compression=gzip|zstd
+    compresses the download.
+    """
+    compression = request.GET.get("compression", "none")
+    try:
+        games = exportable_games(
+            request.GET.get("player"), request.GET.get("time_control")
+        )
+        data = compressed(iter_pgns(games), compression)
+    except ExportError as e:
+        return HttpResponse(str(e), status=400, content_type="text/plain")
+    if compression == "none":
+        response = StreamingHttpResponse(data, content_type="application/x-chess-pgn")
+    else:
+        response = StreamingHttpResponse(data, content_type="application/octet-stream")
+    filename = f"{request.GET.get('player') or 'games'}.pgn{COMPRESSIONS[compression]}"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
 @csrf_exempt
 def status(request):
     # TODO: not sure if sonder needs to support this or not, probably not
@@ -0,0 +1,30 @@
+"""
+Benchmarks and load tests, run with python -m sonder.bench.
+
+They create and delete data in bulk, so they refuse to run against anything
+but a test database or the scratch database named by settings.BENCH_DATABASE.
+"""
+from django.conf import settings
+from django.db import connections
+from django.db.backends.base.creation import TEST_DATABASE_PREFIX
+
+
+class UnsafeDatabase(Exception):
+    pass
+
+
+def is_isolated_database(name):
+    """Whether the database called name may be used by the benchmarks."""
+    return name.startswith(TEST_DATABASE_PREFIX) or (
+        bool(settings.BENCH_DATABASE) and name == settings.BENCH_DATABASE
+    )
+
+
+def require_isolated_database(using="default"):
+    """Raise UnsafeDatabase unless the database is an isolated one."""
+    name = connections[using].settings_dict["NAME"]
+    if not is_isolated_database(name):
+        raise UnsafeDatabase(
+            f"Refusing to benchmark against the {name} database, set "
+            "BENCH_DATABASE to the name of a scratch database to use it"
+        )
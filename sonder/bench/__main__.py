@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Benchmark commands, kept apart from sonder's CLI as they fill and empty
+the database they are pointed at.
+"""
+import json
+import os
+
+import click
+import django
+
+from dotenv import load_dotenv
+
+load_dotenv()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sonder.settings")
+django.setup()
+
+# pylint: disable=locally-disabled, wrong-import-position
+from sonder.bench import UnsafeDatabase, require_isolated_database
+from sonder.bench.loadtest import (
+    acquire_load_test,
+    endpoint_benchmark,
+    jsonapi_benchmark,
+    pgn_ingest_benchmark,
+    players_benchmark,
+)
+
+
+@click.group()
+def cli():
+    try:
+        require_isolated_database()
+    except UnsafeDatabase as e:
+        raise click.ClickException(str(e))
+
+
+@cli.command(name="acquire")
+@click.option("--workers", default=200, help="Number of concurrent fishnet clients")
+@click.option("--games", default=5000, help="Number of games to acquire")
+def bench_acquire(workers, games):
+    """Load test /analysis/acquire's work queue against the database."""
+    result = acquire_load_test(workers=workers, games=games)
+    print(json.dumps(result.summary(), indent=2))
+
+
+@cli.command(name="endpoints")
+@click.option("--clients", default=20, help="Number of concurrent fishnet clients")
+@click.option("--reports", default=5, help="Number of irwin reports to seed")
+@click.option("--games", default=100, help="Number of games per report")
+@click.option("--plies", default=60, help="Average length of the seeded games")
+@click.option("--abort-rate", default=0.1, help="Fraction of jobs that are aborted")
+@click.option("--output", type=click.Path(), help="Also write the results to this file")
+def bench_endpoints(clients, reports, games, plies, abort_rate, output):
+    """Benchmark the fishnet acquire, analysis and abort endpoints."""
+    result = endpoint_benchmark(
+        clients=clients,
+        reports=reports,
+        games=games,
+        plies=plies,
+        abort_rate=abort_rate,
+    )
+    print(json.dumps(result, indent=2))
+    if output:
+        with open(output, "w") as fout:
+            json.dump(result, fout, indent=2)
+
+
+@cli.command(name="jsonapi")
+@click.option("--plies", default=150, help="Length of the submitted game")
+@click.option("--iterations", default=200, help="Number of timed calls")
+def bench_jsonapi(plies, iterations):
+    """Time parsing and validating a fishnet analysis submission."""
+    print(json.dumps(jsonapi_benchmark(plies=plies, iterations=iterations), indent=2))
+
+
+@cli.command(name="players")
+@click.option("--players", default=1000000, help="Number of players to insert")
+@click.option("--repeat", default=5, help="Number of timed runs of each query")
+@click.option("--output", type=click.Path(), help="Also write the results to this file")
+def bench_players(players, repeat, output):
+    """Time deep pages and username searches of the GraphQL players list."""
+    result = players_benchmark(players=players, repeat=repeat)
+    print(json.dumps(result, indent=2))
+    if output:
+        with open(output, "w") as fout:
+            json.dump(result, fout, indent=2)
+
+
+@cli.command(name="pgn-ingest")
+@click.option("--games", default=100000, help="Number of games in the dump")
+@click.option("--unique", default=2000, help="Number of distinct games in the dump")
+def bench_pgn_ingest(games, unique):
+    """Time parsing a league PGN dump for import."""
+    print(json.dumps(pgn_ingest_benchmark(games=games, unique=unique), indent=2))
+
+
+if __name__ == "__main__":
+    cli()
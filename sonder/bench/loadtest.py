@@ -0,0 +1,580 @@
+"""
+Load tests the work queue that fishnet clients acquire their jobs from, and
+benchmarks the fishnet endpoints in front of it.
+
+Everything that writes to the database first checks that it is an isolated
+one, see sonder.bench.require_isolated_database.
+"""
+from collections import Counter, defaultdict
+from dataclasses import dataclass, field
+import datetime
+import hashlib
+import io
+import json
+import math
+import random
+import statistics
+import threading
+import time
+from typing import Dict, List
+
+import chess
+import chess.pgn
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import Client, RequestFactory
+import jsonschema
+
+from sonder import jsonapi
+from sonder.analysis.models import (
+    AnalysisSource,
+    Game,
+    IrwinReport,
+    IrwinReportRequiredGame,
+    ParsedGame,
+    Player,
+    read_pgn_games,
+)
+from sonder.analysis.schema import FishnetAnalysis, FishnetJob
+from sonder.schema import schema
+from sonder.utils import opening_cache
+from . import require_isolated_database
+
+
+def percentile(sorted_values, p):
+    """The nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(p / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+@dataclass
+class AcquireLoadTestResult:
+    workers: int
+    games: int
+    elapsed: float
+    latencies: List[float] = field(default_factory=list)
+    acquired: int = 0
+    double_assigned: int = 0
+    errors: int = 0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+
+        def ms(p):
+            if not latencies:
+                return None
+            return round(percentile(latencies, p) * 1000, 2)
+
+        return {
+            "workers": self.workers,
+            "games": self.games,
+            "acquires": len(latencies),
+            "acquired": self.acquired,
+            "double_assigned": self.double_assigned,
+            "errors": self.errors,
+            "elapsed_s": round(self.elapsed, 3),
+            "acquires_per_s": round(len(latencies) / self.elapsed, 1)
+            if self.elapsed
+            else None,
+            "p50_ms": ms(50),
+            "p90_ms": ms(90),
+            "p99_ms": ms(99),
+            "max_ms": ms(100),
+        }
+
+
+def random_moves(rng, plies):
+    """A random legal game of at most plies plies, as uci moves."""
+    board = chess.Board()
+    moves = []
+    while len(moves) < plies and not board.is_game_over():
+        move = rng.choice(list(board.legal_moves))
+        board.push(move)
+        moves.append(move.uci())
+    return moves
+
+
+def create_acquire_fixture(name, games, reports=1, plies=None, seed=0):
+    """Create reports IrwinReports with games unassigned games each.
+
+    Everything is named after name. Games are two moves long, unless plies
+    is given, in which case they are random games of about that length.
+    """
+    require_isolated_database()
+    rng = random.Random(seed)
+    white, _ = Player.objects.get_or_create(username=f"{name}-white")
+    black, _ = Player.objects.get_or_create(username=f"{name}-black")
+    for r in range(reports):
+        report = IrwinReport.objects.create(player=white, precedence=1)
+        game_objs = Game.objects.bulk_create(
+            [
+                Game(
+                    lichess_id=f"{name}-{r}-{i}",
+                    white_player=white,
+                    black_player=black,
+                    moves=random_moves(rng, rng.randint(plies // 2, plies * 3 // 2))
+                    if plies
+                    else ["e2e4", "e7e5"],
+                )
+                for i in range(games)
+            ]
+        )
+        IrwinReportRequiredGame.enqueue(report, game_objs)
+    return report
+
+
+def delete_acquire_fixture(name):
+    require_isolated_database()
+    Game.objects.filter(lichess_id__startswith=f"{name}-").delete()
+    AnalysisSource.objects.filter(name__startswith=f"{name}-").delete()
+    IrwinReport.objects.filter(player__username=f"{name}-white").delete()
+    Player.objects.filter(username__startswith=f"{name}-").delete()
+
+
+def acquire_load_test(workers=200, games=5000, name="loadtest"):
+    """Have workers threads acquire games concurrently until none are left.
+
+    Each thread is a separate fishnet client with its own AnalysisSource and
+    database connection, so the database needs max_connections > workers.
+    The fixture data is removed again afterwards.
+    """
+    delete_acquire_fixture(name)
+    create_acquire_fixture(name, games)
+    sources = [
+        AnalysisSource.objects.create(name=f"{name}-{i}", use_for_irwin=True)
+        for i in range(workers)
+    ]
+    result = AcquireLoadTestResult(workers=workers, games=games, elapsed=0.0)
+    acquired = Counter()
+    lock = threading.Lock()
+    start = threading.Barrier(workers + 1)
+
+    def client(source):
+        latencies = []
+        claimed = []
+        errors = 0
+        try:
+            start.wait()
+            while True:
+                before = time.perf_counter()
+                try:
+                    game = IrwinReportRequiredGame.assign_game(source)
+                except Exception:  # pylint: disable=broad-except
+                    # Most likely out of connections, which won't get better.
+                    errors += 1
+                    break
+                latencies.append(time.perf_counter() - before)
+                if game is None:
+                    break
+                claimed.append(game.pk)
+        finally:
+            connections.close_all()
+            with lock:
+                result.latencies.extend(latencies)
+                result.errors += errors
+                acquired.update(claimed)
+
+    threads = [threading.Thread(target=client, args=(source,)) for source in sources]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    result.elapsed = time.perf_counter() - started
+    result.acquired = sum(acquired.values())
+    result.double_assigned = sum(count - 1 for count in acquired.values())
+    delete_acquire_fixture(name)
+    return result
+
+
+@dataclass
+class EndpointStats:
+    latencies: List[float] = field(default_factory=list)
+    queries: List[int] = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+
+    def add(self, other):
+        self.latencies.extend(other.latencies)
+        self.queries.extend(other.queries)
+        self.statuses.update(other.statuses)
+
+    def summary(self, elapsed):
+        latencies = sorted(self.latencies)
+        requests = len(latencies)
+        return {
+            "requests": requests,
+            "requests_per_s": round(requests / elapsed, 1) if elapsed else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2) if requests else None,
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2) if requests else None,
+            "queries_per_request": round(sum(self.queries) / requests, 2)
+            if requests
+            else None,
+            "statuses": {str(status): n for status, n in sorted(self.statuses.items())},
+        }
+
+
+def fishnet_positions(job, rng):
+    """A completed fishnet analysis for job, with made up evaluations."""
+    positions = len(job["moves"].split()) + 1
+    skip = set(job["skipPositions"])
+    return [
+        {"skipped": True}
+        if ply in skip
+        else {
+            "pv": "e2e4",
+            "score": {"cp": rng.randint(-300, 300)},
+            "depth": 18,
+            "nodes": job["nodes"],
+            "nps": rng.randint(1000000, 2000000),
+            "time": 3000,
+        }
+        for ply in range(positions)
+    ]
+
+
+def endpoint_benchmark(
+    clients=20, reports=5, games=100, plies=60, abort_rate=0.1, name="bench", seed=0
+):
+    """Drive acquire, analysis and abort with concurrent fishnet clients.
+
+    Requests go through django.test.Client in the client's own thread, so
+    they exercise the whole app (middleware, views and database) without
+    the noise of an HTTP server, and the queries each request makes can be
+    counted. A client aborts a job with probability abort_rate and otherwise
+    submits a completed analysis for it. The clients stop once the queue is
+    empty. Returns a JSON serialisable dict.
+    """
+    delete_acquire_fixture(name)
+    create_acquire_fixture(name, games, reports=reports, plies=plies, seed=seed)
+    sources = [
+        AnalysisSource.objects.create(name=f"{name}-{i}", use_for_irwin=True)
+        for i in range(clients)
+    ]
+    stats: Dict[str, EndpointStats] = defaultdict(EndpointStats)
+    # Jobs acquired and not aborted since. Completed jobs stay in here, as
+    # they must never be handed out again.
+    assigned = set()
+    double_assigned = 0
+    errors = 0
+    lock = threading.Lock()
+    start = threading.Barrier(clients + 1)
+    host = next((h for h in settings.ALLOWED_HOSTS if h != "*"), "localhost")
+
+    def client(i, source):
+        nonlocal double_assigned, errors
+        rng = random.Random(seed + i)
+        http = Client(HTTP_HOST=host)
+        fishnet = {
+            "fishnet": {"version": "bench", "python": "3", "apikey": source.secret_token},
+            "stockfish": {"name": "bench", "options": {}},
+        }
+        local = defaultdict(EndpointStats)
+        queries = []
+
+        def count_queries(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        def post(endpoint, url, body):
+            del queries[:]
+            before = time.perf_counter()
+            response = http.post(url, json.dumps(body), content_type="application/json")
+            local[endpoint].latencies.append(time.perf_counter() - before)
+            local[endpoint].queries.append(len(queries))
+            local[endpoint].statuses[response.status_code] += 1
+            return response
+
+        try:
+            with connection.execute_wrapper(count_queries):
+                start.wait()
+                while True:
+                    response = post("acquire", "/analysis/acquire", fishnet)
+                    if response.status_code != 202:
+                        break
+                    job = response.json()
+                    work_id = job["work"]["id"]
+                    with lock:
+                        if work_id in assigned:
+                            double_assigned += 1
+                        assigned.add(work_id)
+                    if rng.random() < abort_rate:
+                        # Let go before telling the server, which may hand
+                        # the job to someone else right away.
+                        with lock:
+                            assigned.discard(work_id)
+                        post("abort", f"/analysis/abort/{work_id}", fishnet)
+                    else:
+                        post(
+                            "analysis",
+                            f"/analysis/analysis/{work_id}?stop=true",
+                            {**fishnet, "analysis": fishnet_positions(job, rng)},
+                        )
+        except Exception:  # pylint: disable=broad-except
+            with lock:
+                errors += 1
+        finally:
+            connections.close_all()
+            with lock:
+                for endpoint, endpoint_stats in local.items():
+                    stats[endpoint].add(endpoint_stats)
+
+    threads = [
+        threading.Thread(target=client, args=(i, source))
+        for i, source in enumerate(sources)
+    ]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    completed = IrwinReportRequiredGame.objects.filter(
+        game__lichess_id__startswith=f"{name}-", is_completed=True
+    ).count()
+    delete_acquire_fixture(name)
+    return {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "config": {
+            "clients": clients,
+            "reports": reports,
+            "games": games,
+            "plies": plies,
+            "abort_rate": abort_rate,
+        },
+        "elapsed_s": round(elapsed, 3),
+        "completed_games": completed,
+        "double_assigned": double_assigned,
+        "errors": errors,
+        "endpoints": {
+            endpoint: stats[endpoint].summary(elapsed)
+            for endpoint in ("acquire", "analysis", "abort")
+        },
+    }
+
+
+def fishnet_analysis_payload(moves, rng):
+    """The body a fishnet client submits for a finished game."""
+    job = {
+        "moves": " ".join(moves),
+        "skipPositions": list(range(10)),
+        "nodes": 4500000,
+    }
+    return {
+        "fishnet": {"version": "bench", "python": "3", "apikey": "bench"},
+        "stockfish": {"name": "bench", "options": {}},
+        "analysis": fishnet_positions(job, rng),
+    }
+
+
+def jsonapi_benchmark(plies=150, iterations=200):
+    """Time what jsonapi does to a submitted analysis and the job it returns.
+
+    Compares json.loads and jsonschema.validate, which build a validator from
+    the schema on every call, with jsonapi's compiled schemas and fastest
+    available json parser. Returns a JSON serialisable dict of ms per call.
+    """
+    rng = random.Random(0)
+    moves = random_moves(rng, plies)
+    body = json.dumps(fishnet_analysis_payload(moves, rng)).encode()
+    job = {
+        "work": {"type": "analysis", "id": "irwin-1"},
+        "game_id": "bench",
+        "position": chess.STARTING_FEN,
+        "variant": "standard",
+        "skipPositions": list(range(10)),
+        "moves": " ".join(moves),
+        "nodes": 4500000,
+        "multipv": 5,
+    }
+    in_schema = jsonapi.CompiledSchema(FishnetAnalysis)
+    out_schema = jsonapi.CompiledSchema(FishnetJob)
+
+    def timed(run):
+        run()
+        started = time.perf_counter()
+        for _ in range(iterations):
+            run()
+        return round((time.perf_counter() - started) / iterations * 1000, 3)
+
+    def uncompiled():
+        jsonschema.validate(instance=json.loads(body), schema=FishnetAnalysis)
+        jsonschema.validate(instance=job, schema=FishnetJob)
+
+    def compiled():
+        assert in_schema.error(jsonapi.loads(body)) is None
+        if settings.JSONAPI_VALIDATE_RESPONSES:
+            assert out_schema.error(job) is None
+
+    return {
+        "plies": plies,
+        "body_bytes": len(body),
+        "json_backend": jsonapi.loads.__module__,
+        "validate_responses": settings.JSONAPI_VALIDATE_RESPONSES,
+        "uncompiled_ms": timed(uncompiled),
+        "compiled_ms": timed(compiled),
+        "parse_only_ms": timed(lambda: jsonapi.loads(body)),
+    }
+
+
+PLAYERS_PAGE_QUERY = """
+query ($offset: Int, $after: String, $search: String, $exact: String) {
+    players(
+        limit: 25
+        offset: $offset
+        ordering: "username"
+        username_Gt: $after
+        username_Icontains: $search
+        username_Iexact: $exact
+    ) {
+        username
+    }
+}
+"""
+
+
+def players_benchmark(players=1000000, repeat=5, name="benchplayers"):
+    """Time deep pages and username searches of the GraphQL players list.
+
+    Inserts players players, named name-<md5 of their number>, and queries
+    the list through the schema as a logged in user: the page 90% of the
+    way in by offset and by keyset (username_Gt), a substring search and an
+    exact search. Returns a JSON serialisable dict with the median ms of
+    each. The players are removed again afterwards.
+    """
+
+    require_isolated_database()
+
+    def username(i):
+        return f"{name}-{hashlib.md5(str(i).encode()).hexdigest()}"
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM analysis_player WHERE username LIKE %s", [f"{name}-%"]
+        )
+        cursor.execute(
+            "INSERT INTO analysis_player (username)"
+            " SELECT %s || '-' || md5(i::text) FROM generate_series(1, %s) i",
+            [name, players],
+        )
+        cursor.execute("ANALYZE analysis_player")
+        cursor.execute("SELECT count(*) FROM analysis_player")
+        (total,) = cursor.fetchone()
+        offset = total * 9 // 10
+        cursor.execute(
+            "SELECT username FROM analysis_player ORDER BY username OFFSET %s LIMIT 1",
+            [offset - 1],
+        )
+        (after,) = cursor.fetchone()
+        cursor.execute(
+            "SELECT 1 FROM pg_indexes WHERE indexname = 'player_username_upper_trgm'"
+        )
+        trigram_index = cursor.fetchone() is not None
+
+    request = RequestFactory().post("/graphql/")
+    request.user, _ = User.objects.get_or_create(username=f"{name}-user")
+
+    def timed(**variables):
+        runs = []
+        for _ in range(repeat + 1):
+            before = time.perf_counter()
+            result = schema.execute(
+                PLAYERS_PAGE_QUERY, variables=variables, context_value=request
+            )
+            runs.append(time.perf_counter() - before)
+            if result.errors:
+                raise result.errors[0]
+        # The first run warms the caches.
+        return round(statistics.median(runs[1:]) * 1000, 2)
+
+    needle = username(players // 2)
+    try:
+        return {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "players": total,
+            "trigram_index": trigram_index,
+            "offset_page_ms": timed(offset=offset),
+            "keyset_page_ms": timed(after=after),
+            "icontains_ms": timed(search=needle[-12:-4]),
+            "iexact_ms": timed(exact=needle.upper()),
+        }
+    finally:
+        request.user.delete()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "DELETE FROM analysis_player WHERE username LIKE %s", [f"{name}-%"]
+            )
+
+
+def league_dump(games, unique=2000, openings=50, plies=80, seed=0):
+    """A PGN dump of games lichess games, like a league's.
+
+    Games start with one of a few openings and carry clock comments, the
+    way lichess exports them. Only unique of them are distinct, the others
+    repeat those under a different Site.
+    """
+    rng = random.Random(seed)
+    lines = [random_moves(rng, rng.randint(6, 16)) for _ in range(openings)]
+    pgns = []
+    for i in range(unique):
+        board = chess.Board()
+        game = chess.pgn.Game()
+        game.headers["White"] = f"white{i % 97}"
+        game.headers["Black"] = f"black{i % 89}"
+        game.headers["TimeControl"] = "2700+45"
+        node = game
+        for uci in rng.choice(lines):
+            node = node.add_variation(chess.Move.from_uci(uci))
+            node.comment = "[%clk 0:45:00]"
+            board.push(node.move)
+        while board.ply() < plies and not board.is_game_over():
+            move = rng.choice(list(board.legal_moves))
+            node = node.add_variation(move)
+            node.comment = f"[%clk 0:{rng.randint(10, 44)}:00]"
+            board.push(move)
+        game.headers["Result"] = board.result()
+        pgns.append(str(game))
+    return "\n\n".join(
+        pgns[i % unique].replace(
+            '[Site "?"]', f'[Site "https://lichess.org/{i:08}"]', 1
+        )
+        for i in range(games)
+    )
+
+
+def pgn_ingest_benchmark(games=100000, unique=2000):
+    """Time turning a league dump into ParsedGames, without the database.
+
+    Compares parsing with chess.pgn's GameBuilder and re-exporting the game,
+    as imports used to, with read_pgn_games. Returns a JSON serialisable
+    dict of games per second.
+    """
+    dump = league_dump(games, unique=unique)
+
+    def game_builder():
+        pgn_in = io.StringIO(dump)
+        game = chess.pgn.read_game(pgn_in)
+        while game:
+            yield ParsedGame.from_pgn_game(game)
+            game = chess.pgn.read_game(pgn_in)
+
+    def timed(parse):
+        started = time.perf_counter()
+        count = sum(1 for _ in parse())
+        elapsed = time.perf_counter() - started
+        assert count == games
+        return round(games / elapsed, 1)
+
+    opening_cache.clear()
+    return {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "games": games,
+        "dump_bytes": len(dump),
+        "game_builder_games_per_s": timed(game_builder),
+        "ingest_visitor_games_per_s": timed(lambda: read_pgn_games(io.StringIO(dump))),
+        "opening_cache_size": opening_cache.size,
+    }
@@ -1,6 +1,9 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from functools import partial
+from itertools import groupby, repeat
+from multiprocessing import get_context
 from operator import eq, lt
 from dataclasses import dataclass, field, asdict
 from .pyutils import DefaultDictInt
@@ -9,20 +12,30 @@ from typing import List, Tuple, DefaultDict, Optional
 from tqdm import tqdm
 
 import click
+import hashlib
 import json
 import math
+import numpy as np
+import sqlite3
 import subprocess
 import tempfile
+import time
 
 
 from django.contrib.auth.models import User
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
 from sonder.analysis.models import (
     AnalysisSource,
     Player,
     Game,
     GameAnalysis,
-    CRReport
+    CRReport,
+    CRGameResult,
 )
+from sonder.analysis.packed import PackedAnalysis, NULL32
+from sonder.utils import batches
 
 cr_export_sql_template = """
 .mode csv
@@ -55,12 +68,51 @@ def process_csv(taskname, filename,  callback):
         for line in progress:
             callback(*line.strip().split(","))
         progress.close()
+    return progress.n
+
+def report_rate(title, rows, started):
+    elapsed = time.monotonic() - started
+    rate = rows / elapsed if elapsed > 0 else float(rows)
+    click.secho(f"✓ {title} ({rows} rows, {rate:.0f} rows/s)", fg='green')
 
 def color_move_to_ply(color, move):
     if color == 'w':
         return (move-1)*2+1
     return move*2
 
+def cr_moves_to_analysis(cr_analysis):
+    """Convert a ply -> CR move row mapping into the GameAnalysis.analysis format.
+    """
+    moves  = list(sorted([(int(k), v) for k,v in cr_analysis.items()]))
+    last_move_number, _ = moves[-1]
+
+    def empty_move(num):
+        return {
+            'move': num,
+            'pvs': [],
+            "cr": {}
+        }
+    sonder_analysis = [empty_move(i+1) for i in range(last_move_number)]
+    for move_number, cr_move_analysis in moves:
+        move_analysis = sonder_analysis[move_number-1]
+        move_analysis["nodes"] = cr_move_analysis["nodes"]
+        move_analysis["cr"].update({
+            "played_eval": cr_move_analysis['played_eval'],
+            "played_rank": cr_move_analysis['played_rank'],
+            "masterdb_matches": cr_move_analysis['masterdb_matches'],
+        })
+
+        def pv(cp):
+            return {"pv": "", "score": { "cp": cp, "mate": None }}
+        move_analysis['pvs'] = [
+            pv(cr_move_analysis["pv1_eval"]),
+            pv(cr_move_analysis["pv2_eval"]),
+            pv(cr_move_analysis["pv3_eval"]),
+            pv(cr_move_analysis["pv4_eval"]),
+            pv(cr_move_analysis["pv5_eval"])
+        ]
+    return sonder_analysis
+
 def import_cr_database(database, analysis_source, stockfish_version):
     with tempfile.TemporaryDirectory() as base_dir:
         # Export the tables that we need
@@ -75,16 +127,18 @@ def import_cr_database(database, analysis_source, stockfish_version):
         def process_player(old_player_id, username):
             player, _ = Player.objects.get_or_create(username=username.strip())
             players_by_old_id[old_player_id] = player
-        process_csv("Loading players", f"{base_dir}/player.csv", process_player)
-        click.secho("✓ Players Loaded", fg='green')
+        started = time.monotonic()
+        rows = process_csv("Loading players", f"{base_dir}/player.csv", process_player)
+        report_rate("Players Loaded", rows, started)
 
         players_by_lichess_game_id = defaultdict(lambda: dict((("w", None), ("b", None))))
 
         def process_gameplayer(_, lichess_id, color, player_id):
             player = players_by_old_id[player_id]
             players_by_lichess_game_id[lichess_id][color] = player
-        process_csv("Loading Game Players", f"{base_dir}/gameplayer.csv", process_gameplayer)
-        click.secho("✓ GamePlayers Loaded", fg='green')
+        started = time.monotonic()
+        rows = process_csv("Loading Game Players", f"{base_dir}/gameplayer.csv", process_gameplayer)
+        report_rate("GamePlayers Loaded", rows, started)
 
         game_analysis_completed = {}
 
@@ -104,8 +158,9 @@ def import_cr_database(database, analysis_source, stockfish_version):
             game.black_player = players['b']
             game.save()
             game_analysis_completed[game.lichess_id] = completed
-        process_csv("Loading Games", f"{base_dir}/game.csv", process_game)
-        click.secho("✓ Games Loaded", fg='green')
+        started = time.monotonic()
+        rows = process_csv("Loading Games", f"{base_dir}/game.csv", process_game)
+        report_rate("Games Loaded", rows, started)
 
         game_analysis = defaultdict(lambda: defaultdict(dict))
 
@@ -126,10 +181,12 @@ def import_cr_database(database, analysis_source, stockfish_version):
                 'nodes': nodes,
                 'masterdb_matches': masterdb_matches,
             })
-        process_csv("Loading Moves", f"{base_dir}/move.csv", process_move)
-        click.secho("✓ Moves Loaded", fg='green')
+        started = time.monotonic()
+        rows = process_csv("Loading Moves", f"{base_dir}/move.csv", process_move)
+        report_rate("Moves Loaded", rows, started)
 
         analysis_source, _ = AnalysisSource.objects.get_or_create(name=analysis_source)
+        started = time.monotonic()
         progress = tqdm(game_analysis.items(), "Processing analysis", leave=False)
         for game_id, cr_analysis in progress:
             game = Game.objects.get(lichess_id=game_id)
@@ -142,39 +199,175 @@ def import_cr_database(database, analysis_source, stockfish_version):
                     "is_completed": game_analysis_completed.get(game_id, False)
                 }
             )
-            moves  = list(sorted([(int(k), v) for k,v in cr_analysis.items()]))
-            last_move_number, _ = moves[-1]
-
-            def empty_move(num):
-                return {
-                    'move': num,
-                    'pvs': [],
-                    "cr": {}
-                }
-            sonder_analysis = [empty_move(i+1) for i in range(last_move_number)]
-            for move_number, cr_move_analysis in moves:
-                move_analysis = sonder_analysis[move_number-1]
-                move_analysis.update({
-                    "played_eval": cr_move_analysis['played_eval'],
-                    "played_rank": cr_move_analysis['played_rank'],
-                    "nodes": cr_move_analysis["nodes"],
-                    "masterdb_matches": cr_move_analysis['masterdb_matches'],
-                })
-
-                def pv(cp):
-                    return {"pv": "", "score": { "cp": cp, "mate": None }}
-                move_analysis['pvs'] = [
-                    pv(cr_move_analysis["pv1_eval"]),
-                    pv(cr_move_analysis["pv2_eval"]),
-                    pv(cr_move_analysis["pv3_eval"]),
-                    pv(cr_move_analysis["pv4_eval"]),
-                    pv(cr_move_analysis["pv5_eval"])
-                ]
-
-            game_analysis.analysis = sonder_analysis
+            game_analysis.set_analysis(cr_moves_to_analysis(cr_analysis))
             game_analysis.save()
+            cache_a1_results([game_analysis])
         progress.close()
-        click.secho("✓ Analysis Loaded", fg='green')
+        report_rate("Analysis Loaded", progress.n, started)
+
+
+def stream_sqlite_rows(connection, sql, batch_size):
+    """Iterate over the rows of a query, fetching batch_size rows at a time.
+
+    sqlite steps through the result as we fetch, so this never materializes
+    the whole table in memory.
+    """
+    cursor = connection.execute(sql)
+    try:
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            yield from rows
+            rows = cursor.fetchmany(batch_size)
+    finally:
+        cursor.close()
+
+cr_bulk_game_sql = """
+SELECT g.id, g.is_analyzed, w.username, b.username
+FROM game g
+LEFT JOIN gameplayer gw ON gw.game_id = g.id AND gw.color = 'w'
+LEFT JOIN player w ON w.id = gw.player_id
+LEFT JOIN gameplayer gb ON gb.game_id = g.id AND gb.color = 'b'
+LEFT JOIN player b ON b.id = gb.player_id
+"""
+
+cr_bulk_move_sql = """
+SELECT game_id, color, number, pv1_eval, pv2_eval, pv3_eval, pv4_eval, pv5_eval,
+       played_eval, played_rank, nodes, masterdb_matches
+FROM move
+ORDER BY game_id
+"""
+
+def import_cr_database_bulk(database, analysis_source, stockfish_version, batch_size=1000):
+    """Import a ChessReanalysis database without going through per-row ORM calls.
+
+    Reads the sqlite file directly and streams each table in batches of
+    batch_size rows, resolving existing rows with a single IN query per batch
+    and writing with bulk_create/bulk_update.
+    """
+    connection = sqlite3.connect(database)
+    try:
+        started = time.monotonic()
+        players_by_username = {}
+        usernames = (
+            username.strip()
+            for (username,) in stream_sqlite_rows(connection, "SELECT username FROM player", batch_size)
+        )
+        rows = 0
+        for batch in batches(tqdm(usernames, "Loading players", leave=False), batch_size):
+            rows += len(batch)
+            with transaction.atomic():
+                existing = Player.objects.filter(username__in=batch).in_bulk(field_name="username")
+                missing = {
+                    username: Player(username=username)
+                    for username in batch if username not in existing
+                }
+                Player.objects.bulk_create(missing.values())
+            players_by_username.update(existing)
+            players_by_username.update(missing)
+        report_rate("Players Loaded", rows, started)
+
+        started = time.monotonic()
+        game_ids = {}
+        game_analysis_completed = {}
+        rows = 0
+        game_rows = stream_sqlite_rows(connection, cr_bulk_game_sql, batch_size)
+        for batch in batches(tqdm(game_rows, "Loading Games", leave=False), batch_size):
+            rows += len(batch)
+            players = {}
+            for game_id, completed, white, black in batch:
+                if white is None and black is None:
+                    print(f"Missing players for game: {game_id}")
+                    continue
+                if white is None or black is None:
+                    raise AssertionError("Missing players")
+                players[game_id.strip()] = (
+                    players_by_username[white.strip()],
+                    players_by_username[black.strip()],
+                )
+                game_analysis_completed[game_id.strip()] = completed == 1
+            with transaction.atomic():
+                existing = Game.objects.filter(lichess_id__in=players.keys()).only(
+                    "id", "lichess_id", "white_player", "black_player"
+                ).in_bulk(field_name="lichess_id")
+                created = []
+                for lichess_id, (white, black) in players.items():
+                    game = existing.get(lichess_id)
+                    if game is None:
+                        game = Game(lichess_id=lichess_id)
+                        created.append(game)
+                    game.white_player = white
+                    game.black_player = black
+                Game.objects.bulk_update(existing.values(), ["white_player", "black_player"])
+                Game.objects.bulk_create(created)
+            game_ids.update((g.lichess_id, g.pk) for g in existing.values())
+            game_ids.update((g.lichess_id, g.pk) for g in created)
+        report_rate("Games Loaded", rows, started)
+
+        analysis_source, _ = AnalysisSource.objects.get_or_create(name=analysis_source)
+
+        def cr_analyses():
+            move_rows = stream_sqlite_rows(connection, cr_bulk_move_sql, batch_size)
+            for game_id, game_moves in groupby(move_rows, key=lambda row: row[0]):
+                cr_analysis = defaultdict(dict)
+                for (_, color, number, pv1_eval, pv2_eval, pv3_eval, pv4_eval, pv5_eval,
+                        played_eval, played_rank, nodes, masterdb_matches) in game_moves:
+                    cr_analysis[color_move_to_ply(color, number)].update({
+                        'pv1_eval': pv1_eval,
+                        'pv2_eval': pv2_eval,
+                        'pv3_eval': pv3_eval,
+                        'pv4_eval': pv4_eval,
+                        'pv5_eval': pv5_eval,
+                        'played_eval': played_eval,
+                        'played_rank': played_rank,
+                        'nodes': nodes,
+                        'masterdb_matches': masterdb_matches,
+                    })
+                yield game_id.strip(), cr_analysis
+
+        started = time.monotonic()
+        rows = 0
+        skipped = 0
+        for batch in batches(tqdm(cr_analyses(), "Loading Analysis", leave=False), batch_size):
+            analyses = {}
+            for game_id, cr_analysis in batch:
+                rows += len(cr_analysis)
+                if game_id not in game_ids:
+                    skipped += 1
+                    continue
+                analyses[game_ids[game_id]] = (game_id, cr_moves_to_analysis(cr_analysis))
+            with transaction.atomic():
+                existing = {
+                    game_analysis.game_id: game_analysis
+                    for game_analysis in GameAnalysis.objects.filter(
+                        game_id__in=analyses.keys(),
+                        source=analysis_source,
+                        stockfish_version=stockfish_version,
+                    ).only("id", "game_id")
+                }
+                created = []
+                for game_pk, (game_id, analysis) in analyses.items():
+                    game_analysis = existing.get(game_pk)
+                    if game_analysis is None:
+                        game_analysis = GameAnalysis(
+                            game_id=game_pk,
+                            source=analysis_source,
+                            stockfish_version=stockfish_version,
+                            is_completed=game_analysis_completed.get(game_id, False),
+                        )
+                        created.append(game_analysis)
+                    game_analysis.set_analysis(analysis)
+                    game_analysis.date_modified = timezone.now()
+                GameAnalysis.objects.bulk_update(
+                    existing.values(),
+                    ["analysis", "analysis_packed", "done_bitmap", "date_modified"],
+                )
+                GameAnalysis.objects.bulk_create(created)
+                cache_a1_results([*existing.values(), *created])
+        if skipped:
+            click.secho(f"✘ Skipped analysis for {skipped} games missing from the game table", fg='red')
+        report_rate("Analysis Loaded", rows, started)
+    finally:
+        connection.close()
 
 #Notes:
 #ChessReanalysis structures
@@ -197,12 +390,46 @@ _cp_loss_ops = [partial(eq,0)] + [partial(lt, cp_incr) for cp_incr in _cp_loss_i
 
 
 
-def get_analysed_game_pgns_from_db(gameids):
+@dataclass
+class WorkingGame:
+    white_player: Player
+    black_player: Player
+    analysis_id: int
+    # The JSON analysis or a PackedAnalysis, None until loaded
+    analysis: object = None
+
+
+def get_analysed_game_pgns_from_db(gameids, with_analysis=True):
+    """Load the analysis and players of each game in a single query.
+
+    The working set is ordered like gameids so that reports come out the same
+    regardless of how the database returns the rows. Without with_analysis
+    only the players are loaded, see load_working_set_analysis.
+    """
     working_set = {}
-    for analysis in GameAnalysis.objects.filter(game__lichess_id__in=gameids).select_related('game'):
-        working_set[analysis.game.lichess_id] = analysis.analysis
-            #TODO: ensure all games are fully analysed here, ^ this only ensures analysis started
-    return working_set
+    fields = [
+        "game__lichess_id",
+        "game__white_player__username",
+        "game__black_player__username",
+    ]
+    if with_analysis:
+        fields += ["analysis", "analysis_packed"]
+    analyses = (
+        GameAnalysis.objects.filter(game__lichess_id__in=gameids)
+        .select_related("game__white_player", "game__black_player")
+        .only(*fields)
+        .order_by("pk")
+    )
+    for analysis in analyses:
+        game = analysis.game
+        working_set[game.lichess_id] = WorkingGame(
+            game.white_player,
+            game.black_player,
+            analysis.pk,
+            analysis.analysis_view() if with_analysis else None,
+        )
+        #TODO: ensure all games are fully analysed here, ^ this only ensures analysis started
+    return {gid: working_set[gid] for gid in gameids if gid in working_set}
 
 
 def int_or_none(val):
@@ -261,9 +488,7 @@ class Move:
 
     @property
     def played_rank(self):
-        if self.move_analysis['cr']['played_rank'] == "":
-            return None
-        return int(self.move_analysis['cr']['played_rank'])
+        return int_or_none(self.move_analysis['cr']['played_rank'])
         #Look up which move they played, if it's in the pv list us it, if it's not there, use len(pvs)+1
 
     @property
@@ -357,26 +582,191 @@ class A1Report:
         self.by_player = defaultdict(PgnSpyResult)
         self.by_game = defaultdict(PgnSpyResult)
 
-def generate_a1_report(working_set) -> A1Report:
+def config_hash(config, engine):
+    """Identifies the cached results of a config, computed by engine.
+
+    The engines reject the same games but are free to differ otherwise, so
+    each has its own results.
+    """
+    key = json.dumps([config, engine], sort_keys=True)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def load_working_set_analysis(working_set):
+    missing = {
+        working_game.analysis_id: working_game
+        for working_game in working_set.values()
+        if working_game.analysis is None
+    }
+    if not missing:
+        return
+    analyses = GameAnalysis.objects.filter(pk__in=missing.keys()).only(
+        "analysis", "analysis_packed"
+    )
+    for analysis in analyses:
+        missing[analysis.pk].analysis = analysis.analysis_view()
+
+
+# Raised by the engines for analysis the report can't be computed from,
+# e.g. fishnet analysis without CR data, or NaN evaluations.
+UNUSABLE_ANALYSIS_ERRORS = (KeyError, IndexError, TypeError, ValueError)
+
+
+def compute_a1_results(working_set, config, engine="python"):
+    """The A1 result for each (game id, colour) in the working set.
+
+    Games whose analysis is unusable are left out.
+    """
+    prepare, run_a1_game = a1_engines[engine]
+    load_working_set_analysis(working_set)
+    results = {}
+    for gid, working_game in working_set.items():
+        try:
+            moves = prepare(working_game.analysis)
+            white = run_a1_game(gid, config, moves, 'w', working_game.white_player)
+            black = run_a1_game(gid, config, moves, 'b', working_game.black_player)
+        except UNUSABLE_ANALYSIS_ERRORS:
+            continue
+        results[gid, 'w'] = white
+        results[gid, 'b'] = black
+    return results
+
+
+def cached_a1_results(working_set, config, engine="python"):
+    """Like compute_a1_results, but reusing and filling the CRGameResult cache."""
+    results = {}
+    h = config_hash(config, engine)
+    gid_by_analysis_id = {
+        working_game.analysis_id: gid for gid, working_game in working_set.items()
+    }
+    # Rows older than their analysis were computed from a previous version
+    # of it that was saved without going through cache_a1_results.
+    cached = CRGameResult.objects.filter(
+        game_analysis_id__in=gid_by_analysis_id.keys(),
+        config_hash=h,
+        date_created__gte=F("game_analysis__date_modified"),
+    )
+    for row in cached:
+        gid = gid_by_analysis_id[row.game_analysis_id]
+        results[gid, row.color] = PgnSpyResult(
+            game_list=[gid],
+            cp_loss_count=DefaultDictInt(row.cp_loss_count),
+            **{attr: getattr(row, attr) for attr in CRGameResult.copy_attrs},
+        )
+
+    missing = {
+        gid: working_game
+        for gid, working_game in working_set.items()
+        if (gid, 'w') not in results or (gid, 'b') not in results
+    }
+    if missing:
+        computed = compute_a1_results(missing, config, engine)
+        CRGameResult.objects.filter(
+            game_analysis_id__in=[w.analysis_id for w in missing.values()],
+            config_hash=h,
+        ).delete()
+        CRGameResult.objects.bulk_create(
+            [
+                CRGameResult.from_result(missing[gid].analysis_id, color, h, result)
+                for (gid, color), result in computed.items()
+            ],
+            ignore_conflicts=True,
+        )
+        results.update(computed)
+    return results
+
+
+def cache_a1_results(game_analyses, engine="numpy"):
+    """Replace the cached A1 results of the given (saved) GameAnalysis objects.
+
+    Unusable analyses (see UNUSABLE_ANALYSIS_ERRORS) just have their cached
+    results removed.
+    """
     config = json.loads(CR_CONFIG)
-    report = A1Report()
+    h = config_hash(config, engine)
+    prepare, run_a1_game = a1_engines[engine]
+    rows = []
+    for game_analysis in game_analyses:
+        try:
+            moves = prepare(game_analysis.analysis_view())
+            results = [
+                CRGameResult.from_result(
+                    game_analysis.pk, color, h, run_a1_game(None, config, moves, color, None)
+                )
+                for color in ('w', 'b')
+            ]
+        except UNUSABLE_ANALYSIS_ERRORS:
+            continue
+        rows.extend(results)
+    with transaction.atomic():
+        invalidate_a1_results(game_analyses)
+        CRGameResult.objects.bulk_create(rows)
+
+
+def invalidate_a1_results(game_analyses):
+    CRGameResult.objects.filter(
+        game_analysis_id__in=[game_analysis.pk for game_analysis in game_analyses]
+    ).delete()
+
 
-    working_set.update({
-        gid: [Move(a) for a in analysis]
-        for gid, analysis in working_set.items()
-    })
+def generate_a1_report(working_set, engine="python", use_cache=False) -> A1Report:
+    config = json.loads(CR_CONFIG)
+    report = A1Report()
+    if use_cache:
+        results = cached_a1_results(working_set, config, engine)
+    else:
+        results = compute_a1_results(working_set, config, engine)
+
+    for gid, working_game in working_set.items():
+        if (gid, 'w') not in results:
+            # The analysis is unusable, see compute_a1_results.
+            continue
 
-    for gid, moves in working_set.items():
         def add_player_result(player, color):
-            result = a1_game(gid, config, moves, color, player)
+            result = results[gid, color]
             report.by_player[player].add(result)
             report.by_game[(player, gid)].add(result)
 
-        add_player_result(Game.objects.get(lichess_id=gid).white_player, 'w')
-        add_player_result(Game.objects.get(lichess_id=gid).black_player, 'b')
+        add_player_result(working_game.white_player, 'w')
+        add_player_result(working_game.black_player, 'b')
     return report
 
 
+def merge_a1_reports(reports) -> A1Report:
+    """Merge reports over disjoint sets of games, in the order given."""
+    merged = A1Report()
+    for report in reports:
+        for player, result in report.by_player.items():
+            merged.by_player[player].add(result)
+        for key, result in report.by_game.items():
+            merged.by_game[key].add(result)
+    return merged
+
+
+def a1_report_for_games(gameids, engine="python", use_cache=False) -> A1Report:
+    working_set = get_analysed_game_pgns_from_db(gameids, with_analysis=not use_cache)
+    return generate_a1_report(working_set, engine=engine, use_cache=use_cache)
+
+
+def generate_a1_report_parallel(gameids, workers, engine="python", use_cache=False) -> A1Report:
+    """Generate the report for gameids across a pool of worker processes.
+
+    The games are split into contiguous shards which are merged back in
+    order, so the result is the same as generate_a1_report over all of them.
+    """
+    gameids = list(dict.fromkeys(gameids))
+    shard_size = max(1, math.ceil(len(gameids) / (workers * 4)))
+    shards = [gameids[i:i + shard_size] for i in range(0, len(gameids), shard_size)]
+
+    # Workers are forked so that they inherit the configured django, but they
+    # must not share the parent's database connections.
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("fork")) as executor:
+        return merge_a1_reports(executor.map(
+            a1_report_for_games, shards, repeat(engine), repeat(use_cache)
+        ))
+
+
 def write_a1_to_txt(report: A1Report, report_name: str):
     out_path = f'report-a1--{datetime.now():%Y-%m-%d--%H-%M-%S}--{report_name}.txt'
     with open(out_path, 'w') as fout:
@@ -448,6 +838,137 @@ def a1_game(gid, config, moves, color, player):
     return r
 
 
+@dataclass
+class EvalArrays:
+    """A columnar view of a game's analysis for the vectorized A1 engine.
+
+    Missing evals are NaN so that any comparison against them is false,
+    which mirrors the `is not None` checks in a1_game. The evals a1_game
+    uses unchecked are checked by a1_game_arrays instead.
+    """
+    pv_evals: np.ndarray  # (plies, 5) centipawn evals of the top 5 pvs
+    played_eval: np.ndarray
+    played_rank: np.ndarray  # 0 when unknown
+    is_white: np.ndarray
+    number: np.ndarray
+
+    @classmethod
+    def from_analysis(cls, analysis):
+        if isinstance(analysis, PackedAnalysis):
+            return cls.from_packed(analysis)
+        plies = len(analysis)
+        pv_evals = np.full((plies, 5), np.nan)
+        played_eval = np.full(plies, np.nan)
+        played_rank = np.zeros(plies)
+        ply = np.zeros(plies, dtype=np.int64)
+        for i, move_analysis in enumerate(analysis):
+            for j, pv in enumerate(move_analysis['pvs'][:5]):
+                cp = int_or_none(pv['score']['cp'])
+                if cp is not None:
+                    pv_evals[i, j] = cp
+            cr = move_analysis['cr']
+            value = int_or_none(cr['played_eval'])
+            if value is not None:
+                played_eval[i] = value
+            played_rank[i] = int_or_none(cr['played_rank']) or 0
+            ply[i] = move_analysis['move']
+        return cls(
+            pv_evals=pv_evals,
+            played_eval=played_eval,
+            played_rank=played_rank,
+            is_white=ply % 2 == 1,
+            number=(ply - 1) // 2 + 1,
+        )
+
+    @classmethod
+    def from_packed(cls, packed):
+        plies = len(packed)
+        npvs = np.frombuffer(packed.npvs, dtype=np.uint8)
+        offsets = np.asarray(packed.pv_offsets[:-1], dtype=np.int64)
+        cps = np.frombuffer(packed.pv_cp, dtype=np.int32).astype(float)
+        cps[cps == NULL32] = np.nan
+        pv_evals = np.full((plies, 5), np.nan)
+        for i in range(5):
+            has_pv = npvs > i
+            pv_evals[has_pv, i] = cps[offsets[has_pv] + i]
+        played_eval = np.frombuffer(packed.played_eval, dtype=np.int32).astype(float)
+        played_eval[played_eval == NULL32] = np.nan
+        played_rank = np.frombuffer(packed.played_rank, dtype=np.int32).astype(float)
+        played_rank[played_rank == NULL32] = 0
+        ply = np.frombuffer(packed.move, dtype=np.int32).astype(np.int64)
+        return cls(
+            pv_evals=pv_evals,
+            played_eval=played_eval,
+            played_rank=played_rank,
+            is_white=ply % 2 == 1,
+            number=(ply - 1) // 2 + 1,
+        )
+
+def a1_game_arrays(gid, config, arrays, color, player):
+    """The same computation as a1_game, done with array operations over EvalArrays.
+    """
+    r = PgnSpyResult()
+    r.game_list.append(gid)
+
+    own = arrays.is_white if color == 'w' else ~arrays.is_white
+    pv1, pv2, pv3, pv4 = (arrays.pv_evals[:, i] for i in range(4))
+    evals = np.where(own, pv1, -pv1)
+
+    # a1_game raises TypeError on the missing evals it does arithmetic with,
+    # which makes the analysis unusable, so the same games are rejected here.
+    past_book = own & (arrays.number > config['book_depth'])
+    if np.isnan(pv1[~own | past_book]).any():
+        raise TypeError("missing pv1 eval")
+    considered = past_book & (pv1 > -config['undecided_pos_thresh']) & (pv1 < config['undecided_pos_thresh'])
+    if np.isnan(arrays.played_eval[considered]).any():
+        raise TypeError("missing played eval")
+
+    forced = config['forced_move_thresh']
+    unclear = config['unclear_pos_thresh']
+    t1 = considered & (pv1 <= pv2 + forced) & (pv1 <= pv2 + unclear)
+    t2 = t1 & (pv2 <= pv3 + forced) & (pv1 <= pv3 + unclear)
+    t3 = t2 & (pv3 <= pv4 + forced) & (pv1 <= pv4 + unclear)
+
+    rank = arrays.played_rank
+    ranked = rank != 0
+    t1 &= pv2 < pv1
+    t2 &= pv3 < pv2
+    t3 &= pv4 < pv3
+    r.t1_total = int(t1.sum())
+    r.t1_count = int((t1 & ranked & (rank <= 1)).sum())
+    r.t2_total = int(t2.sum())
+    r.t2_count = int((t2 & ranked & (rank <= 2)).sum())
+    r.t3_total = int(t3.sum())
+    r.t3_count = int((t3 & ranked & (rank <= 3)).sum())
+
+    cpl = np.minimum(np.maximum(pv1 - arrays.played_eval, 0), config['max_cpl'])[considered]
+    r.cp_loss_total = len(cpl)
+    for cp_name, cp_op in zip(cp_loss_names, _cp_loss_ops):
+        count = int(cp_op(cpl).sum())
+        if count:
+            r.cp_loss_count[cp_name] = count
+
+    flat = np.zeros(len(pv1), dtype=bool)
+    if config['exclude_flat']:
+        # Exclude flat evals from CPL, e.g. dead drawn endings
+        flat[2:] = (evals[1:-1] == pv1[2:]) & (evals[:-2] == pv1[2:])
+    sampled = cpl[~(flat[considered] & (cpl == 0))]
+    r.sample_size = len(sampled)
+    r.sample_total_cpl = int(sampled.sum())
+
+    return r
+
+def moves_from_analysis(analysis):
+    if isinstance(analysis, PackedAnalysis):
+        return list(analysis.moves())
+    return [Move(a) for a in analysis]
+
+a1_engines = {
+    "python": (moves_from_analysis, a1_game),
+    "numpy": (EvalArrays.from_analysis, a1_game_arrays),
+}
+
+
 def t_output(fout, result):
     if result.t1_total:
         fout.write('T1: {}\n'.format(generate_stats_string(result.t1_count, result.t1_total)))
@@ -465,7 +986,11 @@ def t_output(fout, result):
             fout.write(f'  {cp_loss_name} CP loss: {stats_str}\n')
 
 
-def cr_text_report(gameids, report_name: str):
-    working_set = get_analysed_game_pgns_from_db(gameids)
-    report = generate_a1_report(working_set)
+def cr_text_report(gameids, report_name: str, engine="python", workers=1, use_cache=True):
+    if workers > 1:
+        report = generate_a1_report_parallel(
+            gameids, workers, engine=engine, use_cache=use_cache
+        )
+    else:
+        report = a1_report_for_games(gameids, engine=engine, use_cache=use_cache)
     return write_a1_to_txt(report, report_name)
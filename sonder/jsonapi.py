@@ -4,13 +4,145 @@ Some helpers to deal with json in/json out
 import json
 from functools import wraps
 
-from jsonschema import validate, ValidationError
+import ijson
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
 
 from django.conf import settings
+from django.core.exceptions import RequestDataTooBig
 from django.http import (JsonResponse, HttpResponse, HttpResponseBadRequest)
 from django.utils.log import log_response
 
-def api(in_schema=None, out_schema=None, status=200):
+if orjson is not None:
+    loads = orjson.loads
+    JSONDecodeError = orjson.JSONDecodeError
+else:
+    loads = json.loads
+    JSONDecodeError = json.JSONDecodeError
+
+
+class Unsupported(Exception):
+    pass
+
+def _is_number(instance):
+    return isinstance(instance, (int, float)) and not isinstance(instance, bool)
+
+def _is_integer(instance):
+    if isinstance(instance, float):
+        return instance.is_integer()
+    return isinstance(instance, int) and not isinstance(instance, bool)
+
+_TYPE_CHECKS = {
+    "object": lambda instance: isinstance(instance, dict),
+    "array": lambda instance: isinstance(instance, list),
+    "string": lambda instance: isinstance(instance, str),
+    "boolean": lambda instance: isinstance(instance, bool),
+    "null": lambda instance: instance is None,
+    "number": _is_number,
+    "integer": _is_integer,
+}
+
+# Keywords that don't constrain anything.
+_ANNOTATIONS = {"title", "description", "$schema"}
+
+def fast_check(schema):
+    """Compile schema into a predicate built from plain python checks.
+
+    Only the keywords our schemas use are supported, anything else raises
+    Unsupported. The predicate only says whether an instance is valid, it's
+    up to jsonschema to explain why one isn't.
+    """
+    checks = []
+    for keyword, value in schema.items():
+        if keyword in _ANNOTATIONS:
+            continue
+        if keyword == "type":
+            types = [value] if isinstance(value, str) else value
+            type_checks = [_TYPE_CHECKS[t] for t in types]
+            checks.append(lambda i, c=type_checks: any(check(i) for check in c))
+        elif keyword == "required":
+            checks.append(
+                lambda i, r=value: not isinstance(i, dict) or all(k in i for k in r)
+            )
+        elif keyword == "properties":
+            properties = {k: fast_check(v) for k, v in value.items()}
+            checks.append(
+                lambda i, p=properties: not isinstance(i, dict)
+                or all(p[k](v) for k, v in i.items() if k in p)
+            )
+        elif keyword == "items" and isinstance(value, dict):
+            item_check = fast_check(value)
+            checks.append(
+                lambda i, c=item_check: not isinstance(i, list)
+                or all(c(item) for item in i)
+            )
+        elif keyword == "anyOf":
+            any_of = [fast_check(subschema) for subschema in value]
+            checks.append(lambda i, a=any_of: any(check(i) for check in a))
+        elif keyword == "minimum":
+            checks.append(lambda i, m=value: not _is_number(i) or i >= m)
+        else:
+            raise Unsupported(keyword)
+    if len(checks) == 1:
+        return checks[0]
+    return lambda instance: all(check(instance) for check in checks)
+
+class CompiledSchema:
+    """A schema's jsonschema validator, built once, and its fast_check."""
+
+    def __init__(self, schema):
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        self.validator = cls(schema)
+        try:
+            self.is_valid = fast_check(schema)
+        except Unsupported:
+            self.is_valid = self.validator.is_valid
+
+    def error(self, instance):
+        """The most relevant error of instance, or None if it is valid."""
+        if self.is_valid(instance):
+            return None
+        return best_match(self.validator.iter_errors(instance))
+
+def item_schema(schema, prefix):
+    """The schema of the items at an ijson prefix, like "analyses.item"."""
+    for part in prefix.split("."):
+        schema = schema["items"] if part == "item" else schema["properties"][part]
+    return schema
+
+class InvalidItem(Exception):
+    def __init__(self, error):
+        super().__init__(error.message)
+        self.error = error
+
+def stream_json(stream, item_schemas, buf_size=16 * 1024):
+    """Parse the json document read from stream as it comes in.
+
+    item_schemas maps ijson prefixes to CompiledSchemas. Every item at one of
+    those prefixes is checked as soon as it has been parsed, raising
+    InvalidItem before the rest of the document is read. The raw document is
+    never held in memory in one piece.
+    """
+    builder = ijson.ObjectBuilder()
+    # Every ply repeats the same few keys, share one copy of each.
+    keys = {}
+    for prefix, event, value in ijson.parse(stream, buf_size=buf_size, use_float=True):
+        if event == "map_key":
+            value = keys.setdefault(value, value)
+        builder.event(event, value)
+        if prefix in item_schemas and event not in ("start_map", "start_array", "map_key"):
+            error = item_schemas[prefix].error(builder.containers[-1][-1])
+            if error is not None:
+                raise InvalidItem(error)
+    return builder.value
+
+def api(in_schema=None, out_schema=None, status=200, stream_items=()):
     """
     Decorator to make a view only accept and return a particular json schema. Usage::
         @json_api(JobRequest, JobResponse)
@@ -19,8 +151,20 @@ def api(in_schema=None, out_schema=None, status=200):
             return job_response
 
     Both parameters are optional and if left out, no processing will be done for that
-    direction.
+    direction. The schemas are compiled once, here. Responses are only validated if
+    settings.JSONAPI_VALIDATE_RESPONSES is set, which it is in development and tests.
+
+    Request bodies with large arrays, like the plies of an analysis, can be parsed
+    as they are read by listing the ijson prefixes of their items in stream_items,
+    see stream_json. That is much slower than parsing the whole body at once, so it's
+    only done for bodies of at least settings.JSONAPI_STREAM_MIN_BYTES.
     """
+    in_validator = CompiledSchema(in_schema) if in_schema else None
+    out_validator = CompiledSchema(out_schema) if out_schema else None
+    item_validators = {
+        prefix: CompiledSchema(item_schema(in_schema, prefix)) for prefix in stream_items
+    }
+
     def decorator(func):
         @wraps(func)
         def inner(request, *args, **kwargs):
@@ -34,16 +178,35 @@ def api(in_schema=None, out_schema=None, status=200):
             json_request = None
             if in_schema:
                 try:
-                    json_request = json.loads(request.body)
-                except json.JSONDecodeError:
+                    content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+                    if (
+                        item_validators
+                        and content_length >= settings.JSONAPI_STREAM_MIN_BYTES
+                    ):
+                        # The same limit Django applies to request.body.
+                        limit = settings.DATA_UPLOAD_MAX_MEMORY_SIZE
+                        if limit is not None and content_length > limit:
+                            raise RequestDataTooBig(
+                                'Request body exceeded settings.DATA_UPLOAD_MAX_MEMORY_SIZE.'
+                            )
+                        json_request = stream_json(request, item_validators)
+                    else:
+                        json_request = loads(request.body)
+                except (JSONDecodeError, ijson.JSONError):
                     response = HttpResponseBadRequest("Unable to decode json body")
                     # TODO: these logs aren't printing in dev.
                     log("Bad Request", response)
                     return response
+                except InvalidItem as e:
+                    response = HttpResponseBadRequest(json.dumps(
+                        {'error': str(e.error.message)}
+                    ))
+                    # TODO: these logs aren't printing in dev.
+                    log("Bad Request", response)
+                    return response
 
-                try:
-                    validate(instance=json_request, schema=in_schema)
-                except ValidationError as e:
+                e = in_validator.error(json_request)
+                if e is not None:
                     response = HttpResponseBadRequest(json.dumps(
                         {'error': str(e.message)}
                     ))
@@ -55,11 +218,12 @@ def api(in_schema=None, out_schema=None, status=200):
                 return response
 
             if out_schema:
-                try:
-                    validate(instance=response, schema=out_schema)
-                except ValidationError as e:
+                e = None
+                if settings.JSONAPI_VALIDATE_RESPONSES:
+                    e = out_validator.error(response)
+                if e is not None:
                     if settings.DEBUG:
-                        raise
+                        raise e
                     response = HttpResponseBadRequest(json.dumps(
                         {'error': str(e.message)}
                     ))
@@ -0,0 +1,243 @@
+"""
+A concurrent, rate limited client for the lichess game export API.
+"""
+import queue
+import random
+import threading
+import time
+
+import requests
+from django.conf import settings
+
+EXPORT_IDS_PATH = "/games/export/_ids"
+
+# Lichess asks clients that got a 429 to wait a full minute.
+RATE_LIMITED_WAIT = 60.0
+
+
+class LichessError(Exception):
+    pass
+
+
+def chunks(l, n):
+    """Yield successive n-sized chunks from l."""
+    for i in range(0, len(l), n):
+        yield l[i : i + n]
+
+
+class TokenBucket:
+    """A thread safe token bucket.
+
+    Allows bursts of up to capacity requests and rate requests per second on
+    average. pause() stops everyone from getting a token for a while, which
+    is what lichess wants after a 429.
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + seconds)
+            self.tokens = 0
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = self.clock()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    start = max(self.updated, self.paused_until)
+                    self.tokens = min(
+                        self.capacity, self.tokens + (now - start) * self.rate
+                    )
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+def iter_pgns(lines):
+    """Split a stream of PGN lines into one string per game.
+
+    A game ends at the first tag line after its movetext, so games are yielded
+    as soon as they have been received.
+    """
+    game = []
+    in_movetext = False
+    for line in lines:
+        if line.startswith("["):
+            if in_movetext:
+                yield "\n".join(game).strip()
+                game = []
+                in_movetext = False
+        elif line.strip() and game:
+            in_movetext = True
+        game.append(line)
+    pgn = "\n".join(game).strip()
+    if pgn:
+        yield pgn
+
+
+class LichessDownloader:
+    """Downloads game PGNs from lichess with several requests in flight.
+
+    All requests share a pooled session and a token bucket. Failed requests
+    are retried with exponential backoff, honouring Retry-After when lichess
+    sends one. PGNs are parsed while the response streams in and handed to
+    the consumer through a bounded queue so memory use doesn't grow with the
+    number of games.
+    """
+
+    def __init__(
+        self,
+        base_url=None,
+        token=None,
+        workers=4,
+        rate=1.0,
+        burst=None,
+        chunk_size=300,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=RATE_LIMITED_WAIT,
+        queue_size=1000,
+        sleep=time.sleep,
+    ):
+        self.base_url = (base_url or settings.LICHESS_API_URL).rstrip("/")
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.queue_size = queue_size
+        self.sleep = sleep
+        self.bucket = TokenBucket(rate, burst or workers, sleep=sleep)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=workers
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Accept"] = "application/x-chess-pgn"
+        token = token if token is not None else settings.LICHESS_API_TOKEN
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def retry_delay(self, response, attempt):
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+        if retry_after is not None:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        if response is not None and response.status_code == 429:
+            return self.max_backoff
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay * random.uniform(0.5, 1.0)
+
+    def post_ids(self, game_ids):
+        """POST a chunk of ids, retrying until we get a streaming response."""
+        url = f"{self.base_url}{EXPORT_IDS_PATH}"
+        body = ",".join(game_ids)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                response = self.session.post(
+                    url,
+                    data=body,
+                    headers={"Content-Type": "text/plain"},
+                    stream=True,
+                    timeout=60,
+                )
+            except requests.ConnectionError:
+                response = None
+            else:
+                if response.status_code == 200:
+                    return response
+                response.close()
+                if response.status_code != 429 and response.status_code < 500:
+                    raise LichessError(
+                        f"{url} responded with {response.status_code}"
+                    )
+            delay = self.retry_delay(response, attempt)
+            if response is not None and response.status_code == 429:
+                self.bucket.pause(delay)
+            else:
+                self.sleep(delay)
+        raise LichessError(f"{url} failed after {self.max_retries + 1} attempts")
+
+    def iter_chunk(self, game_ids):
+        with self.post_ids(game_ids) as response:
+            response.encoding = response.encoding or "utf-8"
+            yield from iter_pgns(response.iter_lines(decode_unicode=True))
+
+    def download(self, game_ids):
+        """Yield the PGN of each of the game_ids that lichess knows about.
+
+        PGNs come out in the order they arrive rather than in the order of
+        game_ids.
+        """
+        work = queue.Queue()
+        for chunk in chunks(list(game_ids), self.chunk_size):
+            work.put(chunk)
+        results = queue.Queue(maxsize=self.queue_size)
+        stopped = threading.Event()
+        done = object()
+
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                while not stopped.is_set():
+                    try:
+                        chunk = work.get_nowait()
+                    except queue.Empty:
+                        break
+                    for pgn in self.iter_chunk(chunk):
+                        if not put(pgn):
+                            return
+            except Exception as e:  # pylint: disable=broad-except
+                put(e)
+            finally:
+                put(done)
+
+        threads = [
+            threading.Thread(target=worker, daemon=True)
+            for _ in range(min(self.workers, work.qsize()))
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            running = len(threads)
+            while running:
+                item = results.get()
+                if item is done:
+                    running -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stopped.set()
+            for thread in threads:
+                thread.join()
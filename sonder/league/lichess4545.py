@@ -0,0 +1,166 @@
+"""
+Scrapes the pairings of lichess4545 leagues, with an on-disk HTTP cache.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import requests
+from django.conf import settings
+
+ROUNDS = range(1, 12)
+
+
+@dataclass
+class CachedResponse:
+    url: str
+    status_code: int
+    text: str
+    from_cache: bool = False
+
+
+class HTTPCache:
+    """A directory of responses, revalidated with ETag/Last-Modified.
+
+    Responses fetched with frozen=True are served straight from disk once
+    they have been fetched or revalidated with frozen=True, for pages that
+    can't change anymore. A page cached before it was frozen is revalidated
+    once first, since it may have changed since. Missing pages are never
+    frozen, as they may still be published.
+    """
+
+    def __init__(self, directory, session=None):
+        self.directory = directory
+        self.session = session or requests.Session()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest())
+
+    def load(self, url):
+        try:
+            with open(self.path(url), encoding="utf-8") as fin:
+                return json.load(fin)
+        except FileNotFoundError:
+            return None
+
+    def store(self, url, entry):
+        # Write and rename so concurrent readers never see half a file.
+        fd, tmp = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "w", encoding="utf-8") as fout:
+            json.dump(entry, fout)
+        os.replace(tmp, self.path(url))
+
+    def get(self, url, frozen=False):
+        entry = self.load(url)
+        if entry and frozen and entry.get("frozen"):
+            return CachedResponse(url, entry["status_code"], entry["text"], True)
+
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        response = self.session.get(url, headers=headers, timeout=60)
+        if response.status_code == 304 and entry:
+            if frozen and entry["status_code"] < 400:
+                entry["frozen"] = True
+                self.store(url, entry)
+            return CachedResponse(url, entry["status_code"], entry["text"], True)
+
+        entry = {
+            "status_code": response.status_code,
+            "text": response.text,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "frozen": frozen and response.ok,
+        }
+        # Errors other than a missing page are worth asking about again.
+        if response.ok or response.status_code == 404:
+            self.store(url, entry)
+        return CachedResponse(url, response.status_code, response.text)
+
+
+def split_season_id(season):
+    """Split a season id into its series and number, so seasons can be ordered.
+
+    Ids start with the season number, and the rest names the series, e.g.
+    13u1800 is season 13 of u1800 and 13 is season 13 of the main series.
+    """
+    match = re.match(r"(\d+)(.*)$", season)
+    if not match:
+        return season, 0
+    return match.group(2), int(match.group(1))
+
+
+def current_seasons(seasons):
+    """The newest season of each series, e.g. of both lonewolf and u1800."""
+    newest = {}
+    for season in seasons:
+        series, number = split_season_id(season)
+        if number >= newest.get(series, (-1, None))[0]:
+            newest[series] = (number, season)
+    return {season for _, season in newest.values()}
+
+
+class Lichess4545Scraper:
+    """Fetches pairings pages concurrently through an HTTPCache.
+
+    Only the newest season of each series can still change, so the pages of
+    all the other seasons are only revalidated once after the season closed,
+    and missing rounds are asked for again. refresh=True revalidates every
+    page.
+    """
+
+    def __init__(
+        self, base_url=None, cache_dir=None, workers=8, refresh=False, session=None
+    ):
+        self.base_url = (base_url or settings.LICHESS4545_URL).rstrip("/")
+        self.workers = workers
+        self.refresh = refresh
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=workers
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.cache = HTTPCache(cache_dir or settings.LICHESS4545_CACHE_DIR, session)
+
+    def season_ids(self, league):
+        # They all have a season 2, lonewolf doesn't have a season 1. :'(
+        url = f"{self.base_url}/{league}/season/2/summary/"
+        response = self.cache.get(url)
+        ids = re.findall(rf"{league}/season/([\w]+)/summary", response.text)
+        return list(dict.fromkeys(ids))
+
+    def round_game_ids(self, league, season, roundnum, closed=False):
+        url = f"{self.base_url}/{league}/season/{season}/round/{roundnum}/pairings/"
+        response = self.cache.get(url, frozen=closed and not self.refresh)
+        if response.status_code != 200:
+            return []
+        ids = re.findall(r"en\.lichess\.org\/([\w]+)", response.text)
+        return [(league, season, roundnum, id) for id in ids]
+
+    def season_game_ids(self, league, seasons=None, rounds=None):
+        """Scrape (league, season, round, game id) for every pairing.
+
+        Without seasons every season of the league is scraped.
+        """
+        all_seasons = self.season_ids(league)
+        seasons = seasons or all_seasons
+        rounds = rounds or ROUNDS
+        current = current_seasons(all_seasons)
+        closed = set(all_seasons) - current
+        pages = [
+            (league, season, roundnum, season in closed)
+            for season in seasons
+            for roundnum in rounds
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(lambda page: self.round_game_ids(*page), pages)
+            return [game for round_games in results for game in round_games]
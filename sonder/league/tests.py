@@ -0,0 +1,274 @@
+import hashlib
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.test import SimpleTestCase, TestCase
+
+from ..analysis.models import Game
+from .lichess import LichessDownloader, LichessError, iter_pgns
+from .lichess4545 import Lichess4545Scraper, current_seasons, split_season_id
+from .utils import import_pgns
+
+
+def fake_pgn(game_id):
+    return "\n".join(
+        [
+            '[Event "Rated Blitz game"]',
+            f'[Site "https://lichess.org/{game_id}"]',
+            f'[White "white-{game_id}"]',
+            f'[Black "black-{game_id}"]',
+            '[Result "1-0"]',
+            '[TimeControl "300+0"]',
+            "",
+            "1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0",
+        ]
+    )
+
+
+class FakeLichess(ThreadingHTTPServer):
+    """Serves /games/export/_ids the way lichess does.
+
+    The first `rate_limited` requests get a 429, and every response is
+    delayed by `latency` seconds.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, rate_limited=0, retry_after="0", latency=0.0):
+        super().__init__(("127.0.0.1", 0), FakeLichessHandler)
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.latency = latency
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeLichessHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        server = self.server
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        with server.lock:
+            server.requests += 1
+            rate_limited = server.requests <= server.rate_limited
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            if rate_limited:
+                self.send_response(429)
+                if server.retry_after is not None:
+                    self.send_header("Retry-After", server.retry_after)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            payload = "\n\n\n".join(fake_pgn(i) for i in body.split(",")).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-chess-pgn")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+def game_ids(count):
+    return [f"g{i:07}" for i in range(count)]
+
+
+class TestLichessDownloader(SimpleTestCase):
+    def downloader(self, server, **kwargs):
+        kwargs = {"token": "", "rate": 1000.0, "chunk_size": 50, **kwargs}
+        return LichessDownloader(base_url=server.url, **kwargs)
+
+    def test_iter_pgns(self):
+        text = "\n\n\n".join(fake_pgn(i) for i in game_ids(3))
+        self.assertEqual(
+            list(iter_pgns(text.splitlines())), [fake_pgn(i) for i in game_ids(3)]
+        )
+
+    def test_downloads_concurrently(self):
+        ids = game_ids(1000)
+        with FakeLichess(latency=0.05) as server:
+            started = time.monotonic()
+            pgns = list(self.downloader(server, workers=4).download(ids))
+            elapsed = time.monotonic() - started
+        self.assertEqual(sorted(pgns), sorted(fake_pgn(i) for i in ids))
+        self.assertEqual(server.requests, 20)
+        self.assertGreater(server.max_in_flight, 1)
+        # 20 requests of 50ms each, so they must have overlapped.
+        self.assertLess(elapsed, 20 * 0.05)
+
+    def test_backs_off_when_rate_limited(self):
+        ids = game_ids(100)
+        with FakeLichess(rate_limited=2, retry_after="0.2") as server:
+            started = time.monotonic()
+            pgns = list(self.downloader(server, workers=1).download(ids))
+            elapsed = time.monotonic() - started
+        self.assertEqual(len(pgns), 100)
+        self.assertEqual(server.requests, 4)
+        self.assertGreaterEqual(elapsed, 0.4)
+
+    def test_gives_up_after_max_retries(self):
+        with FakeLichess(rate_limited=10, retry_after=None) as server:
+            downloader = self.downloader(
+                server, workers=1, max_retries=2, max_backoff=0.01
+            )
+            with self.assertRaises(LichessError):
+                list(downloader.download(game_ids(10)))
+        self.assertEqual(server.requests, 3)
+
+
+class TestImportDownloadedGames(TestCase):
+    def test_import_streams_into_db(self):
+        ids = game_ids(120)
+        with FakeLichess() as server:
+            downloader = LichessDownloader(
+                base_url=server.url, token="", rate=1000.0, chunk_size=50
+            )
+            self.assertEqual(import_pgns(downloader.download(ids)), 120)
+        self.assertEqual(Game.objects.filter(lichess_id__in=ids).count(), 120)
+
+
+class FakeLichess4545(FakeLichess):
+    """Serves pages from a dict, answering conditional requests with a 304."""
+
+    def __init__(self, pages):
+        super().__init__()
+        self.RequestHandlerClass = FakeLichess4545Handler
+        self.pages = pages
+        self.paths = []
+        self.not_modified = 0
+
+
+class FakeLichess4545Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        with server.lock:
+            server.paths.append(self.path)
+        if self.path not in server.pages:
+            self.send_error(404)
+            return
+        payload = server.pages[self.path].encode()
+        etag = '"%s"' % hashlib.sha1(payload).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            with server.lock:
+                server.not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def pairings_page(game_ids):
+    return "".join(
+        f'<a href="https://en.lichess.org/{game_id}">game</a>' for game_id in game_ids
+    )
+
+
+class TestLichess4545Scraper(SimpleTestCase):
+    def setUp(self):
+        summary = "".join(
+            f'<a href="/team4545/season/{season}/summary/">' for season in (1, 2, 3)
+        )
+        self.pages = {"/team4545/season/2/summary/": summary}
+        for season in (1, 2, 3):
+            for roundnum in (1, 2):
+                self.pages[
+                    f"/team4545/season/{season}/round/{roundnum}/pairings/"
+                ] = pairings_page([f"s{season}r{roundnum}g1", f"s{season}r{roundnum}g2"])
+        self.cache_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.cache_dir.cleanup()
+
+    def scrape(self, server, **kwargs):
+        scraper = Lichess4545Scraper(
+            base_url=server.url, cache_dir=self.cache_dir.name, **kwargs
+        )
+        return {
+            game_id for _, _, _, game_id in scraper.season_game_ids(
+                "team4545", rounds=[1, 2, 3]
+            )
+        }
+
+    def test_current_seasons(self):
+        self.assertEqual(
+            current_seasons(["2", "10", "9u1800", "10u1800", "13u1800", "13"]),
+            {"13", "13u1800"},
+        )
+        self.assertEqual(split_season_id("13u1800"), ("u1800", 13))
+
+    def test_unchanged_closed_seasons_are_not_requested(self):
+        with FakeLichess4545(self.pages) as server:
+            self.assertEqual(len(self.scrape(server)), 12)
+            self.assertEqual(len(server.paths), 10)
+
+            server.paths.clear()
+            self.pages["/team4545/season/3/round/3/pairings/"] = pairings_page(["new"])
+            self.assertIn("new", self.scrape(server))
+            # The current season, and the missing rounds of the closed ones.
+            self.assertEqual(len(server.paths), 6)
+            self.assertEqual(server.not_modified, 3)
+            self.assertTrue(
+                all(
+                    "season/3/" in p or "summary" in p or "round/3/" in p
+                    for p in server.paths
+                )
+            )
+
+            server.paths.clear()
+            self.assertEqual(len(self.scrape(server, refresh=True)), 13)
+            self.assertEqual(len(server.paths), 10)
+
+    def test_season_rollover(self):
+        del self.pages["/team4545/season/3/round/2/pairings/"]
+        with FakeLichess4545(self.pages) as server:
+            self.assertEqual(len(self.scrape(server)), 10)
+
+            # Season 3 closes with a round published after the last scrape.
+            self.pages["/team4545/season/2/summary/"] += (
+                '<a href="/team4545/season/4/summary/">'
+            )
+            self.pages["/team4545/season/3/round/2/pairings/"] = pairings_page(
+                ["s3r2g1"]
+            )
+            self.pages["/team4545/season/4/round/1/pairings/"] = pairings_page(
+                ["s4r1g1"]
+            )
+            self.assertLessEqual({"s3r2g1", "s4r1g1"}, self.scrape(server))
+            self.assertIn("/team4545/season/3/round/1/pairings/", server.paths)
+
+            # Revalidated once, season 3 is now served from the cache.
+            server.paths.clear()
+            self.assertEqual(len(self.scrape(server)), 12)
+            self.assertFalse(
+                [p for p in server.paths if "season/3/" in p and "round/3/" not in p]
+            )
@@ -0,0 +1,52 @@
+"""
+Per request memory accounting, to help size the gunicorn workers.
+"""
+import logging
+import resource
+import tracemalloc
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+logger = logging.getLogger("sonder.memory")
+
+
+class MemoryAccountingMiddleware:
+    """Logs how much memory each request needed.
+
+    peak is the most python memory allocated during the request that was
+    in use at once, as traced by tracemalloc. maxrss is the worker's peak
+    resident set size so far, so requests that raise it are the ones the
+    workers have to be sized for. The peak is also sent back in the
+    X-Memory-Peak-KiB header.
+
+    Traces are cleared at the start of every request, which only gives
+    meaningful numbers with one request at a time per process, like
+    gunicorn's sync workers. Tracing slows everything down, so this is only
+    enabled by settings.REQUEST_MEMORY_ACCOUNTING.
+    """
+
+    def __init__(self, get_response):
+        if not settings.REQUEST_MEMORY_ACCOUNTING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __call__(self, request):
+        tracemalloc.clear_traces()
+        maxrss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        response = self.get_response(request)
+        _, peak = tracemalloc.get_traced_memory()
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        response["X-Memory-Peak-KiB"] = str(peak // 1024)
+        logger.info(
+            "%s %s %s peak=%dKiB maxrss=%dKiB (+%dKiB)",
+            request.method,
+            request.path,
+            response.status_code,
+            peak // 1024,
+            maxrss,
+            maxrss - maxrss_before,
+        )
+        return response
@@ -14,3 +14,8 @@ class DefaultDictInt(collections.defaultdict):
     def __init__(self, *args, **kwargs):
         super().__init__(int, *args, **kwargs)
 
+    # defaultdict pickles itself as cls(default_factory), which our __init__
+    # would pass on as the initial items.
+    def __reduce__(self):
+        return (type(self), (), None, None, iter(self.items()))
+
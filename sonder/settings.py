@@ -3,6 +3,7 @@ Django settings for sonder project.
 """
 
 import os
+import sys
 import dj_database_url
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -14,6 +15,7 @@ BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.environ.get('SECRET_KEY', 'dr#-g98prpuk8&mbz+m02o&!&ne6pkhf^-6o^15f&k8t$dzn6s')
 DEBUG = os.environ.get('DEBUG', False)
+TESTING = sys.argv[1:2] == ['test']
 
 ALLOWED_HOSTS = [
     os.environ.get('ALLOWED_HOSTS', 'localhost'),
@@ -35,6 +37,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'sonder.middleware.MemoryAccountingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -107,6 +110,56 @@ AUTHLIB_OAUTH_CLIENTS = {
     }
 }
 
+LICHESS_API_URL = os.environ.get('LICHESS_API_URL', 'https://lichess.org')
+LICHESS_API_TOKEN = os.environ.get('LICHESS_API_TOKEN', '')
+
+LICHESS4545_URL = os.environ.get('LICHESS4545_URL', 'https://www.lichess4545.com')
+LICHESS4545_CACHE_DIR = os.environ.get(
+    'LICHESS4545_CACHE_DIR', os.path.join(BASE_DIR, '.cache', 'lichess4545')
+)
+
+# How long a fishnet client may go without reporting progress before its
+# game is given to someone else.
+ANALYSIS_LEASE_SECONDS = int(os.environ.get('ANALYSIS_LEASE_SECONDS', 600))
+
+# How long each process trusts its cached AnalysisSource api key lookups.
+# Saving a source through the admin clears the cache of that process only.
+ANALYSIS_SOURCE_CACHE_SECONDS = int(os.environ.get('ANALYSIS_SOURCE_CACHE_SECONDS', 60))
+
+# Analyses are stamped with date_modified before their transaction commits, so
+# the player reports job leaves the ones this recent for its next run.
+PLAYER_REPORTS_SETTLE_SECONDS = int(os.environ.get('PLAYER_REPORTS_SETTLE_SECONDS', 300))
+
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+
+# Check that jsonapi views return what their schema says. Every response is
+# validated, so it's off in production by default.
+JSONAPI_VALIDATE_RESPONSES = os.environ.get(
+    'JSONAPI_VALIDATE_RESPONSES', '1' if DEBUG or TESTING else '0'
+) == '1'
+
+# Request bodies at least this big are parsed while they are read, instead of
+# after reading all of them, by the jsonapi views that support it.
+JSONAPI_STREAM_MIN_BYTES = int(os.environ.get('JSONAPI_STREAM_MIN_BYTES', 256 * 1024))
+
+# Log the peak memory use of every request, see sonder.middleware.
+REQUEST_MEMORY_ACCOUNTING = os.environ.get('REQUEST_MEMORY_ACCOUNTING', '0') == '1'
+
+# The name of a scratch database that the benchmarks in sonder.bench may fill
+# and empty. They refuse to run against any other but test databases.
+BENCH_DATABASE = os.environ.get('BENCH_DATABASE', '')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'sonder.memory': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
 GRAPHENE = {
     'SCHEMA': 'sonder.schema.schema',
     'MIDDLEWARE': [
@@ -1,19 +1,225 @@
 import chess.pgn
+import chess.polyglot
+from collections import OrderedDict
 import io
+from itertools import islice
+import threading
+import time
 
 from django.db import models
 from django.utils.text import slugify
 
+# Positions this many plies in are not worth caching, few games share them.
+OPENING_CACHE_PLIES = 20
+OPENING_CACHE_MAX_SIZE = 200000
+
+
+class OpeningCache:
+    """A trie of the moves of common openings from the standard position.
+
+    Each node maps a SAN token to the move it stands for, its SAN as
+    exported and the node after it. Games that follow a cached line get
+    their moves without generating legal moves to parse the SAN.
+    """
+
+    def __init__(self, max_plies=OPENING_CACHE_PLIES, max_size=OPENING_CACHE_MAX_SIZE):
+        self.max_plies = max_plies
+        self.max_size = max_size
+        self.size = 0
+        self.root = {}
+
+    def clear(self):
+        self.size = 0
+        self.root = {}
+
+    def add(self, node, token, move, san):
+        """Cache move under node, returning the node after it, if there's room."""
+        if self.size >= self.max_size:
+            return None
+        self.size += 1
+        child = {}
+        node[token] = (move, san, child)
+        return child
+
+
+opening_cache = OpeningCache()
+
+
+class IngestVisitor(chess.pgn.StringExporter):
+    """Parses a PGN into its headers, re-exported PGN and uci moves at once.
+
+    Variations, comments and NAGs are skipped. The export is that of a
+    StringExporter without variations or comments, except that moves are
+    written with the SAN they were read as instead of being regenerated, so
+    they match only for PGNs with standard SAN like lichess exports. Opening
+    moves come from opening_cache.
+    """
+
+    def __init__(self, cache=None):
+        super().__init__(headers=True, variations=False, comments=False)
+        self.cache = cache or opening_cache
+        self.game_headers = chess.pgn.Headers()
+        self.moves = []
+        self.written = 0
+        self.node = None
+        self.token = None
+        self.san = None
+        self.errors = []
+
+    def begin_headers(self):
+        super().begin_headers()
+        return self.game_headers
+
+    def visit_header(self, tagname, tagvalue):
+        self.game_headers[tagname] = tagvalue
+
+    def end_headers(self):
+        for tagname, tagvalue in self.game_headers.items():
+            super().visit_header(tagname, tagvalue)
+        super().end_headers()
+        standard = "FEN" not in self.game_headers and (
+            self.game_headers.get("Variant", "Standard").lower()
+            in ("standard", "chess")
+        )
+        self.node = self.cache.root if standard else None
+
+    def parse_san(self, board, san):
+        self.token = san
+        node = self.node
+        if node is not None and san in node:
+            move, self.san, self.node = node[san]
+            return move
+        self.san = None
+        return board.parse_san(san)
+
+    def visit_move(self, board, move):
+        if board.turn == chess.WHITE:
+            self.write_token(f"{board.fullmove_number}. ")
+        elif self.force_movenumber:
+            self.write_token(f"{board.fullmove_number}... ")
+        self.force_movenumber = False
+        self.moves.append(move)
+
+    def visit_board(self, board):
+        # Called with the move pushed, when check is cheap to test for. The
+        # tokenizer drops check and mate suffixes, so they're added back.
+        if len(self.moves) == self.written:
+            return
+        self.written += 1
+        san = self.san
+        if san is None:
+            san = self.token
+            if not self.moves[-1]:
+                san = "--"
+            elif san[0] == "0":
+                san = san.replace("0", "O")
+            if board.is_check():
+                san += "#" if board.is_checkmate() else "+"
+            if self.node is not None and self.written <= self.cache.max_plies:
+                self.node = self.cache.add(self.node, self.token, self.moves[-1], san)
+            else:
+                self.node = None
+        self.write_token(f"{san} ")
+
+    def visit_result(self, result):
+        # Like GameBuilder, the headers win unless they have no result, in
+        # which case the Result header already written is replaced.
+        if self.game_headers.get("Result", "*") == "*":
+            self.game_headers["Result"] = result
+            for i, line in enumerate(self.lines):
+                if line == '[Result "*"]':
+                    self.lines[i] = f'[Result "{result}"]'
+                    break
+
+    def end_game(self):
+        super().visit_result(self.game_headers.get("Result", "*"))
+        super().end_game()
+
+    def handle_error(self, error):
+        chess.pgn.LOGGER.error("%s while parsing %r", error, self.game_headers)
+        self.errors.append(error)
+
+    def result(self):
+        return self.game_headers, super().result(), [move.uci() for move in self.moves]
+
+
 def pgn_to_uci(pgn):
     """A method that should take a PGN string and return a list of uci moves.
     """
-    pgn = io.StringIO(pgn)
-    game = chess.pgn.read_game(pgn)
-    moves = []
-    for move in game.mainline_moves():
-        moves.append(move.uci())
+    _, _, moves = chess.pgn.read_game(io.StringIO(pgn), Visitor=IngestVisitor)
     return moves
 
+def signed64(n):
+    """Reinterpret an unsigned 64 bit integer as signed, to fit a bigint."""
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+def zobrist_hashes(moves, board=None):
+    """The zobrist hash of each position of a game given as uci moves.
+
+    Starts with the hash of the initial position, so there is one more hash
+    than there are moves. The hashes are signed, see signed64.
+    """
+    board = board or chess.Board()
+    hashes = [signed64(chess.polyglot.zobrist_hash(board))]
+    for move in moves:
+        board.push_uci(move)
+        hashes.append(signed64(chess.polyglot.zobrist_hash(board)))
+    return hashes
+
+def batches(iterable, size):
+    """Yield successive lists of at most size items from iterable."""
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+class TTLCache:
+    """A thread safe in-process cache whose entries expire after ttl seconds.
+
+    Each process has its own, so clear() only affects the current process and
+    other processes can serve stale entries for up to ttl seconds. None is
+    never cached, and once there are maxsize entries the oldest are dropped.
+    """
+
+    def __init__(self, ttl, maxsize=1024, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        # Every entry lives for ttl, so insertion order is also expiry order.
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_or_set(self, key, default):
+        """The cached value of key, calling default() to fill it if needed."""
+        now = self.clock()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.entries[key]
+                entry = None
+        if entry is not None:
+            return entry[1]
+        value = default()
+        if value is None:
+            return value
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (now + self.ttl, value)
+            self._evict(now)
+        return value
+
+    def _evict(self, now):
+        while self.entries:
+            expires, _ = next(iter(self.entries.values()))
+            if expires > now and len(self.entries) <= self.maxsize:
+                break
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
 def _const_name(name):
     return slugify(name).replace("-", "_").upper()
 
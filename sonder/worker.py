@@ -0,0 +1,25 @@
+"""
+The rq worker. Jobs use the django ORM, so django is set up before the
+worker starts importing them.
+"""
+import os
+
+import django
+from dotenv import load_dotenv
+
+
+def main():
+    load_dotenv()
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sonder.settings")
+    django.setup()
+
+    # pylint: disable=locally-disabled, import-outside-toplevel
+    from django.conf import settings
+    from redis import Redis
+    from rq import Worker
+
+    Worker(["default"], connection=Redis.from_url(settings.REDIS_URL)).work()
+
+
+if __name__ == "__main__":
+    main()